@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Load test for the isOGen backend against the mock ComfyUI
+Starts the mock and the backend as subprocesses (unless --url is given),
+drives one endpoint at a fixed concurrency and reports throughput,
+latency percentiles, the backend's peak RSS and bytes moved per job
+
+    python benchmarks/load_test.py --endpoint process-base64 --concurrency 8 --requests 64 --latency 0.5
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from PIL import Image
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+ENDPOINTS = ("process-base64", "process", "jobs", "batch")
+BACKEND_BOOT = (
+    "import sys, comfy_service; "
+    "comfy_service.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True, debug=False)"
+)
+
+class JobCancelled(Exception):
+    """The backend cancelled the job (client request, disconnect or the abandoned-job reaper)"""
+
+def make_input_png(side):
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+def wait_for(url, timeout=30):
+    """Poll url until it answers at all"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+def peak_rss_kb(pid):
+    """High-water mark of a process's resident set from /proc (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+class Driver:
+    """Sends one kind of request per call and records latency and wire bytes"""
+    def __init__(self, base_url, endpoint, image_data, unique_prompts, batch_size, job_timeout, clients=1):
+        self.base_url = base_url.rstrip("/")
+        self.endpoint = endpoint
+        self.image_data = image_data
+        self.image_base64 = base64.b64encode(image_data).decode()
+        self.unique_prompts = unique_prompts
+        self.batch_size = batch_size
+        self.job_timeout = job_timeout
+        self.clients = clients
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=256))
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.failures = {}
+        self.cancelled = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def prompt(self, index):
+        # Unique prompts defeat the result cache, so every request reaches ComfyUI
+        if self.unique_prompts:
+            return f"benchmark building {index} {random.random():.6f}"
+        return "benchmark building"
+
+    def headers(self, index, content_type="application/json"):
+        # Spread requests over several client ids so per-client admission limits don't throttle the run
+        return {"Content-Type": content_type, "X-Client-Id": f"load-test-{index % self.clients}"}
+
+    def run_one(self, index):
+        started = time.perf_counter()
+        try:
+            sent, received = getattr(self, "send_" + self.endpoint.replace("-", "_"))(index)
+        except JobCancelled:
+            with self.lock:
+                self.cancelled += 1
+            return
+        except Exception as e:
+            with self.lock:
+                key = type(e).__name__ if not str(e) else str(e)[:80]
+                self.failures[key] = self.failures.get(key, 0) + 1
+            return
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def check(self, response):
+        if response.status_code >= 400:
+            raise Exception(f"HTTP {response.status_code}: {response.text[:60]}")
+        return len(response.content)
+
+    def send_process_base64(self, index):
+        body = json.dumps({"image": "data:image/png;base64," + self.image_base64, "prompt": self.prompt(index)})
+        response = self.session.post(f"{self.base_url}/api/process-base64", data=body,
+                                     headers=self.headers(index), timeout=self.job_timeout)
+        return len(body), self.check(response)
+
+    def send_process(self, index):
+        response = self.session.post(f"{self.base_url}/api/process", params={"prompt": self.prompt(index)},
+                                     data=self.image_data, headers=self.headers(index, "image/png"),
+                                     timeout=self.job_timeout)
+        return len(self.image_data), self.check(response)
+
+    def send_batch(self, index):
+        prompts = [f"{self.prompt(index)} v{variant}" for variant in range(self.batch_size)]
+        body = json.dumps({"image": self.image_base64, "prompts": prompts})
+        response = self.session.post(f"{self.base_url}/api/batch", data=body,
+                                     headers=self.headers(index), timeout=self.job_timeout)
+        return len(body), self.check(response)
+
+    def send_jobs(self, index):
+        """Submit, follow the job until it's done, then fetch the binary image"""
+        body = json.dumps({"image": self.image_base64, "prompt": self.prompt(index)})
+        response = self.session.post(f"{self.base_url}/api/jobs", data=body,
+                                     headers=self.headers(index), timeout=30)
+        received = self.check(response)
+        job_id = response.json()["job_id"]
+        deadline = time.time() + self.job_timeout
+        delay = 0.05
+        while time.time() < deadline:
+            status = self.session.get(f"{self.base_url}/api/jobs/{job_id}", timeout=30)
+            received += self.check(status)
+            state = status.json()["status"]
+            if state == "completed":
+                image = self.session.get(f"{self.base_url}/api/jobs/{job_id}/image", timeout=30)
+                return len(body), received + self.check(image)
+            if state == "failed":
+                error = status.json().get("error") or {}
+                raise Exception(error.get("details") or error.get("error") or "job failed")
+            if state == "cancelled":
+                raise JobCancelled(status.json().get("cancel_reason") or "job cancelled")
+            time.sleep(delay)
+            delay = min(delay * 1.5, 1.0)
+        raise Exception("job timed out")
+
+def start_processes(args):
+    """Launch the mock ComfyUI(s) and the backend, returns (processes, backend pid, mock urls)"""
+    processes = []
+    mock_urls = []
+    for index in range(args.mocks):
+        port = args.mock_port + index
+        command = [sys.executable, os.path.join(BENCHMARK_DIR, "mock_comfyui.py"), "--port", str(port),
+                   "--latency", str(args.latency), "--jitter", str(args.jitter), "--workers", str(args.mock_workers),
+                   "--output-size", str(args.output_size), "--fail-rate", str(args.fail_rate),
+                   "--http-error-rate", str(args.http_error_rate)]
+        processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        mock_urls.append(f"http://127.0.0.1:{port}")
+    for url in mock_urls:
+        if not wait_for(f"{url}/system_stats"):
+            raise SystemExit(f"Mock ComfyUI at {url} did not start")
+
+    env = dict(os.environ, COMFY_UI_URLS=",".join(mock_urls))
+    backend_log = open(args.backend_log, "w") if args.backend_log else subprocess.DEVNULL
+    if args.serving_mode == "asyncio":
+        command = [sys.executable, "comfy_service_async.py", "--host", "127.0.0.1", "--port", str(args.port)]
+    else:
+        command = [sys.executable, "-c", BACKEND_BOOT, str(args.port)]
+    backend = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=backend_log, stderr=subprocess.STDOUT)
+    processes.append(backend)
+    if not wait_for(f"http://127.0.0.1:{args.port}/api/test"):
+        raise SystemExit("Backend did not start (run with --backend-log to see why)")
+    return processes, backend.pid, mock_urls
+
+def mock_stats(mock_urls):
+    totals = {}
+    for url in mock_urls:
+        try:
+            stats = requests.get(f"{url}/mock/stats", timeout=5).json()
+        except requests.RequestException:
+            continue
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+def report(args, driver, wall_time, rss_kb, comfy_stats):
+    completed = len(driver.latencies)
+    failed = sum(driver.failures.values())
+    results = {
+        "endpoint": args.endpoint,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "completed": completed,
+        "failed": failed,
+        "cancelled": driver.cancelled,
+        "failures": driver.failures,
+        "wall_seconds": round(wall_time, 3),
+        "throughput_rps": round(completed / wall_time, 3) if wall_time else None,
+        "latency_p50": percentile(driver.latencies, 0.50),
+        "latency_p95": percentile(driver.latencies, 0.95),
+        "latency_p99": percentile(driver.latencies, 0.99),
+        "latency_max": max(driver.latencies) if driver.latencies else None,
+        "backend_peak_rss_mb": round(rss_kb / 1024, 1) if rss_kb else None,
+        "client_bytes_per_job": round((driver.bytes_sent + driver.bytes_received) / completed) if completed else None,
+        "comfyui_bytes_per_job": (round((comfy_stats.get("bytes_in", 0) + comfy_stats.get("bytes_out", 0)) / completed)
+                                  if completed and comfy_stats else None),
+        "comfyui_view_requests_per_job": (round(comfy_stats.get("view_requests", 0) / completed, 2)
+                                          if completed and comfy_stats else None),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return results
+
+    def seconds(value):
+        return f"{value * 1000:.0f} ms" if value is not None else "n/a"
+    print("=" * 60)
+    print(f"📊 {args.endpoint} x{args.requests} at concurrency {args.concurrency}")
+    print("=" * 60)
+    print(f"Completed:        {completed} ok, {failed} failed, {driver.cancelled} cancelled")
+    for reason, count in driver.failures.items():
+        print(f"   {count:4d} x {reason}")
+    print(f"Throughput:       {results['throughput_rps']} jobs/s over {results['wall_seconds']}s")
+    print(f"Latency:          p50 {seconds(results['latency_p50'])}, p95 {seconds(results['latency_p95'])}, "
+          f"p99 {seconds(results['latency_p99'])}, max {seconds(results['latency_max'])}")
+    print(f"Backend peak RSS: {results['backend_peak_rss_mb']} MB")
+    print(f"Bytes per job:    client {results['client_bytes_per_job']}, ComfyUI {results['comfyui_bytes_per_job']} "
+          f"({results['comfyui_view_requests_per_job']} /view requests)")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the isOGen backend against a mock ComfyUI")
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="process-base64")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=2, help="Requests sent (and ignored) before measuring")
+    parser.add_argument("--url", help="Benchmark an already running backend instead of starting one")
+    parser.add_argument("--port", type=int, default=5055, help="Port for the spawned backend")
+    parser.add_argument("--serving-mode", choices=("threaded", "asyncio"), default="threaded",
+                        help="Spawn the Flask app or comfy_service_async (process-base64 only)")
+    parser.add_argument("--backend-log", help="File to write the spawned backend's output to")
+    parser.add_argument("--mocks", type=int, default=1, help="Mock ComfyUI instances (the backend pools them)")
+    parser.add_argument("--mock-port", type=int, default=8288)
+    parser.add_argument("--mock-workers", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--output-size", type=int, default=512)
+    parser.add_argument("--input-size", type=int, default=512)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=4, help="Variants per /api/batch request")
+    parser.add_argument("--clients", type=int, help="Distinct X-Client-Id values to spread requests over "
+                        "(default: one per concurrent request)")
+    parser.add_argument("--repeat-prompts", action="store_true", help="Reuse one prompt so the result cache can hit")
+    parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+    if args.serving_mode == "asyncio" and args.endpoint != "process-base64":
+        parser.error("the asyncio serving mode only serves --endpoint process-base64")
+
+    processes = []
+    backend_pid = None
+    mock_urls = []
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            processes, backend_pid, mock_urls = start_processes(args)
+            base_url = f"http://127.0.0.1:{args.port}"
+
+        driver = Driver(base_url, args.endpoint, make_input_png(args.input_size), not args.repeat_prompts,
+                        args.batch_size, args.timeout, args.clients or args.concurrency)
+        for index in range(args.warmup):
+            driver.run_one(-1 - index)
+        driver.latencies.clear()
+        driver.failures.clear()
+        driver.bytes_sent = driver.bytes_received = 0
+        baseline = mock_stats(mock_urls)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(driver.run_one, range(args.requests)))
+        wall_time = time.perf_counter() - started
+
+        comfy_stats = {key: value - baseline.get(key, 0) for key, value in mock_stats(mock_urls).items()}
+        report(args, driver, wall_time, peak_rss_kb(backend_pid) if backend_pid else None, comfy_stats)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+if __name__ == "__main__":
+    main()
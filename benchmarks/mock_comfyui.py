@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Stand-in ComfyUI server for benchmarking the backend without a GPU
+Speaks /prompt, /queue, /history, /view, /upload/image, /object_info,
+/system_stats and the /ws event protocol (including binary previews)
+
+    python benchmarks/mock_comfyui.py --port 8188 --latency 2 --output-size 1024
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OUTPUT_CLASS_TYPES = ("Image Save", "SaveImage", "PreviewImage")
+REFERENCE_STEPS = 15  # Sampler steps --latency is quoted for (the shipped workflow's)
+MODEL_LISTS = {
+    "VAELoader": {"vae_name": [["ae.safetensors"]]},
+    "DualCLIPLoader": {
+        "clip_name1": [["t5xxl_fp8_e4m3fn.safetensors", "clip_l.safetensors"]],
+        "clip_name2": [["t5xxl_fp8_e4m3fn.safetensors", "clip_l.safetensors"]]
+    },
+    "UNETLoader": {"unet_name": [["flux1CannyDevFp8_v10.safetensors"]]},
+    "Load Lora": {"lora_name": [["isometric_bld_000001500.safetensors"]]}
+}
+
+def make_png(side):
+    """Random-noise PNG, so the size doesn't collapse under compression"""
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+def make_jpeg(side):
+    buffer = io.BytesIO()
+    Image.new("RGB", (side, side), (40, 160, 90)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def ws_frame(payload, binary=False):
+    """Encode one unmasked server -> client WebSocket frame"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    opcode = 0x82 if binary else 0x81
+    length = len(payload)
+    if length < 126:
+        header = struct.pack(">BB", opcode, length)
+    elif length < 65536:
+        header = struct.pack(">BBH", opcode, 126, length)
+    else:
+        header = struct.pack(">BBQ", opcode, 127, length)
+    return header + payload
+
+class MockComfyUI:
+    """Queue, history and socket registry shared by the HTTP handler and the executor threads"""
+    def __init__(self, latency=1.0, jitter=0.0, output_size=512, workers=1, fail_rate=0.0,
+                 http_error_rate=0.0, previews=True, steps=4, cold_start=0.0, unload_after=0.0):
+        self.latency = latency
+        self.cold_start = cold_start
+        self.unload_after = unload_after
+        self.models_used_at = None  # None until a prompt has "loaded" the models
+        self.jitter = jitter
+        self.workers = workers
+        self.fail_rate = fail_rate
+        self.http_error_rate = http_error_rate
+        self.previews = previews
+        self.steps = steps
+        self.output_png = make_png(output_size)
+        self.preview_jpeg = make_jpeg(256)
+        self.lock = threading.Lock()
+        self.pending = []  # [number, prompt_id, prompt, client_id]
+        self.running = {}  # prompt_id -> entry
+        self.history = {}
+        self.sockets = {}  # client_id -> (socket, send lock)
+        self.interrupted = set()
+        self.node_signatures = {}  # node id -> input signature of its last run, like ComfyUI's classic cache
+        self.next_number = 0
+        self.work = threading.Condition(self.lock)
+        self.stats = {"prompts": 0, "completed": 0, "failed": 0, "uploads": 0, "bytes_in": 0, "bytes_out": 0,
+                      "view_requests": 0, "http_errors": 0, "nodes_cached": 0, "nodes_executed": 0, "cold_starts": 0}
+
+    def start(self):
+        for index in range(self.workers):
+            threading.Thread(target=self._execute_loop, name=f"mock-exec-{index}", daemon=True).start()
+        return self
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def queue_prompt(self, prompt, prompt_id, client_id):
+        with self.work:
+            number = self.next_number
+            self.next_number += 1
+            self.pending.append([number, prompt_id, prompt, client_id])
+            self.stats["prompts"] += 1
+            self.work.notify()
+        return number
+
+    def send(self, client_id, payload, binary=False):
+        with self.lock:
+            entry = self.sockets.get(client_id)
+        if entry is None:
+            return
+        sock, send_lock = entry
+        frame = ws_frame(payload, binary)
+        try:
+            with send_lock:
+                sock.sendall(frame)
+            self.count("bytes_out", len(frame))
+        except OSError:
+            pass
+
+    def event(self, client_id, event_type, data):
+        self.send(client_id, json.dumps({"type": event_type, "data": data}))
+
+    def _execute_loop(self):
+        while True:
+            with self.work:
+                while not self.pending:
+                    self.work.wait()
+                number, prompt_id, prompt, client_id = self.pending.pop(0)
+                self.running[prompt_id] = [number, prompt_id, {}, {}, []]
+            try:
+                self._execute(prompt_id, prompt, client_id)
+            finally:
+                with self.lock:
+                    self.running.pop(prompt_id, None)
+                    self.models_used_at = time.time()
+
+    def _cached_nodes(self, prompt):
+        """Nodes whose inputs (recursively) match their previous run, which ComfyUI would not execute again"""
+        signatures = {}
+
+        def signature(node_id):
+            if node_id not in signatures:
+                node = prompt.get(node_id, {})
+                inputs = {name: signature(value[0]) if isinstance(value, list) and len(value) == 2 and value[0] in prompt
+                          else value for name, value in node.get("inputs", {}).items()}
+                material = json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str)
+                signatures[node_id] = hashlib.sha1(material.encode()).hexdigest()
+            return signatures[node_id]
+
+        with self.lock:
+            cached = [node_id for node_id in prompt if self.node_signatures.get(node_id) == signature(node_id)]
+            self.node_signatures.update((node_id, signature(node_id)) for node_id in prompt)
+        return cached
+
+    def _execute(self, prompt_id, prompt, client_id):
+        started = time.time()
+        self.event(client_id, "execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)})
+        cached = self._cached_nodes(prompt)
+        with self.lock:
+            cold = self.models_used_at is None or (self.unload_after and started - self.models_used_at > self.unload_after)
+            self.models_used_at = float("inf")  # Loaded and in use until this prompt finishes
+        if cold and self.cold_start:
+            # Loading the UNet, text encoders, VAE and LoRA from disk
+            time.sleep(self.cold_start)
+            self.count("cold_starts")
+        self.event(client_id, "execution_cached", {"nodes": cached, "prompt_id": prompt_id,
+                                                   "timestamp": int(time.time() * 1000)})
+        self.count("nodes_cached", len(cached))
+        self.count("nodes_executed", len(prompt) - len(cached))
+        duration = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        node_ids = list(prompt)
+        sampler = next((node_id for node_id, node in prompt.items() if "Sampler" in node.get("class_type", "")),
+                       node_ids[0] if node_ids else None)
+        # Sampling time scales with the requested steps, so draft profiles run faster here too
+        steps = prompt.get(sampler, {}).get("inputs", {}).get("steps") if sampler else None
+        if isinstance(steps, int) and steps > 0:
+            duration *= steps / REFERENCE_STEPS
+        if sampler in cached:
+            duration = 0.0
+        for node_id in node_ids:
+            if node_id != sampler and node_id not in cached:
+                self.event(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+
+        self.event(client_id, "executing", {"node": sampler, "display_node": sampler, "prompt_id": prompt_id})
+        for step in range(1, self.steps + 1):
+            time.sleep(duration / self.steps)
+            if prompt_id in self.interrupted:
+                self.interrupted.discard(prompt_id)
+                self.event(client_id, "execution_interrupted", {"prompt_id": prompt_id, "node_id": sampler})
+                self._record(prompt_id, prompt, {}, "error", [["execution_interrupted", {"prompt_id": prompt_id}]])
+                return
+            self.event(client_id, "progress", {"value": step, "max": self.steps, "prompt_id": prompt_id, "node": sampler})
+            if self.previews:
+                self.send(client_id, struct.pack(">II", 1, 2) + self.preview_jpeg, binary=True)
+
+        if random.random() < self.fail_rate:
+            error = {"prompt_id": prompt_id, "node_id": sampler, "node_type": "KSamplerAdvanced",
+                     "exception_type": "RuntimeError", "exception_message": "injected failure", "traceback": []}
+            self.event(client_id, "execution_error", error)
+            self._record(prompt_id, prompt, {}, "error", [["execution_error", error]])
+            self.count("failed")
+            return
+
+        outputs = {}
+        for node_id, node in prompt.items():
+            if node.get("class_type") in OUTPUT_CLASS_TYPES:
+                folder = "temp" if node["class_type"] == "PreviewImage" else "output"
+                outputs[node_id] = {"images": [{"filename": f"mock_{prompt_id}_{node_id}.png", "subfolder": "", "type": folder}]}
+                self.event(client_id, "executed", {"node": node_id, "display_node": node_id,
+                                                   "output": outputs[node_id], "prompt_id": prompt_id})
+        self._record(prompt_id, prompt, outputs, "success", [["execution_success", {"prompt_id": prompt_id}]])
+        self.event(client_id, "execution_success", {"prompt_id": prompt_id})
+        self.event(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+        self.count("completed")
+
+    def _record(self, prompt_id, prompt, outputs, status, messages):
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {}, list(outputs)],
+                "outputs": outputs,
+                "status": {"status_str": status, "completed": status == "success", "messages": messages}
+            }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type="application/json", status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.mock.count("bytes_out", len(body))
+
+    def send_json(self, payload, status=200):
+        self.send_body(json.dumps(payload).encode(), status=status)
+
+    def injected_error(self):
+        if self.mock.http_error_rate and random.random() < self.mock.http_error_rate:
+            self.mock.count("http_errors")
+            self.send_json({"error": "injected failure"}, status=500)
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        mock = self.mock
+        if url.path == "/ws":
+            return self.serve_websocket(query.get("clientId", [str(uuid.uuid4())])[0])
+        if url.path == "/mock/stats":
+            with mock.lock:
+                stats = dict(mock.stats, pending=len(mock.pending), running=len(mock.running))
+            return self.send_json(stats)
+        if self.injected_error():
+            return
+
+        if url.path == "/system_stats":
+            return self.send_json({"system": {"os": "mock", "comfyui_version": "mock"}, "devices": []})
+        if url.path == "/object_info":
+            return self.send_json({name: {"input": {"required": inputs}} for name, inputs in MODEL_LISTS.items()})
+        if url.path == "/queue":
+            with mock.lock:
+                running = list(mock.running.values())
+                pending = [[number, prompt_id, {}, {}, []] for number, prompt_id, _, _ in mock.pending]
+            return self.send_json({"queue_running": running, "queue_pending": pending})
+        if url.path == "/history":
+            with mock.lock:
+                history = dict(mock.history)
+            return self.send_json(history)
+        if url.path.startswith("/history/"):
+            prompt_id = url.path.rsplit("/", 1)[-1]
+            with mock.lock:
+                entry = mock.history.get(prompt_id)
+            return self.send_json({prompt_id: entry} if entry else {})
+        if url.path == "/view":
+            mock.count("view_requests")
+            return self.send_body(mock.output_png, "image/png")
+        self.send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        mock = self.mock
+        mock.count("bytes_in", len(body))
+        if self.injected_error():
+            return
+
+        if url.path == "/prompt":
+            data = json.loads(body)
+            prompt_id = data.get("prompt_id") or str(uuid.uuid4())
+            number = mock.queue_prompt(data["prompt"], prompt_id, data.get("client_id"))
+            return self.send_json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+        if url.path == "/upload/image":
+            match = re.search(rb'filename="([^"]+)"', body)
+            mock.count("uploads")
+            return self.send_json({"name": match.group(1).decode() if match else "upload.png", "subfolder": "", "type": "input"})
+        if url.path == "/queue":
+            delete = set(json.loads(body or b"{}").get("delete", []))
+            with mock.lock:
+                mock.pending = [item for item in mock.pending if item[1] not in delete]
+            return self.send_json({})
+        if url.path == "/interrupt":
+            with mock.lock:
+                mock.interrupted.update(mock.running)
+            return self.send_json({})
+        self.send_json({"error": "not found"}, status=404)
+
+    def serve_websocket(self, client_id):
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WS_MAGIC).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        with self.mock.lock:
+            self.mock.sockets[client_id] = (self.connection, threading.Lock())
+        self.mock.event(client_id, "status", {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id})
+        try:
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                length = header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack(">H", self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", self.rfile.read(8))[0]
+                if header[1] & 0x80:
+                    self.rfile.read(4)  # Client frames are masked, the payload is never inspected
+                self.rfile.read(length)
+                opcode = header[0] & 0x0F
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self.mock.send(client_id, b"", binary=True)
+        finally:
+            with self.mock.lock:
+                if self.mock.sockets.get(client_id, (None,))[0] is self.connection:
+                    del self.mock.sockets[client_id]
+            self.close_connection = True
+
+def serve(port=8188, host="127.0.0.1", **options):
+    """Run a mock ComfyUI until interrupted"""
+    mock = MockComfyUI(**options).start()
+    handler = type("BoundMockHandler", (MockHandler,), {"mock": mock})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"🧪 Mock ComfyUI on http://{host}:{port} (latency {options.get('latency', 1.0)}s, "
+          f"{len(mock.output_png)} byte outputs)", flush=True)
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock ComfyUI server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds of simulated sampling per prompt at 15 sampler steps")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- seconds added to the latency")
+    parser.add_argument("--workers", type=int, default=1, help="Prompts executed concurrently (1 = one GPU)")
+    parser.add_argument("--output-size", type=int, default=512, help="Side of the generated output PNG in pixels")
+    parser.add_argument("--steps", type=int, default=4, help="Progress events (and previews) per prompt")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of prompts ending in execution_error")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="Fraction of HTTP requests answered with 500")
+    parser.add_argument("--no-previews", action="store_true", help="Don't send binary preview frames")
+    parser.add_argument("--cold-start", type=float, default=0.0,
+                        help="Extra seconds for the first prompt, as if the models were loaded from disk")
+    parser.add_argument("--unload-after", type=float, default=0.0,
+                        help="Idle seconds after which models count as unloaded again (0 = never)")
+    args = parser.parse_args()
+    serve(port=args.port, host=args.host, latency=args.latency, jitter=args.jitter, workers=args.workers,
+          output_size=args.output_size, steps=args.steps, fail_rate=args.fail_rate,
+          http_error_rate=args.http_error_rate, previews=not args.no_previews, cold_start=args.cold_start,
+          unload_after=args.unload_after)
+
+if __name__ == "__main__":
+    main()
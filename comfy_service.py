@@ -8,638 +8,3737 @@ import os
 import json
 import base64
 import requests
+from requests.adapters import HTTPAdapter
 import uuid
+import hashlib
+import math
 import time
-import shutil
+import random
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, send_file
 from flask_cors import CORS
 import traceback
+import logging
 from urllib.parse import quote
 import websocket
 import threading
-from PIL import Image
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from PIL import Image, ImageOps
 import io
+import queue
+import select
+import socket
+import struct
 
 app = Flask(__name__)
 CORS(app)
-
-USER_COMFY_PATH = r"D:\RECURSOS\PROGRAMS\ComfyUI\ComfyUI\input"
+logger = logging.getLogger("isogen")
 
 # Configuration
 COMFY_UI_URL = "http://localhost:8188"
-UPLOAD_DIR = "uploads"
+COMFY_SERVER_ADDRESS = COMFY_UI_URL.split("://", 1)[-1]
+# Comma-separated ComfyUI instances to spread jobs over, e.g. one per GPU
+COMFY_UI_URLS = [url.strip() for url in os.environ.get("COMFY_UI_URLS", COMFY_UI_URL).split(",") if url.strip()]
 OUTPUT_DIR = "outputs"
 WORKFLOW_FILE = "image_to_image_flux.json"
+DEFAULT_PROMPT = "modern architectural building, clean lines"
+
+# Input staging
+STAGED_INPUT_TTL = 600  # Seconds before an identical input is uploaded again
+STAGED_INPUT_CACHE_SIZE = 256
+SAVE_INPUTS_LOCALLY = True  # Keep a copy of inputs in the artifact store (written in the background)
+
+# Input normalization (before anything is queued or staged)
+INPUT_NORMALIZE = True  # Decode uploads once, reject bad ones and downscale to the size the workflow resizes to
+INPUT_MAX_PIXELS = 8192 * 8192  # Larger uploads are rejected before they are decoded
+INPUT_MIN_SIDE = 64
+INPUT_ENCODE_FORMAT = "png"  # "png" keeps staged inputs lossless, "jpg" or "webp" trade a little fidelity for size
+INPUT_ENCODE_QUALITY = 95  # For jpg/webp
+
+# Workflow parameter slots: name -> (node id, input name)
+WORKFLOW_SLOTS = {
+    "image": ("100", "image"),  # LoadImage
+    "positive_prompt": ("98", "text"),  # CLIPTextEncode
+    "seed": ("109", "noise_seed"),  # KSamplerAdvanced
+    "steps": ("109", "steps"),
+    "guidance": ("97", "guidance"),  # FluxGuidance
+    "resize_side": ("95", "smaller_side"),  # ImageResize
+}
+# Quality/latency profiles applied on top of the workflow; "final" is the workflow as authored
+WORKFLOW_PROFILES = {
+    "final": {},
+    "draft": {
+        "slots": {"steps": 6, "resize_side": 512},
+        "bypass": {"118": "image"},  # Skip the 2x ImageScaleBy, its consumers read its image input
+        "drop": ["106", "113", "115"],  # Canny save, image comparer and preview (debug outputs)
+        "preview_saves": True,  # Image Save -> PreviewImage, no 300 dpi PNG with embedded workflow on disk
+    },
+}
+WORKFLOW_DEFAULT_PROFILE = "final"
+WORKFLOW_DRAFT_PROFILE = "draft"  # Run first in progressive mode
+PROMPT_PREFIX = "ismtrcbldng, hyperrealistic photograph, white background, plain white background,  isometric view, architectural visualization, detailed building"
+
+# ComfyUI HTTP transport
+COMFY_HTTP_POOL_SIZE = 16  # Keep-alive connections per ComfyUI server
+COMFY_HTTP_CONNECT_TIMEOUT = 3.05
+COMFY_HTTP_READ_TIMEOUT = 30
+COMFY_HTTP_DOWNLOAD_TIMEOUT = 120  # Read timeout for /view image downloads
+COMFY_HTTP_RETRIES = 2  # Extra attempts for idempotent GETs
+COMFY_HTTP_BACKOFF = 0.5  # Base seconds for jittered retry backoff
+COMFY_BREAKER_FAILURES = 5  # Consecutive failures before failing fast
+COMFY_BREAKER_RESET = 15  # Seconds before a trial request is let through
+
+# ComfyUI WebSocket listener
+COMFY_WS_CONNECT_TIMEOUT = 5  # Seconds to wait for the shared socket before falling back to polling
+COMFY_WS_PING_INTERVAL = 30  # Ping the socket after this many idle seconds
+COMFY_WS_RECONNECT_DELAY = 1  # Initial reconnect backoff, doubles per failure
+COMFY_WS_RECONNECT_MAX_DELAY = 30
+COMFY_PROMPT_TIMEOUT = 300  # 5 minutes
+
+# Completion tracking without the WebSocket
+TRACKER_POLL_MIN = 0.25  # Seconds between /queue samples right after a change
+TRACKER_POLL_MAX = 5  # Backoff ceiling while nothing changes
+TRACKER_POLL_BACKOFF = 1.5
+TRACKER_LOST_AFTER = 15  # Seconds a prompt may be missing from both queue and history
+
+# ComfyUI capability cache
+CAPABILITY_TTL = 15  # Seconds between /system_stats probes
+CAPABILITY_RETRY_INTERVAL = 3  # Probe interval while ComfyUI is unreachable
+CAPABILITY_OBJECT_INFO_TTL = 300  # /object_info is several MB, refresh it rarely
+CAPABILITY_INITIAL_WAIT = 5  # Seconds the first caller waits for the initial probe
+
+# Models the workflow needs, checked against the loaders' input lists
+REQUIRED_MODELS = {
+    "VAELoader": ["ae.safetensors"],
+    "DualCLIPLoader": ["t5xxl_fp8_e4m3fn.safetensors", "clip_l.safetensors"],
+    "UNETLoader": ["flux1CannyDevFp8_v10.safetensors"],
+    "Load Lora": ["isometric_bld_000001500.safetensors"]
+}
+
+# Result cache
+DETERMINISTIC_SEEDS = False  # Derive the seed from input + prompt unless the request sets one
+RESULT_CACHE_DIR = os.path.join(OUTPUT_DIR, "cache")
+RESULT_CACHE_MEMORY_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_DISK_BYTES = 2 * 1024 * 1024 * 1024  # 0 disables the disk tier
+
+# Output retrieval
+OUTPUT_NODE_IDS = ["107", "118", "91"]  # Nodes holding the final image, best first
+OUTPUT_CLASS_TYPES = ["Image Save", "SaveImage"]  # Fallback when none of those produced an image
+OUTPUT_DOWNLOAD_WORKERS = 4  # Parallel /view downloads when several outputs are needed
+OUTPUT_DOWNLOAD_CHUNK = 256 * 1024
+
+# Artifact store
+ARTIFACT_DIR = os.path.join(OUTPUT_DIR, "artifacts")
+ARTIFACT_KINDS = ("input", "output")
+ARTIFACT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+ARTIFACT_MAX_AGE = 7 * 24 * 3600  # Seconds, 0 keeps artifacts until the size quota evicts them
+ARTIFACT_SWEEP_INTERVAL = 600  # Seconds between retention sweeps
+ARTIFACT_MIME_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+SAVE_OUTPUTS_LOCALLY = True
+
+# Output renditions (?format=, ?quality=, ?max_side= or ?size= on image and result endpoints)
+RENDITION_CACHE_DIR = os.path.join(ARTIFACT_DIR, "renditions")  # Transcoded variants, next to the originals
+RENDITION_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+RENDITION_CACHE_DISK_BYTES = 512 * 1024 * 1024  # 0 disables the disk tier
+RENDITION_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+RENDITION_DEFAULT_QUALITY = 85  # For webp/jpg, png is lossless
+RENDITION_MAX_SIDE = 4096
+RENDITION_PRESETS = {
+    "thumb": {"max_side": 256, "quality": 70},  # Grid and listing previews
+    "screen": {"max_side": 1600, "quality": 85}  # Comparison view
+}
+
+# Batch generation
+BATCH_MAX_VARIANTS = 8  # Variants per /api/batch request (each adds a sampler run)
+
+# Live progress (Server-Sent Events)
+SSE_KEEPALIVE_INTERVAL = 15  # Seconds between keep-alive comments on idle streams
+JOB_EVENT_BUFFER = 256  # Events buffered per subscriber before a slow client drops some
+PREVIEW_MAX_FPS = 2
+PREVIEW_MAX_SIDE = 384
+PREVIEW_JPEG_QUALITY = 70
+BINARY_EVENT_PREVIEW_IMAGE = 1  # ComfyUI binary WebSocket event types
+BINARY_EVENT_PREVIEW_IMAGE_WITH_METADATA = 4
+
+# Backend pool
+POOL_MONITOR_INTERVAL = 2  # Seconds between /queue samples per backend
+POOL_LATENCY_ALPHA = 0.3  # EWMA weight of the newest job duration
+POOL_DEFAULT_JOB_SECONDS = 30  # Assumed job duration before a backend has finished one
+POOL_EJECT_FAILURES = 3  # Consecutive failed jobs before a backend is taken out of rotation
+POOL_EJECT_SECONDS = 30
+POOL_MAX_IN_FLIGHT = 2  # Jobs we run on one ComfyUI instance at once
+POOL_SLOT_WAIT = 30  # Seconds a job waits for a free slot while every healthy backend is full
+POOL_WARMUP = True  # Run a tiny generation on each backend so models are loaded before the first real job
+POOL_WARMUP_PARAMS = {"steps": 1, "resize_side": 64}  # Slot values on top of the draft profile
+POOL_WARMUP_IMAGE_SIDE = 64
+POOL_WARMUP_RETRY = 30  # Seconds before a failed warm-up is tried again
+POOL_KEEPALIVE_INTERVAL = 0  # Seconds a backend may idle before a keep-alive generation stops ComfyUI unloading models, 0 disables
+POOL_AFFINITY_SLACK = 1  # Extra jobs' worth of wait accepted to reuse the backend that last ran the same input or prompt
+
+# Logging and metrics
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")  # DEBUG adds per-request and per-node detail
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # Seconds
+
+# Job processing
+JOB_WORKERS = POOL_MAX_IN_FLIGHT * len(COMFY_UI_URLS)  # Concurrent pipelines, one per backend slot
+JOB_QUEUE_LIMIT = 32  # Jobs allowed to wait for a free worker, beyond that submissions get 429
+JOB_RESULT_TTL = 3600  # Seconds a finished job stays retrievable
+JOB_HOUSEKEEPING_INTERVAL = 5  # Seconds between sweeps for expired and abandoned jobs
+JOB_ABANDON_AFTER = 30  # Seconds an unfinished job whose event streams all closed may go without a status poll before it is cancelled, 0 disables
+JOB_DISCONNECT_POLL = 1  # Seconds between client disconnect checks while a blocking request waits
+
+# Admission control
+ADMISSION_LANES = ("interactive", "bulk")  # Priority lanes, highest first
+ADMISSION_DEFAULT_LANE = "interactive"
+ADMISSION_BATCH_LANE = "bulk"  # Default lane for /api/batch
+ADMISSION_MAX_PER_CLIENT = 4  # Queued + running jobs per client before it gets 429
+ADMISSION_CLIENT_HEADER = "X-Client-Id"  # Falls back to the client_id field, then the remote address
+ADMISSION_AFFINITY_RUN = 4  # Jobs in a row that may jump the round-robin to share the previous job's input or prompt
+
+# Ensure directories exist
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s")
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format
+
+    Updates are a dict lookup under a lock; gauges that mirror other
+    components' state are read from collector callbacks at scrape time.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._collectors = []
+
+    def describe(self, name, metric_type, help_text):
+        self._meta[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_collector(self, collector):
+        """collector() returns [(name, labels dict, value)] for gauges described beforehand"""
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), (counts, total, count) in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append((f"{name}_bucket", labels + (("le", repr(float(bound))),), cumulative))
+                lines.append((f"{name}_bucket", labels + (("le", "+Inf"),), count))
+                lines.append((f"{name}_sum", labels, total))
+                lines.append((f"{name}_count", labels, count))
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    if value is not None:
+                        samples.setdefault(name, []).append((name, tuple(sorted(labels.items())), value))
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+        
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = self._meta.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            for sample_name, labels, value in samples[name]:
+                label_text = ",".join('{}="{}"'.format(key, str(val).replace("\\", "\\\\").replace('"', '\\"'))
+                                      for key, val in labels)
+                output.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+        return "\n".join(output) + "\n"
+
+metrics = Metrics()
+metrics.describe("isogen_stage_seconds", "histogram", "Time spent per pipeline stage")
+metrics.describe("isogen_job_seconds", "histogram", "End-to-end job duration from submission to finish")
+metrics.describe("isogen_jobs_total", "counter", "Finished jobs by outcome")
+metrics.describe("isogen_http_requests_total", "counter", "HTTP requests by endpoint and status")
+metrics.describe("isogen_http_request_seconds", "histogram", "HTTP request handling time by endpoint")
+metrics.describe("isogen_prompts_cancelled_total", "counter", "ComfyUI prompts we cancelled, by outcome")
+metrics.describe("isogen_comfyui_nodes_total", "counter",
+                 "Workflow nodes ComfyUI executed or answered from its node cache, by outcome")
+metrics.describe("isogen_input_bytes_total", "counter", "Input image bytes as received and as staged after normalization")
+metrics.describe("isogen_warmup_seconds", "histogram", "Warm-up and keep-alive generation time per backend")
+metrics.describe("isogen_jobs_merged_total", "counter", "Requests merged into an identical in-flight job")
+metrics.describe("isogen_affinity_routed_total", "counter",
+                 "Jobs routed to the backend that last ran the same input or prompt, by outcome")
+
+
+class ComfyUIUnavailableError(Exception):
+    """ComfyUI can't be reached, or the circuit breaker is failing fast"""
+    pass
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets a single trial call through after a cool-down"""
+    def __init__(self, failure_threshold=COMFY_BREAKER_FAILURES, reset_timeout=COMFY_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until the breaker will let a trial call through"""
+        with self._lock:
+            if self.state != "open":
+                return 0
+            return max(0, self.reset_timeout - (time.time() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("ComfyUI circuit closed")
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning("ComfyUI circuit opened after %d failures", self.failures)
+                self.state = "open"
+                self.opened_at = time.time()
+                self._trial_in_flight = False
+
+class ComfyUITransport:
+    """Pooled keep-alive HTTP access to one ComfyUI server with timeouts, retries and a circuit breaker"""
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.base_url = f"http://{server_address}"
+        self.breaker = CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=COMFY_HTTP_POOL_SIZE, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, timeout=None, retries=None, **kwargs):
+        """Send a request, retrying idempotent methods on connection errors and 5xx responses"""
+        if timeout is None:
+            timeout = (COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_READ_TIMEOUT)
+        if retries is None:
+            retries = COMFY_HTTP_RETRIES if method in ("GET", "HEAD") else 0
+        url = f"{self.base_url}{path}"
+        
+        attempt = 0
+        while True:
+            if not self.breaker.allow_request():
+                raise ComfyUIUnavailableError(
+                    f"ComfyUI at {self.server_address} is unavailable "
+                    f"(circuit open, retry in {self.breaker.retry_after():.0f}s)")
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.breaker.record_failure()
+                if attempt >= retries:
+                    raise ComfyUIUnavailableError(f"ComfyUI at {self.server_address} unreachable: {e}") from e
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt >= retries:
+                    return response
+                response.close()
+            
+            # Full jitter keeps retries from many threads from arriving in lockstep
+            time.sleep(random.uniform(0, COMFY_HTTP_BACKOFF * (2 ** attempt)))
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def get_transport(server_address=COMFY_SERVER_ADDRESS):
+    """Get the shared HTTP transport for a ComfyUI server"""
+    with _transports_lock:
+        transport = _transports.get(server_address)
+        if transport is None:
+            transport = ComfyUITransport(server_address)
+            _transports[server_address] = transport
+    return transport
+
+class ComfyUIExecutionError(Exception):
+    pass
+
+class ComfyUIClient:
+    def __init__(self, server_address=COMFY_SERVER_ADDRESS, client_id=None):
+        self.server_address = server_address
+        self.client_id = client_id or str(uuid.uuid4())
+        self.transport = get_transport(server_address)
+        
+    def queue_prompt(self, prompt, prompt_id=None):
+        """Queue a prompt for processing"""
+        p = {"prompt": prompt, "client_id": self.client_id}
+        if prompt_id:
+            # Lets us start watching for events before the prompt is queued
+            p["prompt_id"] = prompt_id
+        data = json.dumps(p).encode('utf-8')
+        req = self.transport.post("/prompt", data=data,
+                                  headers={'Content-Type': 'application/json'})
+        return req.json()
+
+    def get_image(self, filename, subfolder, folder_type):
+        """Get an image from ComfyUI, streamed into a buffer sized from Content-Length"""
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        url_values = "&".join([f"{k}={quote(str(v))}" for k, v in data.items()])
+        response = self.transport.get(f"/view?{url_values}", timeout=(COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_DOWNLOAD_TIMEOUT),
+                                      stream=True)
+        with response:
+            response.raise_for_status()
+            length = int(response.headers.get("Content-Length") or 0)
+            if length:
+                buffer = bytearray(length)
+                view = memoryview(buffer)
+                received = 0
+                for chunk in response.iter_content(OUTPUT_DOWNLOAD_CHUNK):
+                    view[received:received + len(chunk)] = chunk
+                    received += len(chunk)
+                if received != length:
+                    raise Exception(f"Truncated image download: {received} of {length} bytes")
+                return bytes(buffer)
+            return b"".join(response.iter_content(OUTPUT_DOWNLOAD_CHUNK))
+
+    def get_history(self, prompt_id):
+        """Get the history for a prompt"""
+        response = self.transport.get(f"/history/{prompt_id}")
+        return response.json()
+
+class PromptWatch:
+    """Execution state of one queued prompt, fed by the shared event listener"""
+    def __init__(self, prompt_id, on_event=None):
+        self.prompt_id = prompt_id
+        self.future = Future()
+        self.current_node = None
+        self.progress = None
+        self.queue_position = None
+        self.outputs = {}
+        # Called from the listener thread with (event_type, data), keep it cheap
+        self.on_event = on_event
+
+    @property
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        """Block until the prompt finished, raises ComfyUIExecutionError on failure"""
+        try:
+            return self.future.result(timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"Prompt {self.prompt_id} did not finish within {timeout}s")
+
+    def handle_event(self, event_type, data):
+        if event_type == 'executing':
+            self.current_node = data.get('node')
+            if self.current_node is not None:
+                logger.debug("Prompt %s executing node %s", self.prompt_id, self.current_node)
+        elif event_type == 'progress':
+            self.progress = (data.get('value'), data.get('max'))
+        elif event_type == 'executed':
+            self.outputs[str(data.get('node'))] = data.get('output')
+        elif event_type == 'queue_position':
+            self.queue_position = data['position']
+        
+        if self.on_event:
+            try:
+                self.on_event(event_type, data)
+            except Exception as e:
+                logger.warning("Error in prompt event handler: %s", e)
+
+    def finish(self, error=None):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(ComfyUIExecutionError(error))
+        else:
+            self.future.set_result(self.outputs)
+
+    def cancel(self, reason):
+        """Wake the waiter with JobCancelledError, e.g. after we deleted the prompt from the queue"""
+        if not self.future.done():
+            self.future.set_exception(JobCancelledError(details=reason))
+
+class ComfyUIEventListener:
+    """One long-lived ComfyUI WebSocket per backend, routing events to watches by prompt_id"""
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self._watches = {}
+        # Terminal events for prompts nobody is watching (yet), covers the
+        # window between queue_prompt returning and the watch being re-keyed
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._running_prompt = None
+        self._thread = None
+        self.nodes_cached = 0  # Nodes ComfyUI reported as reused from its cache (execution_cached)
+        self.nodes_executed = 0
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    @property
+    def running_prompt(self):
+        """Prompt ComfyUI is executing right now according to the socket, None if idle or unknown"""
+        return self._running_prompt if self.connected else None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"comfy-ws-{self.server_address}", daemon=True)
+                self._thread.start()
+        return self
+
+    def wait_connected(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def watch(self, prompt_id, on_event=None):
+        """Start routing events for prompt_id, returns its PromptWatch"""
+        watch = PromptWatch(prompt_id, on_event)
+        with self._lock:
+            self._watches[prompt_id] = watch
+            finished = self._finished.pop(prompt_id, None)
+        if finished is not None:
+            watch.finish(error=finished)
+        return watch
+
+    def rekey(self, watch, prompt_id):
+        """Move a watch to the prompt_id ComfyUI actually assigned"""
+        with self._lock:
+            self._watches.pop(watch.prompt_id, None)
+            watch.prompt_id = prompt_id
+            self._watches[prompt_id] = watch
+            finished = self._finished.pop(prompt_id, None)
+        if finished is not None:
+            watch.finish(error=finished)
+        return watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            if self._watches.get(watch.prompt_id) is watch:
+                del self._watches[watch.prompt_id]
+
+    def abandon(self, prompt_id, reason):
+        """Stop routing events for a cancelled prompt and wake whoever waits on it"""
+        with self._lock:
+            watch = self._watches.pop(prompt_id, None)
+        if watch:
+            watch.cancel(reason)
+
+    def _run(self):
+        ws_url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        delay = COMFY_WS_RECONNECT_DELAY
+        while True:
+            ws = websocket.WebSocket()
+            try:
+                ws.connect(ws_url, timeout=COMFY_WS_CONNECT_TIMEOUT)
+                ws.settimeout(COMFY_WS_PING_INTERVAL)
+                self._connected.set()
+                delay = COMFY_WS_RECONNECT_DELAY
+                logger.info("Connected to ComfyUI WebSocket (%s)", self.server_address)
+                # Completion events may have been missed while disconnected
+                threading.Thread(target=self._reconcile, daemon=True).start()
+                self._receive_loop(ws)
+            except Exception as e:
+                if self._connected.is_set():
+                    logger.error("WebSocket connection to %s lost: %s", self.server_address, e)
+                    # Re-probe right away so the pool stops routing here
+                    get_capabilities(self.server_address, wait=False).invalidate()
+            finally:
+                self._connected.clear()
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            time.sleep(delay)
+            delay = min(delay * 2, COMFY_WS_RECONNECT_MAX_DELAY)
+
+    def _receive_loop(self, ws):
+        while True:
+            try:
+                out = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                # Idle; make sure the connection is still alive
+                ws.ping()
+                continue
+            if isinstance(out, str):
+                self._dispatch(json.loads(out))
+            else:
+                self._dispatch_binary(out)
+
+    def _dispatch(self, message):
+        event_type = message.get('type')
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        
+        if event_type == 'execution_cached':
+            cached = len(data.get('nodes') or ())
+            self.nodes_cached += cached
+            metrics.inc("isogen_comfyui_nodes_total", cached, outcome="cached")
+        elif event_type == 'executing' and data.get('node') is not None:
+            self.nodes_executed += 1
+            metrics.inc("isogen_comfyui_nodes_total", outcome="executed")
+        
+        if event_type == 'execution_start' or (event_type == 'executing' and data.get('node') is not None):
+            self._running_prompt = prompt_id
+        elif event_type == 'progress' and not prompt_id:
+            # Older ComfyUI versions don't tag progress events
+            prompt_id = self._running_prompt
+        if not prompt_id:
+            return
+        
+        error = None
+        finished = False
+        if event_type == 'executing' and data.get('node') is None:
+            finished = True
+        elif event_type == 'execution_success':
+            finished = True
+        elif event_type in ('execution_error', 'execution_interrupted'):
+            finished = True
+            error = data.get('exception_message') or event_type.replace('_', ' ')
+            if data.get('node_id'):
+                error = f"{error} (node {data['node_id']})"
+        
+        with self._lock:
+            watch = self._watches.get(prompt_id)
+            if finished:
+                if watch:
+                    del self._watches[prompt_id]
+                else:
+                    self._remember_finished(prompt_id, error)
+                if self._running_prompt == prompt_id:
+                    self._running_prompt = None
+        
+        if watch:
+            watch.handle_event(event_type, data)
+            if finished:
+                watch.finish(error=error)
+
+    def _dispatch_binary(self, message):
+        """Route sampler preview frames to the prompt they belong to"""
+        if len(message) < 8:
+            return
+        event_type = struct.unpack(">I", message[:4])[0]
+        prompt_id = self._running_prompt
+        if event_type == BINARY_EVENT_PREVIEW_IMAGE:
+            # 4 byte event type, 4 byte image format, then the encoded image
+            image_data = message[8:]
+        elif event_type == BINARY_EVENT_PREVIEW_IMAGE_WITH_METADATA:
+            metadata_length = struct.unpack(">I", message[4:8])[0]
+            try:
+                metadata = json.loads(message[8:8 + metadata_length])
+            except ValueError:
+                return
+            prompt_id = metadata.get('prompt_id') or prompt_id
+            image_data = message[8 + metadata_length:]
+        else:
+            return
+        
+        with self._lock:
+            watch = self._watches.get(prompt_id)
+        if watch:
+            watch.handle_event('preview', image_data)
+
+    def _remember_finished(self, prompt_id, error):
+        self._finished[prompt_id] = error
+        while len(self._finished) > 256:
+            self._finished.popitem(last=False)
+
+    def _reconcile(self):
+        with self._lock:
+            watches = list(self._watches.values())
+        if not watches:
+            return
+        client = ComfyUIClient(self.server_address, client_id=self.client_id)
+        for watch in watches:
+            try:
+                history = client.get_history(watch.prompt_id)
+            except Exception:
+                continue
+            entry = history.get(watch.prompt_id)
+            if not entry or not entry.get('status', {}).get('completed', True):
+                continue
+            self.unwatch(watch)
+            status = entry.get('status', {})
+            error = None
+            if status.get('status_str') == 'error':
+                error = "execution error (recovered from history)"
+            watch.finish(error=error)
+
+_event_listeners = {}
+_event_listeners_lock = threading.Lock()
+
+def get_event_listener(server_address=COMFY_SERVER_ADDRESS):
+    """Get the shared, already started event listener for a ComfyUI server"""
+    with _event_listeners_lock:
+        listener = _event_listeners.get(server_address)
+        if listener is None:
+            listener = ComfyUIEventListener(server_address).start()
+            _event_listeners[server_address] = listener
+    return listener
+
+class CompletionTracker:
+    """Follows specific prompt ids over HTTP when there is no WebSocket to listen on
+
+    One /queue request per tick covers every outstanding prompt and gives
+    its queue position; only prompts that left the queue get their own
+    /history/<id> lookup. The tick starts short and backs off while nothing
+    changes, so a prompt's latency depends on its own work, not on when the
+    whole queue drains.
+    """
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.transport = get_transport(server_address)
+        self._watches = {}
+        self._missing_since = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"comfy-tracker-{self.server_address}", daemon=True)
+                self._thread.start()
+        return self
+
+    def watch(self, prompt_id, on_event=None):
+        """Start tracking prompt_id, returns its PromptWatch"""
+        watch = PromptWatch(prompt_id, on_event)
+        with self._lock:
+            self._watches[prompt_id] = watch
+        self._wakeup.set()
+        return watch
+
+    def rekey(self, watch, prompt_id):
+        with self._lock:
+            if self._watches.get(watch.prompt_id) is watch:
+                del self._watches[watch.prompt_id]
+            watch.prompt_id = prompt_id
+            self._watches[prompt_id] = watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            if self._watches.get(watch.prompt_id) is watch:
+                del self._watches[watch.prompt_id]
+            self._missing_since.pop(watch.prompt_id, None)
+
+    def abandon(self, prompt_id, reason):
+        """Stop tracking a cancelled prompt and wake whoever waits on it"""
+        with self._lock:
+            watch = self._watches.pop(prompt_id, None)
+            self._missing_since.pop(prompt_id, None)
+        if watch:
+            watch.cancel(reason)
+
+    def _run(self):
+        interval = TRACKER_POLL_MIN
+        while True:
+            with self._lock:
+                watches = dict(self._watches)
+            if not watches:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                interval = TRACKER_POLL_MIN
+                continue
+            try:
+                changed = self._check(watches)
+            except Exception as e:
+                logger.warning("Error checking prompt status on %s: %s", self.server_address, e)
+                changed = False
+            interval = TRACKER_POLL_MIN if changed else min(interval * TRACKER_POLL_BACKOFF, TRACKER_POLL_MAX)
+            # New prompts cut the wait short
+            self._wakeup.wait(interval)
+            if self._wakeup.is_set():
+                self._wakeup.clear()
+                interval = TRACKER_POLL_MIN
+
+    def _check(self, watches):
+        """One /queue sample for all outstanding prompts, returns True if anything changed"""
+        response = self.transport.get("/queue")
+        if response.status_code != 200:
+            raise Exception(f"ComfyUI returned status: {response.status_code}")
+        changed, left = self._apply_queue(watches, response.json())
+        for watch in left:
+            history = self.transport.get(f"/history/{watch.prompt_id}").json()
+            if self._settle(watch, history.get(watch.prompt_id)):
+                changed = True
+        return changed
+
+    def _apply_queue(self, watches, queue_data):
+        """Update queue positions, returns (changed, watches whose prompt left the queue)"""
+        running = {item[1] for item in queue_data.get('queue_running', [])}
+        # Pending entries are [number, prompt_id, ...] and run in number order
+        pending = sorted(queue_data.get('queue_pending', []), key=lambda item: item[0])
+        positions = {item[1]: index + 1 for index, item in enumerate(pending)}
+        
+        changed = False
+        left = []
+        for prompt_id, watch in watches.items():
+            if prompt_id in running or prompt_id in positions:
+                self._missing_since.pop(prompt_id, None)
+                position = positions.get(prompt_id, 0)
+                if watch.queue_position != position:
+                    watch.handle_event('queue_position', {"prompt_id": prompt_id, "position": position})
+                    changed = True
+            else:
+                left.append(watch)
+        return changed, left
+
+    def _settle(self, watch, entry):
+        """Finish a prompt that left the queue from its history entry, returns True if it finished"""
+        if not entry:
+            # Not queued yet (we watch before queueing) or dropped from ComfyUI entirely
+            missing_since = self._missing_since.setdefault(watch.prompt_id, time.time())
+            if time.time() - missing_since < TRACKER_LOST_AFTER:
+                return False
+            self.unwatch(watch)
+            watch.finish(error=f"Prompt {watch.prompt_id} disappeared from the ComfyUI queue")
+            return True
+        
+        self.unwatch(watch)
+        status = entry.get('status', {})
+        if status.get('status_str') == 'error':
+            message = "execution error"
+            for event, data in status.get('messages', []):
+                if event == 'execution_error':
+                    message = f"{data.get('exception_type')}: {data.get('exception_message')} (node {data.get('node_id')})"
+            watch.finish(error=message)
+        else:
+            watch.outputs = entry.get('outputs', {})
+            watch.finish()
+        return True
+
+_completion_trackers = {}
+_completion_trackers_lock = threading.Lock()
+
+def get_completion_tracker(server_address=COMFY_SERVER_ADDRESS):
+    """Get the shared, already started completion tracker for a ComfyUI server"""
+    with _completion_trackers_lock:
+        tracker = _completion_trackers.get(server_address)
+        if tracker is None:
+            tracker = CompletionTracker(server_address).start()
+            _completion_trackers[server_address] = tracker
+    return tracker
+
+def submit_and_watch(listener, workflow_data, on_event=None):
+    """Queue a workflow under the listener's (or tracker's) client id, returns (prompt_id, watch)"""
+    client = ComfyUIClient(listener.server_address, client_id=listener.client_id)
+    # Watch before queueing so a fast completion event can't be missed
+    watch = listener.watch(str(uuid.uuid4()), on_event)
+    try:
+        queue_result = client.queue_prompt(workflow_data, prompt_id=watch.prompt_id)
+    except Exception:
+        listener.unwatch(watch)
+        raise
+    
+    prompt_id = queue_result.get('prompt_id') if isinstance(queue_result, dict) else None
+    if not prompt_id:
+        listener.unwatch(watch)
+        logger.error("Unexpected queue response format: %.200s", queue_result)
+        raise Exception(f"Cannot find prompt_id in response: {queue_result}")
+    if prompt_id != watch.prompt_id:
+        # Older ComfyUI versions ignore the requested prompt_id
+        listener.rekey(watch, prompt_id)
+    return prompt_id, watch
+
+def cancel_prompt(prompt_id, server_address, reason="cancelled"):
+    """Delete our prompt from ComfyUI's queue, or interrupt it if it is the one running
+
+    Returns "deleted", "interrupted" or None if ComfyUI couldn't be reached.
+    The delete is scoped to the prompt id, so it is always safe to send.
+    /interrupt is only sent while the event listener sees this very prompt
+    executing: ComfyUI builds that ignore its prompt_id would stop whatever
+    runs at that moment, so a /queue read followed by /interrupt could hit
+    another client's prompt. Whoever waits on the prompt is woken either
+    way, a deleted prompt never sends a completion event.
+    """
+    transport = get_transport(server_address)
+    with _event_listeners_lock:
+        listener = _event_listeners.get(server_address)
+    outcome = None
+    try:
+        transport.post("/queue", json={"delete": [prompt_id]})
+        outcome = "deleted"
+        if listener and listener.running_prompt == prompt_id:
+            transport.post("/interrupt", json={"prompt_id": prompt_id})
+            outcome = "interrupted"
+    except Exception as e:
+        logger.warning("Could not cancel prompt %s on %s: %s", prompt_id, server_address, e)
+    
+    for registry, lock in ((_event_listeners, _event_listeners_lock), (_completion_trackers, _completion_trackers_lock)):
+        with lock:
+            watcher = registry.get(server_address)
+        if watcher:
+            watcher.abandon(prompt_id, reason)
+    metrics.inc("isogen_prompts_cancelled_total", outcome=outcome or "unreachable")
+    logger.info("Cancelled prompt %s on %s (%s): %s", prompt_id, server_address, outcome or "unreachable", reason)
+    return outcome
+
+_output_downloader = ThreadPoolExecutor(max_workers=OUTPUT_DOWNLOAD_WORKERS, thread_name_prefix="comfy-download")
+
+def download_selected_images(client, selection):
+    """Fetch the image refs an output selector picked, in parallel when there are several
+
+    selection is a single image ref ({"filename", "subfolder", "type"}) or a
+    dict of them; the result has the same shape with bytes in place of refs.
+    """
+    if not selection:
+        return None
+    if "filename" in selection:
+        return client.get_image(selection['filename'], selection.get('subfolder', ''), selection.get('type', 'output'))
+    futures = {
+        key: _output_downloader.submit(client.get_image, ref['filename'], ref.get('subfolder', ''), ref.get('type', 'output'))
+        for key, ref in selection.items() if ref
+    }
+    return {key: futures[key].result() if key in futures else None for key in selection}
+
+def is_node_link(value):
+    """ComfyUI API graphs reference other nodes' outputs as [node_id, output_index]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+class WorkflowTemplate:
+    """Workflow graph parsed once and reloaded when the file changes on disk
+
+    Requests get their own graph from instantiate(): untouched nodes are
+    shared with the template (treat them as read-only), only the nodes
+    behind a parameter slot are copied and patched.
+    """
+    def __init__(self, path, slots=WORKFLOW_SLOTS, profiles=WORKFLOW_PROFILES):
+        self.path = path
+        self.slot_definitions = slots
+        self.profiles = profiles
+        self.graph = None
+        self.version = None
+        self.slots = {}
+        self._profile_graphs = {}
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        """Return the parsed graph, re-reading the file only if its mtime/size changed"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            logger.error("Workflow file not found: %s", self.path)
+            return self.graph
+        
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key != self._stat:
+            with self._lock:
+                if key != self._stat:
+                    self._load(key)
+        return self.graph
+
+    def _load(self, stat_key):
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            graph = json.loads(raw)
+        except Exception as e:
+            # Keep serving the last good graph if an edit left the file broken,
+            # and don't parse this version again until the file changes
+            logger.error("Error loading workflow: %s", e)
+            self._stat = stat_key
+            return
+        
+        slots = {}
+        for name, (node_id, input_name) in self.slot_definitions.items():
+            if node_id in graph and input_name in graph[node_id].get("inputs", {}):
+                slots[name] = (node_id, input_name)
+            else:
+                logger.warning("Slot %r (%s.%s) not found in workflow", name, node_id, input_name)
+        
+        # Publish the new graph in one go so readers never see a half-loaded template
+        self.graph, self.slots, self.version = graph, slots, hashlib.sha1(raw).hexdigest()[:12]
+        self._stat = stat_key
+        logger.info("Loaded workflow with %d nodes (version %s)", len(graph), self.version)
+
+    def defaults(self):
+        """Current template value of every resolved slot"""
+        graph = self.current()
+        return {name: graph[node_id]["inputs"][input_name]
+                for name, (node_id, input_name) in self.slots.items()}
+
+    def profile_graph(self, profile=None):
+        """The template graph with a quality profile applied, built once per workflow version"""
+        graph = self.current()
+        if graph is None or not profile:
+            return graph
+        # Keyed on the graph object too, a reload may land between current() and here
+        cached = self._profile_graphs.get(profile)
+        if cached is None or cached[0] is not graph:
+            cached = (graph, apply_workflow_profile(graph, self.profiles[profile], self.slots))
+            self._profile_graphs[profile] = cached
+        return cached[1]
+
+    def instantiate(self, profile=None, **params):
+        """Build a request graph with the given slot values, copying only the patched nodes"""
+        graph = self.profile_graph(profile)
+        if graph is None:
+            return None
+        
+        workflow = dict(graph)
+        for node_id, inputs in self._patches(params).items():
+            node = graph[node_id]
+            workflow[node_id] = {**node, "inputs": {**node["inputs"], **inputs}}
+        return workflow
+
+    def instantiate_variants(self, shared, variants, profile=None):
+        """Build one graph running several slot variants, sharing every node upstream of the varying slots
+
+        Returns (workflow, node_maps) where node_maps[i] maps template node ids
+        to the node ids variant i runs under.
+        """
+        workflow = self.instantiate(profile, **shared)
+        if workflow is None:
+            return None, None
+        
+        varying = {self.slots[name][0] for params in variants for name in params if name in self.slots}
+        
+        # Everything downstream of a varying node has to run once per variant
+        consumers = {}
+        for node_id, node in workflow.items():
+            for value in node["inputs"].values():
+                if is_node_link(value):
+                    consumers.setdefault(value[0], set()).add(node_id)
+        cloned = set()
+        stack = list(varying)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in cloned:
+                cloned.add(node_id)
+                stack.extend(consumers.get(node_id, ()))
+        
+        base_nodes = {node_id: workflow[node_id] for node_id in cloned}
+        node_maps = []
+        for index, params in enumerate(variants):
+            # The first variant keeps the original ids
+            node_map = {node_id: node_id if index == 0 else f"{node_id}_v{index}" for node_id in cloned}
+            patches = self._patches(params)
+            for node_id, node in base_nodes.items():
+                inputs = {}
+                for name, value in node["inputs"].items():
+                    if is_node_link(value) and value[0] in node_map:
+                        value = [node_map[value[0]], value[1]]
+                    inputs[name] = value
+                inputs.update(patches.get(node_id, {}))
+                workflow[node_map[node_id]] = {**node, "inputs": inputs}
+            node_maps.append(node_map)
+        return workflow, node_maps
+
+    def slot_value(self, name, profile=None):
+        """Value a slot has in the template (or under a profile), None if the slot isn't resolved"""
+        if self.current() is None or name not in self.slots:
+            return None
+        slots = self.profiles.get(profile, {}).get("slots", {}) if profile else {}
+        if name in slots:
+            return slots[name]
+        node_id, input_name = self.slots[name]
+        return self.graph[node_id]["inputs"][input_name]
+
+    def _patches(self, params):
+        """Group slot values into {node id: {input name: value}}"""
+        patches = {}
+        for name, value in params.items():
+            if value is None:
+                continue
+            if name not in self.slots:
+                logger.warning("Unknown or unresolved workflow slot: %s", name)
+                continue
+            node_id, input_name = self.slots[name]
+            patches.setdefault(node_id, {})[input_name] = value
+        return patches
+
+def apply_workflow_profile(graph, profile, slots):
+    """Return a copy of the graph with a WORKFLOW_PROFILES entry applied
+
+    Bypassed nodes are removed and their consumers rewired to the named
+    input; nodes left linking to a removed node are dropped as well.
+    """
+    workflow = dict(graph)
+    for node_id, input_name in profile.get("bypass", {}).items():
+        node = workflow.pop(node_id, None)
+        if node is None:
+            logger.warning("Profile bypasses unknown node %s", node_id)
+            continue
+        source = node["inputs"][input_name]
+        for consumer_id, consumer in list(workflow.items()):
+            if any(is_node_link(value) and value[0] == node_id for value in consumer["inputs"].values()):
+                workflow[consumer_id] = {**consumer, "inputs": {
+                    name: source if is_node_link(value) and value[0] == node_id else value
+                    for name, value in consumer["inputs"].items()}}
+    for node_id in profile.get("drop", ()):
+        workflow.pop(node_id, None)
+    
+    if profile.get("preview_saves"):
+        for node_id, node in list(workflow.items()):
+            if node.get("class_type") in OUTPUT_CLASS_TYPES:
+                workflow[node_id] = {"class_type": "PreviewImage", "inputs": {"images": node["inputs"]["images"]},
+                                     "_meta": {"title": "Preview Image"}}
+    
+    for name, value in profile.get("slots", {}).items():
+        if name not in slots:
+            logger.warning("Profile sets unknown or unresolved workflow slot: %s", name)
+            continue
+        node_id, input_name = slots[name]
+        if node_id in workflow:
+            workflow[node_id] = {**workflow[node_id], "inputs": {**workflow[node_id]["inputs"], input_name: value}}
+    
+    # Drop whatever still links to a removed node, the graph would not validate otherwise
+    while True:
+        dangling = [node_id for node_id, node in workflow.items()
+                    if any(is_node_link(value) and value[0] not in workflow for value in node["inputs"].values())]
+        if not dangling:
+            return workflow
+        for node_id in dangling:
+            del workflow[node_id]
+
+_workflow_template = WorkflowTemplate(WORKFLOW_FILE)
+
+def get_workflow_template():
+    return _workflow_template
+
+def load_workflow():
+    """Load the ComfyUI workflow from JSON file (cached, reloaded on change)"""
+    return get_workflow_template().current()
+
+def normalize_prompt(prompt_text):
+    """Collapse whitespace so prompts that differ only in spacing share CLIP, seed and cache entries"""
+    return " ".join(str(prompt_text).split())
+
+def enhance_prompt(prompt_text, original_prompt=""):
+    """Wrap the user prompt with the architectural keywords the LoRA was trained on"""
+    return f"{PROMPT_PREFIX}, {prompt_text}, {original_prompt}"
+
+def update_workflow_for_processing(template, image_filename, prompt_text, profile=None, **params):
+    """Instantiate the workflow template (under a quality profile) with new image, prompt and parameters"""
+    try:
+        defaults = template.defaults()
+        
+        # Enhance the prompt with architectural keywords
+        enhanced_prompt = enhance_prompt(prompt_text, defaults.get("positive_prompt", ""))
+        
+        # Generate random seed for variety
+        if params.get("seed") is None:
+            params["seed"] = random.randint(1, 2**32 - 1)
+        
+        updated_workflow = template.instantiate(profile, image=image_filename, positive_prompt=enhanced_prompt, **params)
+        if updated_workflow is None:
+            return None
+        
+        logger.debug("Updated workflow: image=%s seed=%s prompt=%.100s", image_filename, params['seed'], enhanced_prompt)
+        return updated_workflow
+        
+    except Exception as e:
+        logger.error("Error updating workflow: %s", e)
+        return None
+
+def find_missing_models(object_info, required_models=REQUIRED_MODELS):
+    """Compare required model files against the choices ComfyUI lists for each loader node"""
+    missing = []
+    for node_type, model_files in required_models.items():
+        if node_type not in object_info:
+            missing.append(f"Node type {node_type} not available")
+            continue
+        
+        # Loader inputs are declared as [[choice, ...], {options}]
+        available = set()
+        inputs = object_info[node_type].get("input", {})
+        for section in ("required", "optional"):
+            for spec in inputs.get(section, {}).values():
+                if isinstance(spec, list) and spec and isinstance(spec[0], list):
+                    # Models in subfolders are listed as "t5\\file.safetensors"
+                    available.update(os.path.basename(str(choice).replace("\\", "/")) for choice in spec[0])
+        
+        for model_file in model_files:
+            if model_file not in available:
+                missing.append(f"{model_file} ({node_type})")
+    return missing
+
+class CapabilityCache:
+    """Background-refreshed view of a ComfyUI server's health and installed models"""
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.transport = get_transport(server_address)
+        self.connected = False
+        self.system_stats = None
+        self.object_info = None
+        self.missing_models = None
+        self.error = None
+        self.checked_at = None
+        self.object_info_at = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._first_probe = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"comfy-caps-{self.server_address}", daemon=True)
+                self._thread.start()
+        return self
+
+    def invalidate(self):
+        """Forget the model listing and re-probe right away, e.g. after a failed job"""
+        with self._lock:
+            self.object_info_at = None
+        self._wakeup.set()
+
+    def wait_ready(self, timeout=None):
+        return self._first_probe.wait(timeout)
+
+    def refresh(self):
+        """Probe /system_stats, and /object_info when the cached copy is stale"""
+        try:
+            response = self.transport.get("/system_stats", retries=0)
+            if response.status_code != 200:
+                raise Exception(f"ComfyUI returned status: {response.status_code}")
+            system_stats = response.json()
+            
+            object_info = None
+            if self.object_info_stale():
+                response = self.transport.get("/object_info")
+                if response.status_code != 200:
+                    raise Exception("Could not get model info from ComfyUI")
+                object_info = response.json()
+        except Exception as e:
+            self.record_failure(e)
+            return False
+        
+        self.record_probe(system_stats, object_info)
+        return True
+
+    def object_info_stale(self):
+        with self._lock:
+            return (self.object_info_at is None or
+                    time.time() - self.object_info_at >= CAPABILITY_OBJECT_INFO_TTL)
+
+    def record_failure(self, e):
+        with self._lock:
+            if self.connected:
+                logger.error("ComfyUI capability probe of %s failed: %s", self.server_address, e)
+            self.connected = False
+            self.error = str(e)
+            self.object_info_at = None
+            self.checked_at = time.time()
+        self._first_probe.set()
+
+    def record_probe(self, system_stats, object_info=None):
+        """Store a successful probe; object_info is None when the cached listing is still fresh"""
+        with self._lock:
+            if not self.connected:
+                logger.info("ComfyUI %s connected - system: %s", self.server_address, system_stats.get('system', {}))
+            self.connected = True
+            self.system_stats = system_stats
+            self.error = None
+            if object_info is not None:
+                self.object_info = object_info
+                self.object_info_at = time.time()
+                self.missing_models = find_missing_models(object_info)
+                if self.missing_models:
+                    logger.warning("Missing models on %s: %s", self.server_address, ", ".join(self.missing_models))
+            self.checked_at = time.time()
+        self._first_probe.set()
+
+    def models_status(self):
+        """Returns (ok, message) from the last model check"""
+        with self._lock:
+            missing = self.missing_models
+        if missing is None:
+            return False, "Model info not loaded yet"
+        if missing:
+            return False, f"Missing components: {', '.join(missing)}"
+        return True, "All required models are available"
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "connected": self.connected,
+                "error": self.error,
+                "missing_models": self.missing_models,
+                "checked_at": datetime.fromtimestamp(self.checked_at).isoformat() if self.checked_at else None,
+                "object_info_age_seconds": round(time.time() - self.object_info_at, 1) if self.object_info_at else None
+            }
+
+    def _run(self):
+        while True:
+            ok = self.refresh()
+            self._wakeup.wait(CAPABILITY_TTL if ok else CAPABILITY_RETRY_INTERVAL)
+            self._wakeup.clear()
+
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+def get_capabilities(server_address=COMFY_SERVER_ADDRESS, wait=True):
+    """Get the shared, already started capability cache for a ComfyUI server"""
+    with _capabilities_lock:
+        capabilities = _capabilities.get(server_address)
+        if capabilities is None:
+            capabilities = CapabilityCache(server_address).start()
+            _capabilities[server_address] = capabilities
+    # Only the very first caller waits, later reads never touch the network
+    if wait:
+        capabilities.wait_ready(CAPABILITY_INITIAL_WAIT)
+    return capabilities
+
+def check_comfyui_connection():
+    """Check if any pooled ComfyUI instance is running and accessible (cached)"""
+    return get_backend_pool().any_available()
+
+def check_required_models():
+    """Check if required models are available on the pooled ComfyUI instances (cached)"""
+    return get_backend_pool().models_status()
+
+def affinity_overlap(a, b):
+    """How many of (input hash, prompt) two jobs share, 0 when either is unknown"""
+    if a is None or b is None:
+        return 0
+    return sum(1 for x, y in zip(a, b) if x == y)
+
+class ComfyUIBackend:
+    """One ComfyUI server in the pool with its load and health bookkeeping"""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.server_address = self.url.split("://", 1)[-1]
+        self.transport = get_transport(self.server_address)
+        self.capabilities = None
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.latency = None  # EWMA of seconds per job
+        self.failures = 0
+        self.ejected_until = 0
+        self.jobs_completed = 0
+        self.last_affinity = None  # (input hash, prompt) of the last job sent, what ComfyUI's node cache holds
+        self.last_used = time.time()
+        self.warm = False  # Models loaded by a warm-up since ComfyUI was last seen connected
+        self.warmed_at = None
+        self.warmup_error = None
+        self.warmup_retry_at = 0
+
+    @property
+    def ejected(self):
+        return time.time() < self.ejected_until
+
+    @property
+    def available(self):
+        return (not self.ejected and self.capabilities is not None and self.capabilities.connected
+                and self.transport.breaker.state != "open")
+
+    def expected_wait(self, default_latency):
+        """Rough seconds until a new job here would finish"""
+        # queue_depth is the last /queue sample (all clients), in_flight our live count
+        load = max(self.queue_depth, self.in_flight)
+        return (load + 1) * (self.latency or default_latency)
+
+    def snapshot(self):
+        return {
+            "url": self.url,
+            "available": self.available,
+            "connected": bool(self.capabilities and self.capabilities.connected),
+            "ejected": self.ejected,
+            "circuit": self.transport.breaker.state,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "latency_seconds": round(self.latency, 2) if self.latency else None,
+            "jobs_completed": self.jobs_completed,
+            "warm": self.warm,
+            "warmed_at": datetime.fromtimestamp(self.warmed_at).isoformat() if self.warmed_at else None,
+            "warmup_error": self.warmup_error,
+            "capabilities": self.capabilities.snapshot() if self.capabilities else None
+        }
+
+class BackendPool:
+    """Routes jobs to the ComfyUI server with the shortest expected wait
+
+    Load comes from periodic /queue samples plus our own in-flight count,
+    speed from an EWMA of recent job durations. Backends that keep failing
+    are ejected for a while and re-admitted once their probe succeeds.
+    """
+    def __init__(self, urls, max_in_flight=POOL_MAX_IN_FLIGHT, slot_wait=POOL_SLOT_WAIT):
+        self.backends = [ComfyUIBackend(url) for url in urls]
+        self.max_in_flight = max_in_flight
+        self.slot_wait = slot_wait
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                for backend in self.backends:
+                    backend.capabilities = get_capabilities(backend.server_address, wait=False)
+                    get_event_listener(backend.server_address)
+                # Probes run concurrently, so this waits for the slowest one at most once
+                for backend in self.backends:
+                    backend.capabilities.wait_ready(CAPABILITY_INITIAL_WAIT)
+                self._thread = threading.Thread(target=self._monitor, name="comfy-pool", daemon=True)
+                self._thread.start()
+                if POOL_WARMUP or POOL_KEEPALIVE_INTERVAL:
+                    threading.Thread(target=self._warm_up, name="comfy-warmup", daemon=True).start()
+        return self
+
+    def get(self, server_address):
+        for backend in self.backends:
+            if backend.server_address == server_address:
+                return backend
+        return None
+
+    def any_available(self):
+        return any(backend.available for backend in self.backends)
+
+    def ready(self):
+        """A backend is up and, with POOL_WARMUP, has its models loaded"""
+        return any(backend.available and (backend.warm or not POOL_WARMUP) for backend in self.backends)
+
+    def warmup_due(self, backend):
+        """"warm-up" while a backend still has to load its models, "keep-alive" once it idled long enough to unload them"""
+        if not backend.capabilities.connected:
+            # ComfyUI may be restarting, in which case its models are gone
+            backend.warm = False
+            return None
+        if time.time() < backend.warmup_retry_at:
+            return None
+        if POOL_WARMUP and not backend.warm:
+            return "warm-up"
+        if (POOL_KEEPALIVE_INTERVAL and backend.in_flight == 0
+                and time.time() - backend.last_used >= POOL_KEEPALIVE_INTERVAL):
+            return "keep-alive"
+        return None
+
+    def record_warmup(self, backend, reason, seconds, error=None):
+        backend.last_used = time.time()
+        # The tiny input replaced whatever image/prompt nodes ComfyUI had cached
+        backend.last_affinity = None
+        if error is not None:
+            backend.warmup_error = str(error)
+            backend.warmup_retry_at = time.time() + POOL_WARMUP_RETRY
+            logger.warning("ComfyUI %s of %s failed after %.1fs: %s", reason, backend.url, seconds, error)
+            return
+        backend.warm = True
+        backend.warmed_at = time.time()
+        backend.warmup_error = None
+        metrics.observe("isogen_warmup_seconds", seconds, reason=reason)
+        logger.info("ComfyUI %s of %s done in %.1fs", reason, backend.url, seconds)
+
+    @property
+    def slots(self):
+        """Jobs the pool runs at once when every backend is in rotation"""
+        return self.max_in_flight * len(self.backends)
+
+    @property
+    def available_slots(self):
+        """Jobs the pool can run at once right now, leaving out ejected and unreachable backends"""
+        return self.max_in_flight * sum(1 for backend in self.backends if backend.available)
+
+    def average_latency(self):
+        latencies = [backend.latency for backend in self.backends if backend.latency]
+        return sum(latencies) / len(latencies) if latencies else POOL_DEFAULT_JOB_SECONDS
+
+    def acquire(self, timeout=0, affinity=None):
+        """Pick the least-loaded healthy backend with a free slot and count a job against it
+
+        Waits up to timeout seconds while every healthy backend already runs
+        max_in_flight jobs; returns None if none is healthy or none freed up.
+        With an (input hash, prompt) affinity, a backend whose last job shared
+        either is preferred while it is at most POOL_AFFINITY_SLACK jobs
+        slower, so ComfyUI can reuse the cached image and prompt nodes.
+        """
+        deadline = time.time() + timeout
+        with self._slot_freed:
+            while True:
+                candidates = [backend for backend in self.backends if backend.available]
+                if not candidates:
+                    return None
+                free = [backend for backend in candidates if backend.in_flight < self.max_in_flight]
+                if free:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._slot_freed.wait(remaining)
+            if POOL_WARMUP:
+                # A cold backend would make this job pay for loading the models
+                free = [backend for backend in free if backend.warm] or free
+            default_latency = self.average_latency()
+            backend = min(free, key=lambda b: b.expected_wait(default_latency))
+            if affinity is not None and len(self.backends) > 1:
+                warm = max(free, key=lambda b: affinity_overlap(b.last_affinity, affinity))
+                if (affinity_overlap(warm.last_affinity, affinity)
+                        and warm.expected_wait(default_latency)
+                        <= backend.expected_wait(default_latency) + POOL_AFFINITY_SLACK * default_latency):
+                    backend = warm
+                metrics.inc("isogen_affinity_routed_total",
+                            outcome="warm" if affinity_overlap(backend.last_affinity, affinity) else "cold")
+            if affinity is not None:
+                backend.last_affinity = affinity
+            backend.in_flight += 1
+            return backend
+
+    def release(self, backend, duration=None, failed=False):
+        with self._slot_freed:
+            backend.in_flight -= 1
+            backend.last_used = time.time()
+            self._slot_freed.notify()
+            if failed:
+                backend.failures += 1
+                if backend.failures >= POOL_EJECT_FAILURES:
+                    backend.ejected_until = time.time() + POOL_EJECT_SECONDS
+                    backend.failures = 0
+                    logger.warning("Ejecting ComfyUI backend %s for %ss", backend.url, POOL_EJECT_SECONDS)
+            else:
+                backend.failures = 0
+                backend.jobs_completed += 1
+                if duration is not None:
+                    if backend.latency is None:
+                        backend.latency = duration
+                    else:
+                        backend.latency += POOL_LATENCY_ALPHA * (duration - backend.latency)
+        if failed:
+            backend.capabilities.invalidate()
+
+    @contextmanager
+    def lease(self, affinity=None):
+        """Hold a backend for one job; 503-class failures count against its health"""
+        backend = self.acquire(self.slot_wait, affinity)
+        if backend is None:
+            raise ProcessingError(
+                "ComfyUI not available",
+                details=f"No healthy ComfyUI backend with a free slot ({', '.join(b.url for b in self.backends)})",
+                suggestion="Start ComfyUI with: python main.py --listen",
+                status_code=503
+            )
+        started = time.time()
+        try:
+            yield backend
+        except ProcessingError as e:
+            self.release(backend, failed=e.status_code == 503)
+            raise
+        except Exception:
+            self.release(backend, failed=True)
+            raise
+        except BaseException:
+            # Cancelled (asyncio mode), not the backend's fault
+            self.release(backend)
+            raise
+        else:
+            self.release(backend, duration=time.time() - started)
+
+    def models_status(self):
+        """Returns (ok, message) across the healthy backends, or all of them if none is"""
+        backends = [backend for backend in self.backends if backend.available] or self.backends
+        problems = []
+        for backend in backends:
+            ok, message = backend.capabilities.models_status()
+            if not ok:
+                problems.append(f"{backend.url}: {message}" if len(self.backends) > 1 else message)
+        if problems:
+            return False, "; ".join(problems)
+        return True, "All required models are available"
+
+    def snapshot(self):
+        return [backend.snapshot() for backend in self.backends]
+
+    def _monitor(self):
+        while True:
+            for backend in self.backends:
+                if not backend.capabilities.connected:
+                    continue
+                try:
+                    response = backend.transport.get("/queue", retries=0)
+                    if response.status_code == 200:
+                        data = response.json()
+                        backend.queue_depth = len(data.get('queue_running', [])) + len(data.get('queue_pending', []))
+                except Exception:
+                    pass
+                if backend.ejected_until and not backend.ejected:
+                    backend.ejected_until = 0
+                    logger.info("Re-admitting ComfyUI backend %s", backend.url)
+            time.sleep(POOL_MONITOR_INTERVAL)
+
+    def _warm_up(self):
+        while True:
+            for backend in self.backends:
+                reason = self.warmup_due(backend)
+                if reason is None:
+                    continue
+                started = time.time()
+                try:
+                    warm_up_backend(backend)
+                except Exception as e:
+                    self.record_warmup(backend, reason, time.time() - started, e)
+                else:
+                    self.record_warmup(backend, reason, time.time() - started)
+            time.sleep(POOL_MONITOR_INTERVAL)
+
+_backend_pool = None
+_backend_pool_lock = threading.Lock()
+
+def get_backend_pool():
+    """Get the shared, started ComfyUI backend pool"""
+    global _backend_pool
+    with _backend_pool_lock:
+        if _backend_pool is None:
+            _backend_pool = BackendPool(COMFY_UI_URLS).start()
+    return _backend_pool
+
+_warmup_image = None
+
+def warmup_image():
+    """Small blank PNG the warm-up generation runs on"""
+    global _warmup_image
+    if _warmup_image is None:
+        buffer = io.BytesIO()
+        Image.new("RGB", (POOL_WARMUP_IMAGE_SIDE, POOL_WARMUP_IMAGE_SIDE), "white").save(buffer, "PNG")
+        _warmup_image = buffer.getvalue()
+    return _warmup_image
+
+def warmup_workflow(input_filename):
+    """The workflow at 1 step and low resolution: every model loader still runs, sampling is nearly free"""
+    workflow = update_workflow_for_processing(get_workflow_template(), input_filename, DEFAULT_PROMPT,
+                                              profile=WORKFLOW_DRAFT_PROFILE, **POOL_WARMUP_PARAMS)
+    if not workflow:
+        raise Exception(f"Could not build the warm-up workflow from {WORKFLOW_FILE}")
+    return workflow
+
+def warm_up_backend(backend):
+    """Load the UNet, text encoders, VAE and LoRA on one backend with a throwaway generation"""
+    input_filename = stage_input_image(warmup_image(), backend.server_address)
+    execute_workflow(warmup_workflow(input_filename), server_address=backend.server_address)
+
+def decode_base64_image(image_base64):
+    """Decode base64 image data, with or without a data URL prefix"""
+    # Remove data URL prefix if present
+    if "data:image" in image_base64:
+        image_base64 = image_base64.split(",")[1]
+    return base64.b64decode(image_base64, validate=True)
+
+def sniff_image_type(image_data):
+    """Return (extension, mime type) from the image's magic bytes, None if unknown"""
+    if image_data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png", "image/png"
+    if image_data.startswith(b"\xff\xd8\xff"):
+        return "jpg", "image/jpeg"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return None
+
+def input_target_side(template):
+    """Smaller side the workflow resizes inputs to, the largest over all profiles; None if it doesn't resize"""
+    sides = [template.slot_value("resize_side", profile) for profile in template.profiles]
+    sides = [side for side in sides if isinstance(side, int) and side > 0]
+    return max(sides) if sides else None
+
+def normalize_input_image(image_data, target_side=None):
+    """Decode an upload once, validate it and re-encode it the way the workflow consumes it
+
+    Mirrors LoadImage (EXIF orientation applied, RGB without alpha) and
+    downscales so the smaller side matches ImageResize, so ComfyUI gets the
+    same pixels it would have produced itself from a fraction of the bytes.
+    Returns (image bytes, info); raises ValueError for unusable images.
+    """
+    if sniff_image_type(image_data) is None:
+        raise ValueError("Unsupported image format (expected PNG, JPEG or WebP)")
+    try:
+        image = Image.open(io.BytesIO(image_data))
+    except Exception as e:
+        raise ValueError(f"Could not decode image: {e}")
+    width, height = image.size
+    info = {"source_bytes": len(image_data), "source_size": [width, height], "source_mode": image.mode}
+    if width * height > INPUT_MAX_PIXELS:
+        raise ValueError(f"Image is {width}x{height}, larger than the {INPUT_MAX_PIXELS} pixel limit")
+    if min(width, height) < INPUT_MIN_SIDE:
+        raise ValueError(f"Image is {width}x{height}, sides must be at least {INPUT_MIN_SIDE} pixels")
+    
+    # Already what we'd produce: an RGB PNG within the target size and without metadata chunks
+    if (INPUT_ENCODE_FORMAT == "png" and image.format == "PNG" and image.mode == "RGB"
+            and not (target_side and min(width, height) > target_side) and not set(image.info) - {"dpi", "gamma"}):
+        try:
+            image.load()
+        except Exception as e:
+            raise ValueError(f"Could not decode image: {e}")
+        info.update(size=[width, height], bytes=len(image_data))
+        return image_data, info
+    
+    try:
+        # A large JPEG can decode straight at a reduced scale
+        if target_side and image.format == "JPEG":
+            image.draft("RGB", (width * target_side // min(width, height), height * target_side // min(width, height)))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+    except Exception as e:
+        raise ValueError(f"Could not decode image: {e}")
+    
+    if target_side and min(image.size) > target_side:
+        scale = target_side / min(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    
+    # Re-encoded without metadata: no EXIF, ICC profile or text chunks reach ComfyUI
+    buffer = io.BytesIO()
+    if INPUT_ENCODE_FORMAT == "jpg":
+        image.save(buffer, "JPEG", quality=INPUT_ENCODE_QUALITY)
+    elif INPUT_ENCODE_FORMAT == "webp":
+        image.save(buffer, "WEBP", quality=INPUT_ENCODE_QUALITY)
+    else:
+        image.save(buffer, "PNG")
+    normalized = buffer.getvalue()
+    info.update(size=list(image.size), bytes=len(normalized))
+    return normalized, info
+
+# Artifact and result cache files are written off the request path
+_disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-writer")
+
+_staged_inputs = OrderedDict()
+_staged_inputs_lock = threading.Lock()
+
+def staged_input_name(image_data):
+    """Returns (file name, mime type) an input is staged under on ComfyUI, named by content hash"""
+    image_type = sniff_image_type(image_data)
+    if image_type is None:
+        raise ValueError("Unsupported image format (expected PNG, JPEG or WebP)")
+    extension, mime_type = image_type
+    return f"isogen_{hashlib.sha256(image_data).hexdigest()[:32]}.{extension}", mime_type
+
+def stage_input_image(image_data, server_address=COMFY_SERVER_ADDRESS):
+    """Upload image bytes to ComfyUI's input folder, returns the name to put in LoadImage
+
+    Files are named by content hash, so identical inputs map to the same
+    file and a recently staged image isn't uploaded again.
+    """
+    filename, mime_type = staged_input_name(image_data)
+    
+    key = (server_address, filename)
+    now = time.time()
+    with _staged_inputs_lock:
+        staged = _staged_inputs.get(key)
+        if staged and now - staged[0] < STAGED_INPUT_TTL:
+            _staged_inputs.move_to_end(key)
+            logger.debug("Input already staged: %s", staged[1])
+            return staged[1]
+    
+    response = get_transport(server_address).post(
+        "/upload/image",
+        files={"image": (filename, image_data, mime_type)},
+        data={"type": "input", "overwrite": "true"},
+        timeout=(COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_DOWNLOAD_TIMEOUT)
+    )
+    if response.status_code != 200:
+        raise Exception(f"ComfyUI upload failed with status {response.status_code}: {response.text[:200]}")
+    
+    uploaded = response.json()
+    name = uploaded.get("name", filename)
+    if uploaded.get("subfolder"):
+        name = f"{uploaded['subfolder']}/{name}"
+    
+    with _staged_inputs_lock:
+        _staged_inputs[key] = (now, name)
+        while len(_staged_inputs) > STAGED_INPUT_CACHE_SIZE:
+            _staged_inputs.popitem(last=False)
+    logger.debug("Uploaded input to ComfyUI: %s (%d bytes)", name, len(image_data))
+    return name
+
+def select_output_image(outputs, workflow_data=None):
+    """Resolve which history output holds the final image, returns its image ref (nothing is downloaded)"""
+    # Look for images in output nodes (typically nodes 107, 118, or similar)
+    for node_id in OUTPUT_NODE_IDS:
+        images = outputs.get(node_id, {}).get('images')
+        if images:
+            logger.debug("Found output image from node %s", node_id)
+            return images[0]  # Get first image
+    
+    # Otherwise prefer save nodes by class_type, then whatever produced an image last
+    candidates = [node_id for node_id, node_output in outputs.items() if node_output.get('images')]
+    saved = [node_id for node_id in candidates
+             if (workflow_data or {}).get(node_id, {}).get('class_type') in OUTPUT_CLASS_TYPES]
+    if saved or candidates:
+        node_id = (saved or candidates)[-1]
+        logger.debug("Using image from node %s", node_id)
+        return outputs[node_id]['images'][0]
+    return None
+
+def progress_forwarder(workflow_data, progress):
+    """Translate raw ComfyUI events for one prompt into job progress events"""
+    def forward(event_type, data):
+        if event_type == 'execution_start':
+            progress("stage", {"stage": "executing"})
+        elif event_type == 'executing' and data.get('node') is not None:
+            node_id = data['node']
+            progress("node", {"node": node_id, "class_type": workflow_data.get(node_id, {}).get("class_type")})
+        elif event_type == 'progress':
+            progress("progress", {"node": data.get('node'), "value": data.get('value'), "max": data.get('max')})
+        elif event_type == 'queue_position':
+            progress("queue", {"position": data['position']})
+            if data['position'] == 0:
+                # The polling tracker's stand-in for execution_start
+                progress("stage", {"stage": "executing"})
+        elif event_type == 'execution_cached':
+            progress("cached", {"nodes": data.get('nodes') or []})
+        elif event_type == 'preview':
+            progress("preview", data)
+    return forward
+
+def process_with_comfyui_websocket(workflow_data, output_selector=select_output_image, progress=None,
+                                   server_address=COMFY_SERVER_ADDRESS):
+    """Process workflow using the shared WebSocket listener for real-time updates"""
+    listener = get_event_listener(server_address)
+    on_event = progress_forwarder(workflow_data, progress) if progress else None
+    try:
+        if not listener.wait_connected(COMFY_WS_CONNECT_TIMEOUT):
+            raise Exception(f"No WebSocket connection to ComfyUI at {listener.server_address}")
+        
+        prompt_id, watch = submit_and_watch(listener, workflow_data, on_event)
+    except Exception as e:
+        logger.warning("WebSocket submission failed, falling back to polling: %s", e)
+        return process_with_polling(workflow_data, output_selector, progress, server_address)
+    
+    # From here on the prompt is queued, falling back would run it twice
+    logger.debug("Queued prompt %s on %s", prompt_id, listener.server_address)
+    if progress:
+        progress("submitted", {"prompt_id": prompt_id, "backend": listener.server_address})
+    try:
+        watch.wait(COMFY_PROMPT_TIMEOUT)
+    except TimeoutError:
+        listener.unwatch(watch)
+        # The caller gets an error either way; don't leave the prompt holding the GPU
+        cancel_prompt(prompt_id, listener.server_address, reason="Timed out")
+        raise
+    
+    # Get the results
+    if progress:
+        progress("stage", {"stage": "fetching_output"})
+    client = ComfyUIClient(listener.server_address, client_id=listener.client_id)
+    history = client.get_history(prompt_id)[prompt_id]
+    
+    # Resolve the wanted output first so discarded images are never downloaded
+    selection = output_selector(history['outputs'], workflow_data)
+    if not selection:
+        raise Exception("No output image found in workflow results")
+    
+    return download_selected_images(client, selection)
+
+def process_with_polling(workflow_data, output_selector=select_output_image, progress=None,
+                         server_address=COMFY_SERVER_ADDRESS):
+    """Fallback without the WebSocket: follow our own prompt_id through /queue and /history"""
+    tracker = get_completion_tracker(server_address)
+    on_event = progress_forwarder(workflow_data, progress) if progress else None
+    
+    prompt_id, watch = submit_and_watch(tracker, workflow_data, on_event)
+    logger.debug("Queued prompt %s on %s (polling)", prompt_id, server_address)
+    if progress:
+        progress("submitted", {"prompt_id": prompt_id, "backend": server_address})
+    try:
+        # The tracker hands over the history entry's outputs on completion
+        outputs = watch.wait(COMFY_PROMPT_TIMEOUT)
+    except TimeoutError:
+        tracker.unwatch(watch)
+        cancel_prompt(prompt_id, server_address, reason="Timed out")
+        raise
+    
+    if progress:
+        progress("stage", {"stage": "fetching_output"})
+    selection = output_selector(outputs, workflow_data)
+    if not selection:
+        raise Exception("No output image found in workflow results")
+    
+    return download_selected_images(ComfyUIClient(server_address), selection)
+
+class ResultCache:
+    """Two-tier (memory LRU + size-capped disk) cache of generated images keyed by content hash"""
+    def __init__(self, directory=RESULT_CACHE_DIR, memory_bytes=RESULT_CACHE_MEMORY_BYTES, disk_bytes=RESULT_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> (data, mime_type)
+        self._memory_size = 0
+        self._disk = OrderedDict()  # key -> (path, size), least recently used first
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if self.disk_bytes:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(input_hash, prompt, seed, workflow_version, params):
+        material = json.dumps({
+            "input": input_hash,
+            "prompt": prompt,
+            "seed": seed,
+            "workflow": workflow_version,
+            "params": params
+        }, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return (data, mime_type) or None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry
+            disk_entry = self._disk.get(key)
+            if disk_entry is not None:
+                self._disk.move_to_end(key)
+        
+        if disk_entry is not None:
+            path = disk_entry[0]
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                with self._lock:
+                    self._drop_disk_locked(key)
+                    self.counters["misses"] += 1
+                return None
+            entry = (data, (sniff_image_type(data) or ("png", "image/png"))[1])
+            with self._lock:
+                self.counters["disk_hits"] += 1
+                self._put_memory_locked(key, entry)
+            return entry
+        
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, data, mime_type):
+        with self._lock:
+            self.counters["stores"] += 1
+            self._put_memory_locked(key, (data, mime_type))
+        if self.disk_bytes:
+            _disk_writer.submit(self._write_disk, key, data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return dict(self.counters,
+                        hit_rate=round(hits / lookups, 3) if lookups else None,
+                        memory_entries=len(self._memory),
+                        memory_bytes=self._memory_size,
+                        disk_entries=len(self._disk),
+                        disk_bytes=self._disk_size)
+
+    def _put_memory_locked(self, key, entry):
+        if len(entry[0]) > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous[0])
+        self._memory[key] = entry
+        self._memory_size += len(entry[0])
+        while self._memory_size > self.memory_bytes:
+            _, (data, _) = self._memory.popitem(last=False)
+            self._memory_size -= len(data)
+            self.counters["evictions"] += 1
+
+    def _write_disk(self, key, data):
+        path = os.path.join(self.directory, f"{key}.bin")
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write result cache entry: %s", e)
+            return
+        
+        with self._lock:
+            self._drop_disk_locked(key)
+            self._disk[key] = (path, len(data))
+            self._disk_size += len(data)
+            while self._disk_size > self.disk_bytes and self._disk:
+                old_key = next(iter(self._disk))
+                self._drop_disk_locked(old_key, remove_file=True)
+                self.counters["evictions"] += 1
+
+    def _drop_disk_locked(self, key, remove_file=False):
+        entry = self._disk.pop(key, None)
+        if entry is None:
+            return
+        self._disk_size -= entry[1]
+        if remove_file:
+            try:
+                os.remove(entry[0])
+            except OSError:
+                pass
+
+    def _load_disk_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-4], path, stat.st_size))
+        for _, key, path, size in sorted(entries):
+            self._disk[key] = (path, size)
+            self._disk_size += size
+
+result_cache = ResultCache()
+rendition_cache = ResultCache(RENDITION_CACHE_DIR, RENDITION_CACHE_MEMORY_BYTES, RENDITION_CACHE_DISK_BYTES)
+
+def negotiate_rendition_format(accept):
+    """Format for format=auto: WebP unless the Accept header names image types without it"""
+    types = {part.split(";")[0].strip().lower() for part in (accept or "").split(",")}
+    listed = {media_type for media_type in types if media_type.startswith("image/") and media_type != "image/*"}
+    if not listed or "image/webp" in types or "image/*" in types:
+        return "webp"
+    return "jpg" if "image/jpeg" in listed else "png"
+
+def rendition_requested(args):
+    return any(args.get(name) not in (None, "") for name in ("format", "quality", "max_side", "size"))
+
+def parse_rendition(args, accept=None):
+    """Rendition requested through query args, None to serve the original bytes
+
+    A size preset sets max_side and quality, explicit values override it.
+    Without a format the Accept header picks one (format=auto).
+    """
+    if not rendition_requested(args):
+        return None
+    rendition = {"format": None, "quality": None, "max_side": None}
+    if args.get("size"):
+        if args["size"] not in RENDITION_PRESETS:
+            raise ValueError(f"size must be one of {', '.join(RENDITION_PRESETS)}")
+        rendition.update(RENDITION_PRESETS[args["size"]])
+    
+    image_format = (args.get("format") or "auto").lower()
+    image_format = "jpg" if image_format == "jpeg" else image_format
+    negotiated = image_format == "auto"
+    if negotiated:
+        image_format = negotiate_rendition_format(accept)
+    elif image_format not in RENDITION_FORMATS:
+        raise ValueError(f"format must be auto or one of {', '.join(RENDITION_FORMATS)}")
+    rendition["format"] = image_format
+    
+    if args.get("quality") not in (None, ""):
+        rendition["quality"] = int(args["quality"])
+        if not 1 <= rendition["quality"] <= 100:
+            raise ValueError("quality must be between 1 and 100")
+    if args.get("max_side") not in (None, ""):
+        rendition["max_side"] = int(args["max_side"])
+        if not 16 <= rendition["max_side"] <= RENDITION_MAX_SIDE:
+            raise ValueError(f"max_side must be between 16 and {RENDITION_MAX_SIDE}")
+    # Lossless output ignores quality, dropping it keeps one cache entry per size
+    rendition["quality"] = None if image_format == "png" else rendition["quality"] or RENDITION_DEFAULT_QUALITY
+    rendition["negotiated"] = negotiated
+    return rendition
+
+def rendition_etag(etag, rendition):
+    return f"{etag}-{rendition['format']}-{rendition['quality'] or 0}-{rendition['max_side'] or 0}"
+
+def render_image(image_data, rendition):
+    """Downscale and transcode image bytes, returns (data, mime type); metadata is not carried over"""
+    started = time.perf_counter()
+    image = Image.open(io.BytesIO(image_data))
+    if rendition["max_side"]:
+        image.thumbnail((rendition["max_side"], rendition["max_side"]), Image.LANCZOS)
+    pil_format, mime_type = RENDITION_FORMATS[rendition["format"]]
+    if image.mode not in ("RGB", "RGBA") or (pil_format == "JPEG" and image.mode != "RGB"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, pil_format)
+    else:
+        image.save(buffer, pil_format, quality=rendition["quality"])
+    metrics.observe("isogen_stage_seconds", time.perf_counter() - started, stage="render")
+    return buffer.getvalue(), mime_type
+
+def get_rendition(image_data, etag, rendition):
+    """Rendition of an image identified by its etag, transcoded once and then served from the rendition cache"""
+    key = hashlib.sha256(rendition_etag(etag, rendition).encode("utf-8")).hexdigest()
+    cached = rendition_cache.get(key)
+    if cached is not None:
+        return cached
+    data, mime_type = render_image(image_data, rendition)
+    rendition_cache.put(key, data, mime_type)
+    return data, mime_type
+
+class ArtifactStore:
+    """Content-addressed copies of job inputs and outputs on disk, with size and age retention
+
+    Artifacts are written by the background disk writer and served from
+    memory until the write lands. The index is rebuilt from the directory
+    on startup, so ids stay valid across restarts.
+    """
+    def __init__(self, directory=ARTIFACT_DIR, max_bytes=ARTIFACT_MAX_BYTES, max_age=ARTIFACT_MAX_AGE):
+        # Absolute, since send_file resolves relative paths against the app root
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._index = OrderedDict()  # id -> entry dict, oldest first
+        self._pending = {}  # id -> bytes not yet on disk
+        self._size = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {"stores": 0, "duplicates": 0, "evictions": 0, "write_errors": 0}
+        for kind in ARTIFACT_KINDS:
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        self._load_index()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sweep_loop, name="artifact-sweeper", daemon=True)
+                self._thread.start()
+        return self
+
+    def put(self, kind, data):
+        """Store bytes under their content hash, returns the artifact id"""
+        # Started on first use, so importing the module (e.g. in the reloader's parent process) starts no thread
+        self.start()
+        extension, mime_type = sniff_image_type(data) or ("bin", "application/octet-stream")
+        artifact_id = hashlib.sha256(data).hexdigest()[:32]
+        with self._lock:
+            entry = self._index.get(artifact_id)
+            if entry is not None:
+                # Identical bytes are stored once, re-storing only refreshes their age
+                entry["created_at"] = time.time()
+                self._index.move_to_end(artifact_id)
+                self.counters["duplicates"] += 1
+                if artifact_id not in self._pending:
+                    _disk_writer.submit(self._touch, entry["path"])
+                return artifact_id
+            entry = {
+                "id": artifact_id,
+                "kind": kind,
+                "path": os.path.join(self.directory, kind, f"{artifact_id}.{extension}"),
+                "size": len(data),
+                "mime_type": mime_type,
+                "created_at": time.time()
+            }
+            self._index[artifact_id] = entry
+            self._pending[artifact_id] = data
+            self._size += len(data)
+            self.counters["stores"] += 1
+        _disk_writer.submit(self._write, artifact_id, data)
+        return artifact_id
+
+    def get(self, artifact_id):
+        """Returns (entry, bytes or None) where None means read the file at entry["path"]"""
+        with self._lock:
+            entry = self._index.get(artifact_id)
+            if entry is None:
+                return None, None
+            return dict(entry), self._pending.get(artifact_id)
+
+    def list(self, kind=None, limit=50):
+        """Newest artifacts first"""
+        with self._lock:
+            entries = [dict(entry) for entry in reversed(self._index.values())
+                       if kind is None or entry["kind"] == kind]
+        return entries[:limit]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._index), bytes=self._size,
+                        pending_writes=len(self._pending), max_bytes=self.max_bytes, max_age=self.max_age)
+
+    def sweep(self):
+        """Drop artifacts past max_age, then the oldest ones while over max_bytes"""
+        cutoff = time.time() - self.max_age if self.max_age else None
+        with self._lock:
+            size = self._size
+            expired = []
+            for artifact_id, entry in self._index.items():
+                if size <= self.max_bytes and (cutoff is None or entry["created_at"] >= cutoff):
+                    break
+                if artifact_id in self._pending:
+                    continue
+                expired.append(artifact_id)
+                size -= entry["size"]
+            entries = [self._index.pop(artifact_id) for artifact_id in expired]
+            for entry in entries:
+                self._size -= entry["size"]
+            self.counters["evictions"] += len(entries)
+        for entry in entries:
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+        if entries:
+            logger.info("Evicted %d artifacts", len(entries))
+        return len(entries)
+
+    def _write(self, artifact_id, data):
+        with self._lock:
+            entry = self._index.get(artifact_id)
+        if entry is None:
+            return
+        started = time.perf_counter()
+        try:
+            tmp_path = f"{entry['path']}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, entry["path"])
+            metrics.observe("isogen_stage_seconds", time.perf_counter() - started, stage="disk_save")
+        except OSError as e:
+            logger.warning("Could not write artifact %s: %s", artifact_id, e)
+            with self._lock:
+                if self._index.pop(artifact_id, None) is not None:
+                    self._size -= len(data)
+                self.counters["write_errors"] += 1
+        finally:
+            with self._lock:
+                self._pending.pop(artifact_id, None)
+        if self._size > self.max_bytes:
+            self.sweep()
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(ARTIFACT_SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Artifact sweep failed: %s", e)
+
+    def _load_index(self):
+        entries = []
+        for kind in ARTIFACT_KINDS:
+            kind_dir = os.path.join(self.directory, kind)
+            for name in os.listdir(kind_dir):
+                artifact_id, _, extension = name.partition(".")
+                if not extension or extension.endswith("tmp"):
+                    continue
+                path = os.path.join(kind_dir, name)
+                stat = os.stat(path)
+                mime_type = ARTIFACT_MIME_TYPES.get(extension, "application/octet-stream")
+                entries.append({"id": artifact_id, "kind": kind, "path": path, "size": stat.st_size,
+                                "mime_type": mime_type, "created_at": stat.st_mtime})
+        for entry in sorted(entries, key=lambda e: e["created_at"]):
+            self._index[entry["id"]] = entry
+            self._size += entry["size"]
+
+artifact_store = ArtifactStore()
+
+def resolve_seed(seed, deterministic, input_hash, prompt):
+    """Pick the sampler seed: explicit, derived from the inputs, or None for a random one"""
+    if seed is not None:
+        return seed
+    if deterministic:
+        digest = hashlib.sha256(f"{input_hash}:{prompt}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], "big") or 1
+    return None
+
+class ProcessingError(Exception):
+    """Pipeline failure carrying the HTTP status and error payload for the API"""
+    def __init__(self, error, details=None, suggestion=None, status_code=500):
+        super().__init__(details or error)
+        self.error = error
+        self.details = details
+        self.suggestion = suggestion
+        self.status_code = status_code
+
+    def to_dict(self):
+        payload = {"error": self.error}
+        if self.details is not None:
+            payload["details"] = self.details
+        if self.suggestion is not None:
+            payload["suggestion"] = self.suggestion
+        return payload
+
+class JobCancelledError(ProcessingError):
+    """The job was cancelled by its client, a disconnect or the abandoned-job reaper"""
+    def __init__(self, details=None):
+        super().__init__("Job cancelled", details=details, status_code=409)
+
+def make_output_result(output_image_data, prompt, seed, cached=False, output_artifact=None,
+                       profile=WORKFLOW_DEFAULT_PROFILE):
+    """Result entry for one generated image
+
+    output_filename is the artifact store's name for the bytes (content hash
+    plus extension), so it stays the same whether or not they came from cache.
+    """
+    extension, mime_type = sniff_image_type(output_image_data) or ("png", "image/png")
+    etag = hashlib.sha256(output_image_data).hexdigest()[:32]
+    return {
+        "output_data": output_image_data,
+        "output_mime_type": mime_type,
+        "output_etag": etag,
+        "output_filename": f"{etag}.{extension}",
+        "prompt": prompt,
+        "seed": seed,
+        "cached": cached,
+        "profile": profile,
+        "output_artifact": output_artifact
+    }
+
+def cached_output_result(output_image_data, prompt, seed, profile=WORKFLOW_DEFAULT_PROFILE):
+    """Result entry for a result cache hit, with the output re-registered in the artifact store"""
+    output_artifact = artifact_store.put("output", output_image_data) if SAVE_OUTPUTS_LOCALLY else None
+    return make_output_result(output_image_data, prompt, seed, cached=True, output_artifact=output_artifact,
+                              profile=profile)
+
+def comfyui_unavailable_error(e, server_address=COMFY_SERVER_ADDRESS):
+    get_capabilities(server_address, wait=False).invalidate()
+    return ProcessingError(
+        "ComfyUI not available",
+        details=str(e),
+        suggestion="Start ComfyUI with: python main.py --listen",
+        status_code=503
+    )
+
+def ensure_comfyui_ready(backend):
+    """Fail fast if the cached probe says the backend is down, warn about missing models"""
+    # Check ComfyUI connection
+    if not backend.capabilities.connected:
+        raise ProcessingError(
+            "ComfyUI not available",
+            details=f"Cannot connect to ComfyUI at {backend.url}",
+            suggestion="Start ComfyUI with: python main.py --listen",
+            status_code=503
+        )
+    
+    # Check required models
+    models_ok, models_msg = backend.capabilities.models_status()
+    if not models_ok:
+        logger.warning("Model check warning: %s", models_msg)
+        # Continue anyway - some models might still work
+
+def stage_job_input(image_data, server_address=COMFY_SERVER_ADDRESS):
+    """Stage the decoded input bytes on ComfyUI, mapping failures to API errors"""
+    try:
+        input_filename = stage_input_image(image_data, server_address)
+    except ComfyUIUnavailableError as e:
+        raise comfyui_unavailable_error(e, server_address)
+    except ValueError as e:
+        raise ProcessingError("Invalid image data", details=str(e), status_code=400)
+    except Exception as e:
+        raise ProcessingError("Failed to stage input image", details=str(e))
+    
+    return input_filename
+
+def execute_workflow(workflow, output_selector=select_output_image, progress=None, server_address=COMFY_SERVER_ADDRESS):
+    """Run a prepared workflow on ComfyUI, mapping failures to API errors"""
+    if progress:
+        progress("stage", {"stage": "submitting"})
+    try:
+        return process_with_comfyui_websocket(workflow, output_selector, progress, server_address)
+    except JobCancelledError:
+        raise
+    except ComfyUIUnavailableError as e:
+        logger.error("ComfyUI unavailable: %s", e)
+        raise comfyui_unavailable_error(e, server_address)
+    except Exception as e:
+        logger.error("ComfyUI processing failed: %s", e)
+        get_capabilities(server_address, wait=False).invalidate()
+        raise ProcessingError(
+            "ComfyUI processing failed",
+            details=str(e),
+            suggestion="Check ComfyUI console for detailed error messages"
+        )
+
+def generation_cache_key(input_hash, prompt, seed, template, profile):
+    # Final results keep the keys they had before profiles existed
+    params = {} if profile == WORKFLOW_DEFAULT_PROFILE else {"profile": profile}
+    return ResultCache.make_key(input_hash, prompt, seed, template.version, params)
+
+def run_generation_pipeline(image_data, prompt, seed=None, deterministic_seed=DETERMINISTIC_SEEDS,
+                            profile=WORKFLOW_DEFAULT_PROFILE, progressive=False, progress=None):
+    """Run the full save -> workflow update -> ComfyUI pipeline for one request
+
+    In progressive mode the draft profile runs first under the same seed and
+    backend lease and is published as a "draft" event before the requested
+    profile's result is generated.
+    """
+    # Load workflow
+    template = get_workflow_template()
+    if not template.current():
+        raise ProcessingError(
+            "Workflow not found",
+            details=f"Could not load {WORKFLOW_FILE}",
+            suggestion="Ensure the workflow JSON file exists in the project root"
+        )
+    
+    # Results are only reusable when the seed is known up front
+    input_hash = hashlib.sha256(image_data).hexdigest()
+    seed = resolve_seed(seed, deterministic_seed, input_hash, prompt)
+    cache_key = None
+    if seed is not None:
+        cache_key = generation_cache_key(input_hash, prompt, seed, template, profile)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Result cache hit (%s)", cache_key[:12])
+            result = cached_output_result(cached[0], prompt, seed, profile)
+            # Nothing was staged, report the name the input would have had on ComfyUI
+            result.update(input_filename=staged_input_name(image_data)[0],
+                          workflow_nodes=len(template.profile_graph(profile)))
+            return result
+    
+    run_draft = progressive and profile != WORKFLOW_DRAFT_PROFILE and progress is not None
+    draft_key = None
+    if run_draft and seed is not None:
+        draft_key = generation_cache_key(input_hash, prompt, seed, template, WORKFLOW_DRAFT_PROFILE)
+        cached = result_cache.get(draft_key)
+        if cached is not None:
+            progress("draft", make_output_result(cached[0], prompt, seed, cached=True, profile=WORKFLOW_DRAFT_PROFILE))
+            run_draft = False
+    
+    with get_backend_pool().lease(affinity=(input_hash, prompt)) as backend:
+        ensure_comfyui_ready(backend)
+        
+        if progress:
+            progress("stage", {"stage": "staging_input"})
+        input_filename = stage_job_input(image_data, backend.server_address)
+        
+        # Generate random seed for variety
+        if seed is None:
+            seed = random.randint(1, 2**32 - 1)
+        
+        if run_draft:
+            draft_data = generate_on_backend(backend, template, input_filename, prompt, seed, WORKFLOW_DRAFT_PROFILE,
+                                             progress)
+            draft = make_output_result(draft_data, prompt, seed, profile=WORKFLOW_DRAFT_PROFILE)
+            if draft_key:
+                result_cache.put(draft_key, draft_data, draft["output_mime_type"])
+            progress("draft", draft)
+        
+        output_image_data = generate_on_backend(backend, template, input_filename, prompt, seed, profile, progress)
+    
+    # Keep copies in the artifact store, written off the request path
+    input_artifact = artifact_store.put("input", image_data) if SAVE_INPUTS_LOCALLY else None
+    output_artifact = artifact_store.put("output", output_image_data) if SAVE_OUTPUTS_LOCALLY else None
+    
+    result = make_output_result(output_image_data, prompt, seed, output_artifact=output_artifact, profile=profile)
+    result.update(input_filename=input_filename, input_artifact=input_artifact,
+                  workflow_nodes=len(template.profile_graph(profile)))
+    if cache_key:
+        result_cache.put(cache_key, output_image_data, result["output_mime_type"])
+    
+    return result
+
+def generate_on_backend(backend, template, input_filename, prompt, seed, profile, progress=None):
+    """Instantiate the workflow under a profile and run it on a leased backend, returns the image bytes"""
+    # Update workflow with new image and prompt
+    updated_workflow = update_workflow_for_processing(template, input_filename, prompt, profile=profile, seed=seed)
+    if not updated_workflow:
+        raise ProcessingError(
+            "Failed to update workflow",
+            details="Could not customize workflow with input parameters"
+        )
+    
+    # Process with ComfyUI
+    return execute_workflow(updated_workflow, progress=progress, server_address=backend.server_address)
+
+def plan_batch_variants(template, image_data, prompt, variants, deterministic_seed, profile):
+    """Resolve each variant's prompt and seed and answer what the result cache can
+
+    Returns (input_hash, results, pending): results holds the cached variants,
+    pending the (index, prompt, seed, cache_key) of those still to generate.
+    """
+    input_hash = hashlib.sha256(image_data).hexdigest()
+    results = [None] * len(variants)
+    pending = []
+    occurrences = {}
+    for index, variant in enumerate(variants):
+        variant_prompt = variant.get("prompt") or prompt
+        # Repeats of a prompt need their own derived seed, the first one
+        # matches what a single request with that prompt would get
+        repeat = occurrences.get(variant_prompt, 0)
+        occurrences[variant_prompt] = repeat + 1
+        seed_material = variant_prompt if repeat == 0 else f"{variant_prompt}:{repeat}"
+        seed = resolve_seed(variant.get("seed"), deterministic_seed, input_hash, seed_material)
+        
+        cache_key = None
+        if seed is not None:
+            cache_key = generation_cache_key(input_hash, variant_prompt, seed, template, profile)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Result cache hit for variant %d (%s)", index, cache_key[:12])
+                results[index] = cached_output_result(cached[0], variant_prompt, seed, profile)
+                continue
+        else:
+            seed = random.randint(1, 2**32 - 1)
+        pending.append((index, variant_prompt, seed, cache_key))
+    return input_hash, results, pending
+
+def build_batch_workflow(template, input_filename, pending, profile):
+    """One graph generating every pending variant, returns (workflow, output_selector)"""
+    original_prompt = template.defaults().get("positive_prompt", "")
+    variant_params = [{"positive_prompt": enhance_prompt(variant_prompt, original_prompt), "seed": seed}
+                      for _, variant_prompt, seed, _ in pending]
+    
+    # Slots that are equal across all variants are set once on the shared graph
+    shared = {"image": input_filename}
+    for name in ("positive_prompt", "seed"):
+        values = {params[name] for params in variant_params}
+        if len(values) == 1:
+            shared[name] = values.pop()
+            for params in variant_params:
+                del params[name]
+    
+    workflow, node_maps = template.instantiate_variants(shared, variant_params, profile)
+    if not workflow:
+        raise ProcessingError(
+            "Failed to update workflow",
+            details="Could not build the batch workflow"
+        )
+    
+    def select_variant_images(outputs, workflow_data):
+        # Each variant's outputs under their template node ids
+        template_graph = template.profile_graph(profile)
+        selection = {}
+        for position, node_map in enumerate(node_maps):
+            variant_outputs = {node_id: outputs[node_map.get(node_id, node_id)] for node_id in template_graph
+                               if node_map.get(node_id, node_id) in outputs}
+            selection[position] = select_output_image(variant_outputs, template_graph)
+        return selection
+    
+    logger.debug("Starting ComfyUI batch of %d variants (%d nodes)", len(pending), len(workflow))
+    return workflow, select_variant_images
+
+def collect_batch_outputs(results, pending, output_images, profile):
+    """Fill in the generated variants, storing and caching each output"""
+    for position, (index, variant_prompt, seed, cache_key) in enumerate(pending):
+        output_image_data = output_images[position]
+        if not output_image_data:
+            raise ProcessingError("ComfyUI processing failed", details=f"No output image for variant {index}")
+        
+        output_artifact = artifact_store.put("output", output_image_data) if SAVE_OUTPUTS_LOCALLY else None
+        results[index] = make_output_result(output_image_data, variant_prompt, seed, output_artifact=output_artifact,
+                                            profile=profile)
+        if cache_key:
+            result_cache.put(cache_key, output_image_data, results[index]["output_mime_type"])
+
+def batch_result(template, image_data, prompt, results, pending, input_filename, input_artifact, workflow, profile):
+    """The batch response body, variants in request order"""
+    logger.info("Batch of %d completed (%d from cache)", len(results), len(results) - len(pending))
+    return {
+        "variants": results,
+        "prompt": prompt,
+        "input_filename": input_filename or staged_input_name(image_data)[0],
+        "input_artifact": input_artifact,
+        "workflow_nodes": len(workflow) if workflow else len(template.profile_graph(profile))
+    }
+
+def run_batch_pipeline(image_data, prompt, variants, deterministic_seed=DETERMINISTIC_SEEDS,
+                       profile=WORKFLOW_DEFAULT_PROFILE, progress=None):
+    """Run several prompt/seed variants of one input image as a single ComfyUI graph
+
+    LoadImage, resize, Canny and the model loaders run once; only the nodes
+    downstream of a slot that differs between variants are duplicated.
+    """
+    template = get_workflow_template()
+    if not template.current():
+        raise ProcessingError(
+            "Workflow not found",
+            details=f"Could not load {WORKFLOW_FILE}",
+            suggestion="Ensure the workflow JSON file exists in the project root"
+        )
+    
+    input_hash, results, pending = plan_batch_variants(template, image_data, prompt, variants, deterministic_seed,
+                                                       profile)
+    workflow = None
+    input_filename = None
+    input_artifact = None
+    if pending:
+        with get_backend_pool().lease(affinity=(input_hash, prompt)) as backend:
+            ensure_comfyui_ready(backend)
+            if progress:
+                progress("stage", {"stage": "staging_input"})
+            input_filename = stage_job_input(image_data, backend.server_address)
+            if SAVE_INPUTS_LOCALLY:
+                input_artifact = artifact_store.put("input", image_data)
+            
+            workflow, select_variant_images = build_batch_workflow(template, input_filename, pending, profile)
+            output_images = execute_workflow(workflow, output_selector=select_variant_images, progress=progress,
+                                             server_address=backend.server_address)
+        
+        collect_batch_outputs(results, pending, output_images, profile)
+    
+    return batch_result(template, image_data, prompt, results, pending, input_filename, input_artifact, workflow,
+                        profile)
+
+def request_fingerprint(input_hash, prompt, pipeline, options):
+    """Identity of a generation request: same input, prompt, pipeline and parameters (seed included when given)"""
+    material = json.dumps({
+        "input": input_hash,
+        "prompt": prompt,
+        "pipeline": pipeline.__name__,
+        "options": options
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class JobQueueFullError(Exception):
+    """The admission queue, or the submitting client's share of it, is full"""
+    def __init__(self, message, retry_after=1, reason="queue_full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class Job:
+    def __init__(self, image_data, prompt, options=None, pipeline=None, timings=None,
+                 client_id=None, lane=ADMISSION_DEFAULT_LANE):
+        self.id = str(uuid.uuid4())
+        self.image_data = image_data
+        self.prompt = prompt
+        self.options = options or {}
+        self.pipeline = pipeline or run_generation_pipeline
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.draft = None  # Draft-profile result of a progressive job, available before it finishes
+        self.error = None
+        self.error_status = None
+        self.stage = "queued"
+        self.current_node = None
+        self.progress = None
+        self.queue_position = None
+        self.prompt_id = None
+        self.backend = None
+        self.cached_nodes = 0  # Workflow nodes ComfyUI answered from its cache for this job
+        self.client_id = client_id
+        self.lane = lane
+        # What ComfyUI can reuse between jobs: the image branch (LoadImage, resize, Canny) and the prompt encoding
+        self.affinity = (hashlib.sha256(image_data).hexdigest(), prompt)
+        # Identical requests arriving while this one is in flight attach to it instead of generating again
+        self.fingerprint = request_fingerprint(self.affinity[0], prompt, self.pipeline, self.options)
+        self.attached = 1  # Requests waiting on this job, more than one after single-flight merging
+        self.admission = None  # AdmissionQueue while the job waits in it
+        self.cancel_reason = None
+        self.last_seen = self.created_at  # Last time a client asked about the job
+        self.streamed = False  # Had an SSE client, only such jobs count as abandoned once it goes away
+        self.timings = dict(timings or {})  # stage -> seconds
+        self._timing_stage = "queued"
+        self._timing_started = self.created_at
+        self._done = threading.Event()
+        self._subscribers = []
+        self._events_lock = threading.Lock()
+        self._last_preview_at = 0
+        self._worker_thread = None
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def subscribe(self, previews=False, events=None):
+        """Register an event queue for an SSE client
+
+        events defaults to a bounded queue.Queue; any queue whose put_nowait
+        raises queue.Full when it is full will do.
+        """
+        if events is None:
+            events = queue.Queue(maxsize=JOB_EVENT_BUFFER)
+        with self._events_lock:
+            self._subscribers.append((events, previews))
+            self.streamed = True
+        return events
+
+    def unsubscribe(self, events):
+        with self._events_lock:
+            self._subscribers = [(q, previews) for q, previews in self._subscribers if q is not events]
+        # The abandon timeout runs from when the last stream went away
+        self.touch()
+
+    @property
+    def subscribed(self):
+        with self._events_lock:
+            return bool(self._subscribers)
+
+    def publish(self, event_type, data):
+        """Record a progress event and fan it out to subscribers"""
+        if event_type == "stage":
+            self.stage = data["stage"]
+            self.enter_timing_stage(data["stage"])
+        elif event_type == "node":
+            self.current_node = data["node"]
+            self.progress = None
+        elif event_type == "progress":
+            self.progress = {"value": data["value"], "max": data["max"]}
+        elif event_type == "queue":
+            self.queue_position = data["position"]
+        elif event_type == "cached":
+            self.cached_nodes += len(data["nodes"])
+        elif event_type == "submitted":
+            self.prompt_id = data["prompt_id"]
+            self.backend = data["backend"]
+            # Time until ComfyUI starts on it, unless execution_start already beat us here
+            self.enter_timing_stage("comfyui_queued", after="submitting")
+        elif event_type == "preview":
+            data = self._encode_preview(data)
+            if data is None:
+                return
+        elif event_type == "draft":
+            # Subscribers get a link, the bytes stay on the job
+            self.draft = data
+            data = {"job_id": self.id, "image_url": f"/api/jobs/{self.id}/image?draft=1",
+                    "seed": data["seed"], "cached": data["cached"]}
+        
+        with self._events_lock:
+            subscribers = list(self._subscribers)
+        for events, previews in subscribers:
+            if event_type == "preview" and not previews:
+                continue
+            try:
+                events.put_nowait((event_type, data))
+            except queue.Full:
+                pass  # A stalled client loses intermediate events, not the stream
+        
+        # Events the pipeline publishes from its own thread double as cancellation points
+        if (self.cancel_reason is not None and self.status == "running"
+                and threading.current_thread() is self._worker_thread):
+            if event_type == "submitted":
+                # Queued just before the cancel arrived, so nobody has cancelled the prompt yet
+                cancel_prompt(self.prompt_id, self.backend, self.cancel_reason)
+            raise JobCancelledError(details=self.cancel_reason)
+
+    def enter_timing_stage(self, stage, after=None):
+        """Close the running stage timer and start the next (None just closes it)"""
+        now = time.time()
+        with self._events_lock:
+            if after is not None and self._timing_stage != after:
+                return
+            if self._timing_stage is not None:
+                elapsed = now - self._timing_started
+                self.timings[self._timing_stage] = self.timings.get(self._timing_stage, 0) + elapsed
+                metrics.observe("isogen_stage_seconds", elapsed, stage=self._timing_stage)
+            self._timing_stage = stage
+            self._timing_started = now
+
+    def record_timing(self, stage, seconds):
+        self.timings[stage] = seconds
+        metrics.observe("isogen_stage_seconds", seconds, stage=stage)
+
+    def rounded_timings(self):
+        return {stage: round(seconds, 4) for stage, seconds in self.timings.items()}
+
+    def _encode_preview(self, image_data):
+        """Downscale a sampler preview to a small JPEG, capped to PREVIEW_MAX_FPS"""
+        now = time.time()
+        with self._events_lock:
+            if not any(previews for _, previews in self._subscribers):
+                return None
+            if now - self._last_preview_at < 1.0 / PREVIEW_MAX_FPS:
+                return None
+            self._last_preview_at = now
+        try:
+            image = Image.open(io.BytesIO(image_data))
+            image.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+            buffer = io.BytesIO()
+            image.convert("RGB").save(buffer, "JPEG", quality=PREVIEW_JPEG_QUALITY)
+        except Exception as e:
+            logger.warning("Could not encode preview: %s", e)
+            return None
+        return {"image": f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode()}"}
+
+    def touch(self):
+        self.last_seen = time.time()
+
+    def cancel(self, reason):
+        """Ask the running pipeline to stop, cancelling its ComfyUI prompt if it has one
+
+        The pipeline thread notices at its next stage, or wakes from the
+        ComfyUI wait when the prompt is cancelled. Returns False if the job
+        had already finished or been cancelled.
+        """
+        with self._events_lock:
+            if self.finished or self.cancel_reason is not None:
+                return False
+            self.cancel_reason = reason
+            prompt_id, backend = self.prompt_id, self.backend
+        logger.info("Cancelling job %s: %s", self.id, reason)
+        if prompt_id:
+            cancel_prompt(prompt_id, backend, reason)
+        return True
+
+    def start(self):
+        self._worker_thread = threading.current_thread()
+        self.status = "running"
+        self.started_at = time.time()
+        logger.debug("Job %s started", self.id)
+        self.publish("stage", {"stage": "preparing"})
+
+    def fail(self, e):
+        """Record a pipeline exception as the job's error payload"""
+        if self.cancel_reason is not None and not isinstance(e, JobCancelledError):
+            # Whatever the cancelled prompt failed with (e.g. execution_interrupted), it was us
+            e = JobCancelledError(details=self.cancel_reason)
+        if isinstance(e, ProcessingError):
+            self.error = e.to_dict()
+            self.error_status = e.status_code
+        else:
+            logger.error("Job %s failed", self.id, exc_info=e)
+            self.error = {
+                "error": "Server processing failed",
+                "details": str(e),
+                "traceback": "".join(traceback.format_exception(type(e), e, e.__traceback__)),
+                "timestamp": datetime.now().isoformat()
+            }
+            self.error_status = 500
+        self.status = "cancelled" if isinstance(e, JobCancelledError) else "failed"
+
+    def finish(self):
+        """Close the timings, wake waiters and announce the terminal event"""
+        # The input is no longer needed once the pipeline has run
+        self.image_data = None
+        self.finished_at = time.time()
+        self.enter_timing_stage(None)
+        self.stage = self.status
+        metrics.inc("isogen_jobs_total", status=self.status)
+        metrics.observe("isogen_job_seconds", self.finished_at - self.created_at)
+        self._done.set()
+        self.publish(*self.terminal_event())
+        logger.info("Job %s %s in %.1fs %s", self.id, self.status, self.finished_at - (self.started_at or self.created_at),
+                    " ".join(f"{stage}={seconds:.3f}" for stage, seconds in self.timings.items()))
+
+    def terminal_event(self):
+        """The completed/failed/cancelled event for a finished job"""
+        if self.status in ("failed", "cancelled"):
+            return self.status, {"job_id": self.id, "error": self.error}
+        return "completed", {
+            "job_id": self.id,
+            "result_url": f"/api/jobs/{self.id}/result",
+            "image_url": f"/api/jobs/{self.id}/image",
+            "processing_time": round(self.finished_at - self.started_at, 3)
+        }
+
+    def wait(self, timeout=None):
+        """Block until the job has finished, returns False on timeout"""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        """Status payload for the jobs API (never includes image data)"""
+        info = {
+            "job_id": self.id,
+            "status": self.status,
+            "prompt": self.prompt,
+            "created_at": datetime.fromtimestamp(self.created_at).isoformat(),
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat() if self.started_at else None,
+            "finished_at": datetime.fromtimestamp(self.finished_at).isoformat() if self.finished_at else None,
+            "stage": self.stage,
+            "current_node": self.current_node,
+            "progress": self.progress,
+            "queue_position": self.queue_position,
+            "prompt_id": self.prompt_id,
+            "backend": self.backend,
+            "cached_nodes": self.cached_nodes,
+            "attached_requests": self.attached,
+            "lane": self.lane,
+            "timings": self.rounded_timings(),
+        }
+        admission = self.admission
+        if self.status == "queued" and admission is not None:
+            ahead = admission.position(self)
+            if ahead is not None:
+                info["jobs_ahead"] = ahead
+                info["estimated_wait_seconds"] = admission.estimate_wait(ahead)
+        if self.started_at:
+            end = self.finished_at or time.time()
+            info["elapsed_seconds"] = round(end - self.started_at, 3)
+        if self.draft is not None:
+            info["draft_image_url"] = f"/api/jobs/{self.id}/image?draft=1"
+        if self.error:
+            info["error"] = self.error
+        if self.cancel_reason:
+            info["cancel_reason"] = self.cancel_reason
+        return info
+
+class AdmissionQueue:
+    """Bounded queue of waiting jobs, served by priority lane and round-robin across clients
+
+    Each lane keeps one FIFO per client. pop() takes from the highest lane
+    with work and rotates through that lane's clients, so a client that
+    submits many jobs waits behind its own work rather than everyone else's.
+    A client whose next job shares the input image or prompt of the job just
+    dispatched may go out of turn, up to affinity_run times in a row, so
+    ComfyUI sees those jobs back to back and reuses its cached nodes.
+    Requests merged into a job count against their own client's limit until
+    the job finishes or they detach.
+    """
+    def __init__(self, lanes=ADMISSION_LANES, max_pending=JOB_QUEUE_LIMIT, max_per_client=ADMISSION_MAX_PER_CLIENT,
+                 slots=JOB_WORKERS, job_seconds=None, affinity_run=ADMISSION_AFFINITY_RUN):
+        self.lanes = lanes
+        self.max_pending = max_pending
+        self.max_per_client = max_per_client
+        self.affinity_run = affinity_run
+        self.slots = slots
+        self.job_seconds = job_seconds or (lambda: POOL_DEFAULT_JOB_SECONDS)
+        self._lanes = {lane: OrderedDict() for lane in lanes}  # lane -> client -> deque of jobs
+        self._active = {}  # client -> queued + running jobs
+        self._holders = {}  # queued or running job -> {client: requests attached to it}
+        self._pending = 0
+        self._rejected = {}
+        self._last_affinity = None
+        self._out_of_turn = 0
+        self._lock = threading.Lock()
+
+    def push(self, job):
+        """Queue a job behind its client's earlier ones, raises JobQueueFullError when over a limit"""
+        if job.lane not in self._lanes:
+            raise ValueError(f"Unknown priority lane {job.lane!r} (expected one of {', '.join(self.lanes)})")
+        with self._lock:
+            self._check_client_locked(job.client_id)
+            if self._pending >= self.max_pending:
+                self._rejected["queue_full"] = self._rejected.get("queue_full", 0) + 1
+                raise JobQueueFullError(f"{self._pending} jobs already waiting",
+                                        retry_after=self._retry_after(1.0 / max(self.slots, 1)))
+            self._lanes[job.lane].setdefault(job.client_id, deque()).append(job)
+            self._active[job.client_id] = self._active.get(job.client_id, 0) + 1
+            self._holders[job] = {job.client_id: 1}
+            self._pending += 1
+            job.admission = self
+            return self._pending
 
-# Ensure directories exist
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+    def attach(self, job, client_id):
+        """Count a request merged into a queued or running job against its client
 
-class ComfyUIClient:
-    def __init__(self, server_address="127.0.0.1:8188"):
-        self.server_address = server_address
-        self.client_id = str(uuid.uuid4())
-        
-    def queue_prompt(self, prompt):
-        """Queue a prompt for processing"""
-        p = {"prompt": prompt, "client_id": self.client_id}
-        data = json.dumps(p).encode('utf-8')
-        req = requests.post(f"http://{self.server_address}/prompt", data=data, 
-                           headers={'Content-Type': 'application/json'})
-        return req.json()
+        Raises JobQueueFullError when the client is at its limit, returns
+        False if the job already finished and can't be merged into.
+        """
+        with self._lock:
+            holders = self._holders.get(job)
+            if holders is None:
+                return False
+            self._check_client_locked(client_id)
+            holders[client_id] = holders.get(client_id, 0) + 1
+            self._active[client_id] = self._active.get(client_id, 0) + 1
+            job.attached += 1
+            return True
 
-    def get_image(self, filename, subfolder, folder_type):
-        """Get an image from ComfyUI"""
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = "&".join([f"{k}={quote(str(v))}" for k, v in data.items()])
-        response = requests.get(f"http://{self.server_address}/view?{url_values}")
-        return response.content
+    def detach(self, job, client_id):
+        """Drop one of client_id's requests from a job, returns False if the client has none attached"""
+        with self._lock:
+            holders = self._holders.get(job)
+            if not holders or not holders.get(client_id):
+                return False
+            holders[client_id] -= 1
+            if not holders[client_id]:
+                del holders[client_id]
+            self._release_locked(client_id)
+            job.attached -= 1
+            return True
 
-    def get_history(self, prompt_id):
-        """Get the history for a prompt"""
-        response = requests.get(f"http://{self.server_address}/history/{prompt_id}")
-        return response.json()
+    def holds(self, job, client_id):
+        """True while client_id has a request attached to the unfinished job"""
+        with self._lock:
+            return bool(self._holders.get(job, {}).get(client_id))
 
-    def get_images(self, ws, prompt):
-        """Get images from a workflow via WebSocket"""
-        queue_result = self.queue_prompt(prompt)
-        print(f"✅ Queue result: {queue_result}")
-        
-        # Handle different response formats
-        if 'prompt_id' in queue_result:
-            prompt_id = queue_result['prompt_id']
-        elif 'exec_info' in queue_result and 'queue_size' in queue_result['exec_info']:
-            # Alternative response format
-            prompt_id = queue_result.get('exec_info', {}).get('queue_size', str(uuid.uuid4()))
-        else:
-            print(f"❌ Unexpected queue response format: {queue_result}")
-            raise Exception(f"Cannot find prompt_id in response: {queue_result}")
-            
-        print(f"✅ Using prompt_id: {prompt_id}")
-        output_images = {}
-        
-        while True:
-            try:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message['type'] == 'executing':
-                        data = message['data']
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            break  # Execution is done
+    def pop(self):
+        """Next job in fair order, or None when nothing waits"""
+        with self._lock:
+            for clients in self._lanes.values():
+                if not clients:
+                    continue
+                client_id = next(iter(clients))
+                if self._out_of_turn < self.affinity_run:
+                    warm = next((other for other, jobs in clients.items()
+                                 if affinity_overlap(jobs[0].affinity, self._last_affinity)), None)
+                    if warm is not None:
+                        client_id = warm
+                self._out_of_turn = self._out_of_turn + 1 if client_id != next(iter(clients)) else 0
+                jobs = clients[client_id]
+                job = jobs.popleft()
+                if jobs:
+                    clients.move_to_end(client_id)
                 else:
-                    continue  # previews are binary data
-            except websocket.WebSocketConnectionClosedException:
-                break
-                
-        history = self.get_history(prompt_id)[prompt_id]
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    image_data = self.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-                output_images[node_id] = images_output
-
-        return output_images
+                    del clients[client_id]
+                self._pending -= 1
+                self._last_affinity = job.affinity
+                job.admission = None
+                return job
+        return None
 
-def load_workflow():
-    """Load the ComfyUI workflow from JSON file"""
-    try:
-        if not os.path.exists(WORKFLOW_FILE):
-            print(f"❌ Workflow file not found: {WORKFLOW_FILE}")
-            return None
-            
-        with open(WORKFLOW_FILE, 'r') as f:
-            workflow = json.load(f)
-        print(f"✅ Loaded workflow with {len(workflow)} nodes")
-        return workflow
-    except Exception as e:
-        print(f"❌ Error loading workflow: {e}")
+    def promote(self, job, lane):
+        """Move a waiting job up to a higher-priority lane, returns False if it isn't waiting or already ranks as high
+
+        Used when a request merges into an identical job, so an interactive
+        request never inherits the place of a bulk one.
+        """
+        with self._lock:
+            if lane not in self._lanes or self.lanes.index(lane) >= self.lanes.index(job.lane):
+                return False
+            jobs = self._lanes[job.lane].get(job.client_id)
+            if not jobs or job not in jobs:
+                return False
+            jobs.remove(job)
+            if not jobs:
+                del self._lanes[job.lane][job.client_id]
+            self._lanes[lane].setdefault(job.client_id, deque()).append(job)
+            job.lane = lane
+            return True
+
+    def remove(self, job):
+        """Take a job out before it was dispatched, returns False if it already left the queue"""
+        with self._lock:
+            jobs = self._lanes.get(job.lane, {}).get(job.client_id)
+            if not jobs or job not in jobs:
+                return False
+            jobs.remove(job)
+            if not jobs:
+                del self._lanes[job.lane][job.client_id]
+            self._pending -= 1
+            job.admission = None
+            self._release_job_locked(job)
+            return True
+
+    def done(self, job):
+        """A dispatched job finished, freeing the share of every client attached to it"""
+        with self._lock:
+            self._release_job_locked(job)
+
+    def position(self, job):
+        """Jobs that will be dispatched before this one if nothing else arrives, None if not queued"""
+        with self._lock:
+            ahead = 0
+            for clients in self._lanes.values():
+                queues = [list(jobs) for jobs in clients.values()]
+                for depth in range(max((len(jobs) for jobs in queues), default=0)):
+                    for jobs in queues:
+                        if depth < len(jobs):
+                            if jobs[depth] is job:
+                                return ahead
+                            ahead += 1
         return None
 
-def update_workflow_for_processing(workflow, image_filename, prompt_text):
-    """Update workflow with new image and prompt"""
-    try:
-        updated_workflow = workflow.copy()
-        
-        # Update image input (node 100 - LoadImage)
-        if "100" in updated_workflow:
-            updated_workflow["100"]["inputs"]["image"] = image_filename
-            print(f"✅ Updated image input: {image_filename}")
-        else:
-            print("⚠️ LoadImage node (100) not found in workflow")
-
-        # Update positive prompt (node 98 - CLIPTextEncode)
-        if "98" in updated_workflow:
-            original_prompt = updated_workflow["98"]["inputs"]["text"]
-            # Enhance the prompt with architectural keywords
-            enhanced_prompt = f"ismtrcbldng, hyperrealistic photograph, white background, plain white background,  isometric view, architectural visualization, detailed building, {prompt_text}, {original_prompt}"
-            updated_workflow["98"]["inputs"]["text"] = enhanced_prompt
-            print(f"✅ Updated prompt: {enhanced_prompt[:100]}...")
+    def estimate_wait(self, ahead):
+        """Rough seconds until a job with `ahead` jobs in front of it starts"""
+        return round((ahead // max(self.slots, 1) + 1) * self.job_seconds(), 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "max_per_client": self.max_per_client,
+                "lanes": {lane: sum(len(jobs) for jobs in clients.values()) for lane, clients in self._lanes.items()},
+                "clients": len(self._active),
+                "rejected": dict(self._rejected)
+            }
+
+    def _retry_after(self, jobs):
+        return max(1, math.ceil(jobs * self.job_seconds()))
+
+    def _check_client_locked(self, client_id):
+        if self._active.get(client_id, 0) >= self.max_per_client:
+            self._rejected["client_limit"] = self._rejected.get("client_limit", 0) + 1
+            raise JobQueueFullError(f"Client already has {self._active[client_id]} jobs queued or running",
+                                    retry_after=self._retry_after(1), reason="client_limit")
+
+    def _release_job_locked(self, job):
+        for client_id, count in self._holders.pop(job, {}).items():
+            for _ in range(count):
+                self._release_locked(client_id)
+
+    def _release_locked(self, client_id):
+        remaining = self._active.get(client_id, 0) - 1
+        if remaining > 0:
+            self._active[client_id] = remaining
         else:
-            print("⚠️ Positive prompt node (98) not found in workflow")
-            
-        # Generate random seed for variety
-        import random
-        random_seed = random.randint(1, 2**32 - 1)
-        
-        # Update seed in KSampler (node 109)
-        if "109" in updated_workflow:
-            updated_workflow["109"]["inputs"]["noise_seed"] = random_seed
-            print(f"✅ Updated seed: {random_seed}")
-            
-        return updated_workflow
-        
-    except Exception as e:
-        print(f"❌ Error updating workflow: {e}")
-        return None
+            self._active.pop(client_id, None)
 
-def check_comfyui_connection():
-    """Check if ComfyUI is running and accessible"""
-    try:
-        response = requests.get(f"{COMFY_UI_URL}/system_stats", timeout=10)
-        if response.status_code == 200:
-            stats = response.json()
-            print(f"✅ ComfyUI connected - System: {stats.get('system', {})}")
+class JobManager:
+    """Runs generation jobs on a bounded worker pool and keeps their results for a while
+
+    Jobs wait in an AdmissionQueue; each worker takes the next one in fair
+    order as soon as it is free, so dispatch order follows lanes and clients
+    rather than arrival.
+    """
+    def __init__(self, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_LIMIT, ttl=JOB_RESULT_TTL):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.admission = AdmissionQueue(max_pending=max_pending, slots=max_workers,
+                                        job_seconds=lambda: get_backend_pool().average_latency())
+        self._work_ready = threading.Condition()
+        self._workers = []
+        self._jobs = {}
+        self._in_flight = {}  # fingerprint -> unfinished job, for single-flight merging
+        self._lock = threading.Lock()
+
+    def submit(self, image_data, prompt, pipeline=None, timings=None, client_id=None, lane=None, **options):
+        """Register a new job and queue it for the workers, raises JobQueueFullError when admission is refused
+
+        A request identical to an unfinished job (same fingerprint) is merged
+        into it: the existing job is returned and nothing new is queued, but
+        the request still counts against its client's admission limit.
+        """
+        job = Job(image_data, prompt, options, pipeline, timings, client_id, lane or ADMISSION_DEFAULT_LANE)
+        with self._lock:
+            self._prune_locked()
+            running = self._in_flight.get(job.fingerprint)
+            if (running is not None and not running.finished and running.cancel_reason is None
+                    and self.admission.attach(running, job.client_id)):
+                running.touch()
+                if self.admission.promote(running, job.lane):
+                    logger.info("Job %s promoted to lane %s by a merged request", running.id, running.lane)
+                metrics.inc("isogen_jobs_merged_total")
+                logger.info("Request merged into in-flight job %s (%d attached)", running.id, running.attached)
+                return running
+            pending = self.admission.push(job)
+            self._in_flight[job.fingerprint] = job
+            self._jobs[job.id] = job
+            if not self._workers:
+                self._start_workers_locked()
+        with self._work_ready:
+            self._work_ready.notify()
+        logger.info("Job %s queued in lane %s (%d waiting)", job.id, job.lane, pending)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.max_workers, "max_pending": self.max_pending, "jobs": counts,
+                "admission": self.admission.stats()}
+
+    def _start_workers_locked(self):
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._worker, name=f"comfy-job_{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        threading.Thread(target=self._housekeep, name="comfy-job-housekeeping", daemon=True).start()
+
+    def _worker(self):
+        while True:
+            with self._work_ready:
+                job = self.admission.pop()
+                while job is None:
+                    self._work_ready.wait()
+                    job = self.admission.pop()
+            try:
+                self._run(job)
+            finally:
+                self.admission.done(job)
+
+    def cancel(self, job, reason="Cancelled by the client", detach=True, client_id=None):
+        """Cancel a job wherever it is: still queued here, or submitted to ComfyUI
+
+        With detach, client_id only removes its own request: a job other
+        merged requests still wait on keeps running, and a client with no
+        request attached can't cancel it. Returns False if the job had already
+        finished or client_id has nothing to detach.
+        """
+        with self._lock:
+            if detach and not job.finished:
+                if client_id is not None and not self.admission.holds(job, client_id):
+                    return False
+                if job.attached > 1:
+                    self.admission.detach(job, client_id if client_id is not None else job.client_id)
+                    logger.info("Request detached from job %s: %s (%d still attached)", job.id, reason, job.attached)
+                    return True
+            # Nobody may attach to a job on its way out
+            if self._in_flight.get(job.fingerprint) is job:
+                del self._in_flight[job.fingerprint]
+        if self.admission.remove(job):
+            job.cancel_reason = reason
+            job.fail(JobCancelledError(details=reason))
+            job.finish()
+            logger.info("Job %s cancelled before it started: %s", job.id, reason)
             return True
-        else:
-            print(f"❌ ComfyUI returned status: {response.status_code}")
-            return False
-    except requests.exceptions.ConnectionError:
-        print("❌ ComfyUI connection refused - is it running on localhost:8188?")
-        return False
-    except Exception as e:
-        print(f"❌ ComfyUI connection error: {e}")
-        return False
+        return job.cancel(reason)
 
-def check_required_models():
-    """Check if required models are available"""
+    def _housekeep(self):
+        """Expire finished jobs and reap abandoned ones on a timer, so neither waits for the next submission"""
+        while True:
+            time.sleep(min(JOB_ABANDON_AFTER / 2, JOB_HOUSEKEEPING_INTERVAL) if JOB_ABANDON_AFTER
+                       else JOB_HOUSEKEEPING_INTERVAL)
+            with self._lock:
+                self._prune_locked()
+            if JOB_ABANDON_AFTER:
+                self._reap_abandoned()
+
+    def _reap_abandoned(self):
+        """Cancel unfinished jobs whose event streams went away and nobody asked about for JOB_ABANDON_AFTER seconds
+
+        Jobs submitted to be fetched later (POST /api/jobs, ?response=url
+        without an event stream) are never reaped.
+        """
+        cutoff = time.time() - JOB_ABANDON_AFTER
+        with self._lock:
+            abandoned = [job for job in self._jobs.values()
+                         if not job.finished and job.streamed and job.last_seen < cutoff and not job.subscribed]
+        for job in abandoned:
+            self.cancel(job, f"Abandoned: nobody followed the job for {JOB_ABANDON_AFTER}s", detach=False)
+
+    def _run(self, job):
+        try:
+            job.start()
+            job.result = job.pipeline(job.image_data, job.prompt, progress=job.publish, **job.options)
+            job.status = "completed"
+        except Exception as e:
+            job.fail(e)
+        finally:
+            job.finish()
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        for fingerprint in [fingerprint for fingerprint, job in self._in_flight.items() if job.finished]:
+            del self._in_flight[fingerprint]
+
+job_manager = JobManager()
+
+def parse_generation_request():
+    """Extract image bytes and prompt from a JSON, multipart or raw image body
+
+    Returns (params, error_response).
+    """
+    started = time.perf_counter()
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("image")
+        image_data = upload.read() if upload else None
+        fields = request.form
+    elif request.mimetype.startswith("image/"):
+        image_data = request.get_data()
+        fields = request.args
+    else:
+        fields = request.get_json(silent=True)
+        if not fields or 'image' not in fields:
+            return None, (jsonify({"error": "No image data provided"}), 400)
+        try:
+            image_data = decode_base64_image(fields['image'])
+        except Exception as e:
+            return None, (jsonify({"error": "Invalid image data", "details": str(e)}), 400)
+    
+    if not image_data:
+        return None, (jsonify({"error": "No image data provided"}), 400)
+    timings = {"decode": time.perf_counter() - started}
+    metrics.observe("isogen_stage_seconds", timings["decode"], stage="decode")
+    
+    if INPUT_NORMALIZE:
+        try:
+            image_data, timings["normalize"] = timed_normalize_input(image_data)
+        except ValueError as e:
+            return None, (jsonify({"error": "Invalid image data", "details": str(e)}), 400)
+    
     try:
-        # Check available models
-        models_response = requests.get(f"{COMFY_UI_URL}/object_info")
-        if models_response.status_code != 200:
-            return False, "Could not get model info from ComfyUI"
-            
-        object_info = models_response.json()
-        
-        # Check for required components
-        required_checks = {
-            "VAELoader": ["ae.safetensors"],
-            "DualCLIPLoader": ["t5xxl_fp8_e4m3fn.safetensors", "clip_l.safetensors"],
-            "UNETLoader": ["flux1CannyDevFp8_v10.safetensors"],
-            "Load Lora": ["isometric_bld_000001500.safetensors"]
-        }
-        
-        missing_models = []
-        
-        for node_type, model_files in required_checks.items():
-            if node_type in object_info:
-                available_models = object_info[node_type]["input"]["required"]
-                for model_file in model_files:
-                    # This is a simplified check - in reality you'd need to check the actual model lists
-                    print(f"ℹ️ Checking for model: {model_file}")
-            else:
-                missing_models.append(f"Node type {node_type} not available")
-        
-        if missing_models:
-            return False, f"Missing components: {', '.join(missing_models)}"
-            
-        return True, "All required models appear to be available"
-        
-    except Exception as e:
-        return False, f"Error checking models: {e}"
+        options = parse_generation_options(fields)
+        # Checked now so a bad rendition doesn't surface only after the GPU work
+        parse_rendition(request.args)
+    except ValueError as e:
+        return None, (jsonify({"error": "Invalid parameters", "details": str(e)}), 400)
+    
+    lane = fields.get('priority') or None
+    if lane is not None and lane not in ADMISSION_LANES:
+        return None, (jsonify({"error": "Invalid parameters",
+                               "details": f"priority must be one of {', '.join(ADMISSION_LANES)}"}), 400)
+    client_id = request_client_id(fields)
+    
+    prompt = normalize_prompt(fields.get('prompt') or "") or DEFAULT_PROMPT
+    logger.debug("Generation request: %d image bytes (%s), prompt %.100r",
+                 len(image_data), request.mimetype or "no content type", prompt)
+    return {"image_data": image_data, "prompt": prompt, "options": options, "fields": fields, "timings": timings,
+            "client_id": client_id, "lane": lane}, None
+
+def request_client_id(fields=None):
+    """Whom a request counts against: the X-Client-Id header, the client_id field, then the remote address"""
+    fields = request.args if fields is None else fields
+    return request.headers.get(ADMISSION_CLIENT_HEADER) or fields.get('client_id') or request.remote_addr
+
+def timed_normalize_input(image_data):
+    """normalize_input_image() for the request path, returns (image bytes, seconds spent)"""
+    started = time.perf_counter()
+    normalized, info = normalize_input_image(image_data, input_target_side(get_workflow_template()))
+    elapsed = time.perf_counter() - started
+    metrics.observe("isogen_stage_seconds", elapsed, stage="normalize")
+    metrics.inc("isogen_input_bytes_total", info["source_bytes"], stage="received")
+    metrics.inc("isogen_input_bytes_total", info["bytes"], stage="normalized")
+    logger.debug("Normalized input %sx%s %s (%d bytes) -> %sx%s (%d bytes) in %.3fs",
+                 *info["source_size"], info["source_mode"], info["source_bytes"], *info["size"], info["bytes"], elapsed)
+    return normalized, elapsed
+
+def parse_flag(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+def parse_generation_options(fields):
+    """Optional generation parameters shared by the JSON, multipart and raw request formats"""
+    options = {}
+    if fields.get('seed') not in (None, ""):
+        seed = int(fields['seed'])
+        if not 0 <= seed < 2**64:
+            raise ValueError("seed must be between 0 and 2^64 - 1")
+        options["seed"] = seed
+    if fields.get('deterministic_seed') not in (None, ""):
+        options["deterministic_seed"] = parse_flag(fields['deterministic_seed'])
+    if fields.get('profile') not in (None, ""):
+        if fields['profile'] not in WORKFLOW_PROFILES:
+            raise ValueError(f"profile must be one of {', '.join(WORKFLOW_PROFILES)}")
+        options["profile"] = fields['profile']
+    if fields.get('progressive') not in (None, ""):
+        options["progressive"] = parse_flag(fields['progressive'])
+    return options
+
+def rendition_url(url, size):
+    return f"{url}{'&' if '?' in url else '?'}size={size}&format=auto"
 
-def copy_to_comfyui_input(source_path, filename):
-    """Copy image to ComfyUI's input directory"""
+def output_payload(result, image_url, rendition=None):
+    """JSON form of an output result, base64 only for JSON clients (binary clients use image_url)
+
+    With a rendition the inlined image is the transcoded variant instead of
+    the full-size original.
+    """
+    payload = {k: v for k, v in result.items() if k != "output_data"}
+    data, mime_type = result["output_data"], result["output_mime_type"]
+    if rendition:
+        data, mime_type = get_rendition(data, result["output_etag"], rendition)
+    payload["output_image"] = f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+    payload["image_url"] = image_url
+    payload["thumbnail_url"] = rendition_url(image_url, "thumb")
+    if result.get("output_artifact"):
+        payload["artifact_url"] = f"/api/artifacts/{result['output_artifact']}"
+    return payload
+
+def job_result_payload(job, rendition=None):
+    """JSON body for a completed job"""
+    started = time.perf_counter()
+    if "variants" in job.result:
+        result = dict(job.result)
+        result["variants"] = [output_payload(variant, f"/api/jobs/{job.id}/image?variant={index}", rendition)
+                              for index, variant in enumerate(job.result["variants"])]
+    else:
+        result = output_payload(job.result, f"/api/jobs/{job.id}/image", rendition)
+    result["success"] = True
+    result["job_id"] = job.id
+    result["processing_time"] = round(job.finished_at - job.started_at, 3)
+    if job.draft is not None:
+        result["draft_image_url"] = f"/api/jobs/{job.id}/image?draft=1"
+    if "encode" not in job.timings:
+        # Once per job: clients polling a finished job would otherwise flood the histogram
+        job.record_timing("encode", time.perf_counter() - started)
+    result["timings"] = job.rounded_timings()
+    return result
+
+def job_result_response(job):
+    """Build the JSON response for a finished job, inlining a rendition if the query asks for one"""
+    if job.status in ("failed", "cancelled"):
+        return jsonify(job.error), job.error_status or 500
     try:
-        # Common ComfyUI input directories - add user's specific path first
-        possible_paths = [
-            "C:/ComfyUI/ComfyUI/input",  # User's specific path
-            "C:\\ComfyUI\\ComfyUI\\input",  # Windows backslash version
-            "ComfyUI/input",
-            "../ComfyUI/input", 
-            "../../ComfyUI/input",
-            os.path.expanduser("~/ComfyUI/input"),
-            "C:/ComfyUI/input",
-            # Check if ComfyUI is in the same directory structure
-            os.path.join(os.path.dirname(__file__), "..", "ComfyUI", "input"),
-        ]
-        
-        # Try to find ComfyUI input directory
-        comfyui_input_dir = None
-        for path in possible_paths:
-            if os.path.exists(path):
-                comfyui_input_dir = path
-                print(f"✅ Found ComfyUI input directory: {path}")
-                break
-        
-        if not comfyui_input_dir:
-            # Try to auto-detect based on ComfyUI API
-            try:
-                # Get system info from ComfyUI to find its location
-                response = requests.get(f"{COMFY_UI_URL}/system_stats")
-                if response.status_code == 200:
-                    # ComfyUI is running, but we need to find its directory
-                    # Let's try a few more common locations
-                    additional_paths = [
-                        USER_COMFY_PATH,
-                        os.path.join(os.path.expanduser("~"), "Desktop", "ComfyUI", "input"),
-                        os.path.join(os.path.expanduser("~"), "Documents", "ComfyUI", "input"),
-                    ]
-                    
-                    for path in additional_paths:
-                        if os.path.exists(path):
-                            comfyui_input_dir = path
-                            print(f"✅ Auto-detected ComfyUI input directory: {path}")
-                            break
-            except:
-                pass
-        
-        if not comfyui_input_dir:
-            print("⚠️ Could not find ComfyUI input directory")
-            return None
-            
-        # Copy the file
-        dest_path = os.path.join(comfyui_input_dir, filename)
-        shutil.copy2(source_path, dest_path)
-        print(f"✅ Copied {source_path} to {dest_path}")
-        return dest_path
-        
-    except Exception as e:
-        print(f"⚠️ Error copying to ComfyUI input: {e}")
-        return None
+        rendition = parse_rendition(request.args, request.headers.get("Accept"))
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    return jsonify(job_result_payload(job, rendition))
+
+def job_image_response(job):
+    """Serve a finished job's output image as raw bytes with an ETag"""
+    if job.status in ("failed", "cancelled"):
+        return jsonify(job.error), job.error_status or 500
+    
+    output = job.result
+    if "variants" in output:
+        index = request.args.get("variant", 0, type=int)
+        if not 0 <= index < len(output["variants"]):
+            return jsonify({"error": "Variant not found", "variant": index}), 404
+        output = output["variants"][index]
+    return output_image_response(job, output)
 
-def save_base64_image(image_base64, filename):
-    """Save base64 image data to file"""
+def output_image_response(job, output):
     try:
-        # Remove data URL prefix if present
-        if "data:image" in image_base64:
-            image_base64 = image_base64.split(",")[1]
-        
-        # Decode base64
-        image_data = base64.b64decode(image_base64)
-        
-        # Save to uploads directory
-        filepath = os.path.join(UPLOAD_DIR, filename)
-        with open(filepath, "wb") as f:
-            f.write(image_data)
-            
-        print(f"✅ Saved image: {filepath} ({len(image_data)} bytes)")
-        return filepath
-        
-    except Exception as e:
-        print(f"❌ Error saving image: {e}")
-        raise e
+        response = image_response(output["output_data"], output["output_mime_type"], output["output_etag"])
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    response.headers["Cache-Control"] = "private, max-age=3600"
+    response.headers["X-Job-Id"] = job.id
+    response.headers["Server-Timing"] = ", ".join(f"{stage};dur={seconds * 1000:.1f}"
+                                                  for stage, seconds in job.timings.items())
+    return response.make_conditional(request)
+
+def image_response(data, mime_type, etag):
+    """Response with the image bytes or the rendition the query asks for; raises ValueError for bad parameters"""
+    rendition = parse_rendition(request.args, request.headers.get("Accept"))
+    if rendition is None:
+        response = Response(data, mimetype=mime_type)
+        response.set_etag(etag)
+        return response
+    
+    data, mime_type = get_rendition(data, etag, rendition)
+    response = Response(data, mimetype=mime_type)
+    response.set_etag(rendition_etag(etag, rendition))
+    if rendition["negotiated"]:
+        response.vary.add("Accept")
+    return response
 
-def process_with_comfyui_websocket(workflow_data):
-    """Process workflow using WebSocket connection for real-time updates"""
+def client_disconnected():
+    """True once the client of the current request has closed its connection"""
+    sock = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+    if sock is None:
+        return False
     try:
-        client = ComfyUIClient()
-        
-        # First, try to queue the prompt and get the response
-        print("🔄 Queuing prompt...")
-        queue_result = client.queue_prompt(workflow_data)
-        print(f"📋 Queue response: {queue_result}")
-        
-        # Handle different response formats from ComfyUI
-        prompt_id = None
-        if isinstance(queue_result, dict):
-            if 'prompt_id' in queue_result:
-                prompt_id = queue_result['prompt_id']
-            elif 'exec_info' in queue_result:
-                # Some ComfyUI versions return exec_info
-                exec_info = queue_result['exec_info']
-                if 'queue_size' in exec_info:
-                    print("⚠️ Using alternative method to track processing...")
-                    # We'll use a different approach - polling the queue
-                    return process_with_polling(workflow_data)
-        
-        if not prompt_id:
-            print(f"❌ Could not extract prompt_id from: {queue_result}")
-            # Fallback to polling method
-            return process_with_polling(workflow_data)
-        
-        print(f"✅ Got prompt_id: {prompt_id}")
-        
-        # Connect to WebSocket
-        ws_url = f"ws://127.0.0.1:8188/ws?clientId={client.client_id}"
-        ws = websocket.WebSocket()
-        ws.connect(ws_url)
-        print("✅ Connected to ComfyUI WebSocket")
-        
-        # Monitor execution
-        while True:
-            try:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message['type'] == 'executing':
-                        data = message['data']
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            print("✅ Execution completed")
-                            break  # Execution is done
-                        elif data['node'] is not None:
-                            print(f"🔄 Processing node: {data['node']}")
-                else:
-                    continue  # previews are binary data
-            except websocket.WebSocketConnectionClosedException:
-                print("❌ WebSocket connection closed")
-                break
-                
-        ws.close()
-        
-        # Get the results
-        print("📥 Getting results...")
-        history = client.get_history(prompt_id)[prompt_id]
-        
-        # Find output images
-        output_images = {}
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    image_data = client.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-                output_images[node_id] = images_output
-        
-        if not output_images:
-            raise Exception("No images generated from workflow")
-            
-        # Find the output image (usually from the last save node)
-        output_image_data = None
-        
-        # Look for images in output nodes (typically nodes 107, 118, or similar)
-        for node_id in ["107", "118", "91"]:  # Check common output nodes
-            if node_id in output_images and output_images[node_id]:
-                output_image_data = output_images[node_id][0]  # Get first image
-                print(f"✅ Found output image from node {node_id}")
-                break
-        
-        if not output_image_data:
-            # If no specific output node found, take the last available image
-            if output_images:
-                last_node = list(output_images.keys())[-1]
-                output_image_data = output_images[last_node][0]
-                print(f"✅ Using image from node {last_node}")
-        
-        if not output_image_data:
-            raise Exception("No output image found in workflow results")
-            
-        # Convert to base64
-        image_base64 = base64.b64encode(output_image_data).decode()
-        return f"data:image/png;base64,{image_base64}"
-        
-    except Exception as e:
-        print(f"❌ WebSocket processing error: {e}")
-        print("🔄 Trying polling method as fallback...")
-        return process_with_polling(workflow_data)
+        readable, _, _ = select.select([sock], [], [], 0)
+        # Readable with nothing to read means the peer closed its end
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+def wait_for_client(job, client_id):
+    """Block until the job finishes; detaches client_id and returns False if the client disconnects first"""
+    while not job.wait(JOB_DISCONNECT_POLL):
+        job.touch()
+        if client_disconnected():
+            job_manager.cancel(job, "Client disconnected", client_id=client_id)
+            return False
+    return True
+
+def queue_full_response(e):
+    """429 with Retry-After for a submission the admission queue turned away"""
+    response = jsonify({
+        "error": "Too many pending jobs" if e.reason == "client_limit" else "Job queue full",
+        "details": str(e),
+        "retry_after": e.retry_after,
+        "suggestion": "Retry once some of the running generations have finished"
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or "unknown"
+    metrics.inc("isogen_http_requests_total", endpoint=endpoint, status=response.status_code)
+    if "request_started" in g:
+        metrics.observe("isogen_http_request_seconds", time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@app.errorhandler(ComfyUIUnavailableError)
+def comfyui_unavailable(e):
+    return jsonify({
+        "error": "ComfyUI not available",
+        "details": str(e),
+        "suggestion": "Start ComfyUI with: python main.py --listen"
+    }), 503
+
+def job_accepted_response(job):
+    status = job.to_dict()
+    status["status_url"] = f"/api/jobs/{job.id}"
+    status["result_url"] = f"/api/jobs/{job.id}/result"
+    status["image_url"] = f"/api/jobs/{job.id}/image"
+    return jsonify(status), 202
 
-def process_with_polling(workflow_data):
-    """Fallback method using polling instead of WebSocket"""
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue a generation job and return its id immediately"""
+    params, error_response = parse_generation_request()
+    if error_response:
+        return error_response
+    
     try:
-        client = ComfyUIClient()
-        
-        # Queue the prompt
-        queue_result = client.queue_prompt(workflow_data)
-        print(f"📋 Polling method - Queue result: {queue_result}")
-        
-        # Wait for processing to complete by polling the queue
-        max_wait = 300  # 5 minutes
-        start_time = time.time()
-        last_queue_size = None
-        
-        while time.time() - start_time < max_wait:
-            try:
-                # Check queue status
-                response = requests.get("http://127.0.0.1:8188/queue")
-                if response.status_code == 200:
-                    queue_data = response.json()
-                    running = queue_data.get('queue_running', [])
-                    pending = queue_data.get('queue_pending', [])
-                    current_queue_size = len(running) + len(pending)
-                    
-                    if last_queue_size is not None and current_queue_size < last_queue_size:
-                        print("🔄 Queue size decreased, checking for completion...")
-                    
-                    if current_queue_size == 0:
-                        print("✅ Queue is empty, processing should be complete")
-                        break
-                    
-                    last_queue_size = current_queue_size
-                    print(f"⏳ Queue size: {current_queue_size}")
-                    
-            except Exception as e:
-                print(f"⚠️ Error checking queue: {e}")
-            
-            time.sleep(2)
-        
-        # Get the most recent history
-        print("📥 Getting recent history...")
-        history_response = requests.get("http://127.0.0.1:8188/history")
-        if history_response.status_code != 200:
-            raise Exception("Could not get processing history")
-            
-        history_data = history_response.json()
-        
-        if not history_data:
-            raise Exception("No processing history found")
-        
-        # Get the most recent prompt result
-        latest_prompt_id = list(history_data.keys())[-1]
-        latest_result = history_data[latest_prompt_id]
-        
-        print(f"✅ Found recent result: {latest_prompt_id}")
-        
-        # Extract output images
-        output_images = {}
-        for node_id in latest_result['outputs']:
-            node_output = latest_result['outputs'][node_id]
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    image_data = client.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-                output_images[node_id] = images_output
-        
-        if not output_images:
-            raise Exception("No images found in latest result")
-            
-        # Find the best output image
-        output_image_data = None
-        for node_id in ["107", "118", "91"]:
-            if node_id in output_images and output_images[node_id]:
-                output_image_data = output_images[node_id][0]
-                print(f"✅ Found output image from node {node_id}")
-                break
-        
-        if not output_image_data and output_images:
-            last_node = list(output_images.keys())[-1]
-            output_image_data = output_images[last_node][0]
-            print(f"✅ Using image from node {last_node}")
-        
-        if not output_image_data:
-            raise Exception("No output image found")
-            
-        # Convert to base64
-        image_base64 = base64.b64encode(output_image_data).decode()
-        return f"data:image/png;base64,{image_base64}"
-        
-    except Exception as e:
-        print(f"❌ Polling method failed: {e}")
-        raise e
+        job = job_manager.submit(params["image_data"], params["prompt"], timings=params["timings"],
+                                 client_id=params["client_id"], lane=params["lane"], **params["options"])
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    return job_accepted_response(job)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Get the status of a generation job"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found", "job_id": job_id}), 404
+    job.touch()
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued or running job, deleting or interrupting its ComfyUI prompt
+
+    The client is identified like on submission (X-Client-Id, ?client_id=,
+    remote address); with several merged requests it only detaches its own.
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found", "job_id": job_id}), 404
+    if not job_manager.cancel(job, client_id=request_client_id()) and job.cancel_reason is None:
+        if not job.finished:
+            # Merged requests share the job id; each client may only withdraw its own
+            return jsonify({"error": "No request of this client is attached to the job", "job_id": job_id}), 403
+        return jsonify({"error": "Job already finished", "job_id": job_id, "status": job.status}), 409
+    # Running jobs stop at their next stage or when ComfyUI confirms, usually within a second
+    job.wait(JOB_DISCONNECT_POLL)
+    return jsonify(job.to_dict()), 200 if job.finished else 202
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Get the output of a generation job, 202 while it is still running"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found", "job_id": job_id}), 404
+    job.touch()
+    if not job.finished:
+        return jsonify(job.to_dict()), 202
+    return job_result_response(job)
 
 @app.route('/api/process-base64', methods=['POST'])
 def process_base64_image():
     """Process base64 image with real ComfyUI workflow"""
+    params, error_response = parse_generation_request()
+    if error_response:
+        return error_response
+    
     try:
-        print("🔍 API call received for real ComfyUI processing")
-        
-        # Get JSON data
-        data = request.get_json()
-        if not data or 'image' not in data:
-            return jsonify({"error": "No image data provided"}), 400
-        
-        image_base64 = data['image']
-        prompt = data.get('prompt', 'modern architectural building, clean lines')
-        print(f"📝 Prompt: {prompt}")
-        print(f"🖼️ Image data length: {len(image_base64)} characters")
-        
-        # Check ComfyUI connection
-        if not check_comfyui_connection():
-            return jsonify({
-                "error": "ComfyUI not available",
-                "details": "Cannot connect to ComfyUI on localhost:8188",
-                "suggestion": "Start ComfyUI with: python main.py --listen"
-            }), 503
-        
-        # Check required models
-        models_ok, models_msg = check_required_models()
-        if not models_ok:
-            print(f"⚠️ Model check warning: {models_msg}")
-            # Continue anyway - some models might still work
-        
-        # Load workflow
-        workflow = load_workflow()
-        if not workflow:
-            return jsonify({
-                "error": "Workflow not found",
-                "details": f"Could not load {WORKFLOW_FILE}",
-                "suggestion": "Ensure the workflow JSON file exists in the project root"
-            }), 500
-        
-        # Save input image to both locations
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        input_filename = f"input_{timestamp}.png"
-        
-        try:
-            # Save to uploads directory
-            input_filepath = save_base64_image(image_base64, input_filename)
-            
-            # Try to find and copy to ComfyUI input directory
-            comfyui_copied = copy_to_comfyui_input(input_filepath, input_filename)
-            
-            if not comfyui_copied:
-                # Alternative: Try using absolute path in workflow
-                abs_path = os.path.abspath(input_filepath)
-                print(f"ℹ️ Using absolute path: {abs_path}")
-                # We'll update the workflow to use the absolute path
-                input_filename = abs_path
-                
-        except Exception as e:
-            return jsonify({
-                "error": "Failed to save input image",
-                "details": str(e)
-            }), 500
-        
-        # Update workflow with new image and prompt
-        updated_workflow = update_workflow_for_processing(workflow, input_filename, prompt)
-        if not updated_workflow:
-            return jsonify({
-                "error": "Failed to update workflow",
-                "details": "Could not customize workflow with input parameters"
-            }), 500
-        
-        # Process with ComfyUI
-        print("🎨 Starting ComfyUI processing...")
+        job = job_manager.submit(params["image_data"], params["prompt"], timings=params["timings"],
+                                 client_id=params["client_id"], lane=params["lane"], **params["options"])
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    # Blocking wrapper around the job API for existing clients
+    if not wait_for_client(job, params["client_id"]):
+        return jsonify(job.to_dict()), 409
+    return job_result_response(job)
+
+@app.route('/api/jobs/<job_id>/image', methods=['GET'])
+def get_job_image(job_id):
+    """Get the output image of a generation job as raw bytes"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found", "job_id": job_id}), 404
+    job.touch()
+    if parse_flag(request.args.get("draft", "")):
+        # Progressive jobs serve their draft while the final image is still generating
+        if job.draft is not None:
+            return output_image_response(job, job.draft)
+        if job.finished:
+            return jsonify({"error": "Job has no draft", "job_id": job_id}), 404
+        return jsonify(job.to_dict()), 202
+    if not job.finished:
+        return jsonify(job.to_dict()), 202
+    return job_image_response(job)
+
+def sse_event(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Server-Sent Events stream of a job's stage, node and sampler progress
+
+    Pass ?previews=1 to also receive downscaled JPEG previews of the sampler.
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found", "job_id": job_id}), 404
+    events = job.subscribe(previews=parse_flag(request.args.get("previews", "0")))
+    
+    def generate():
         try:
-            output_image_base64 = process_with_comfyui_websocket(updated_workflow)
-            
-            # Save output image for debugging
-            output_filename = f"output_{timestamp}.png"
-            if output_image_base64:
+            yield sse_event("status", job.to_dict())
+            while True:
+                if job.finished and events.empty():
+                    # Finished before we subscribed, or the final event was dropped
+                    yield sse_event(*job.terminal_event())
+                    return
                 try:
-                    save_base64_image(output_image_base64, output_filename)
-                except:
-                    pass  # Don't fail if we can't save output
-            
-            print("✅ ComfyUI processing completed successfully")
-            
-            return jsonify({
-                "success": True,
-                "output_image": output_image_base64,
-                "prompt": prompt,
-                "processing_time": "completed",
-                "input_filename": input_filename,
-                "output_filename": output_filename,
-                "workflow_nodes": len(updated_workflow)
-            })
-            
-        except Exception as e:
-            print(f"❌ ComfyUI processing failed: {e}")
-            return jsonify({
-                "error": "ComfyUI processing failed",
-                "details": str(e),
-                "suggestion": "Check ComfyUI console for detailed error messages"
-            }), 500
-            
-    except Exception as e:
-        error_details = {
-            "error": "Server processing failed",
-            "details": str(e),
-            "traceback": traceback.format_exc(),
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        print("❌ DETAILED ERROR:")
-        print(f"Error: {e}")
-        print(f"Traceback:\n{traceback.format_exc()}")
-        
-        return jsonify(error_details), 500
+                    event_type, data = events.get(timeout=SSE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event(event_type, data)
+                if event_type in ("completed", "failed", "cancelled"):
+                    return
+        finally:
+            job.unsubscribe(events)
+    
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/api/process', methods=['POST'])
+def process_binary_image():
+    """Process a multipart or raw image/* upload and return the output image bytes
+
+    With ?response=url the job is queued and its image URL returned right away.
+    """
+    params, error_response = parse_generation_request()
+    if error_response:
+        return error_response
+    
+    try:
+        job = job_manager.submit(params["image_data"], params["prompt"], timings=params["timings"],
+                                 client_id=params["client_id"], lane=params["lane"], **params["options"])
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    if request.args.get("response") == "url":
+        return job_accepted_response(job)
+    
+    if not wait_for_client(job, params["client_id"]):
+        return jsonify(job.to_dict()), 409
+    return job_image_response(job)
+
+def field_list(fields, name):
+    """List value from a JSON body (list or scalar) or form/query args (repeated field)"""
+    if hasattr(fields, "getlist"):
+        return fields.getlist(name)
+    if hasattr(fields, "getall"):
+        return fields.getall(name, [])
+    value = fields.get(name)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def parse_batch_variants(fields, options):
+    """Expand prompts/seeds/batch_size into one dict per variant"""
+    prompts = [p for p in (normalize_prompt(value) for value in field_list(fields, "prompts")) if p]
+    seeds = [int(part) for value in field_list(fields, "seeds") for part in str(value).split(",") if part.strip()]
+    batch_size = int(fields.get("batch_size") or max(len(prompts), len(seeds), 1))
+    if not 1 <= batch_size <= BATCH_MAX_VARIANTS:
+        raise ValueError(f"batch_size must be between 1 and {BATCH_MAX_VARIANTS}")
+    if "seed" in options and not seeds:
+        # An explicit base seed gives consecutive seeds per variant
+        seeds = [options["seed"] + index for index in range(batch_size)]
+    
+    variants = []
+    for index in range(batch_size):
+        variant = {}
+        if prompts:
+            variant["prompt"] = prompts[index % len(prompts)]
+        if index < len(seeds):
+            variant["seed"] = seeds[index]
+        variants.append(variant)
+    return variants
+
+@app.route('/api/batch', methods=['POST'])
+def process_batch():
+    """Generate several prompt/seed variants of one image in a single ComfyUI run
+
+    Accepts the same body formats as /api/process plus prompts, seeds and
+    batch_size. With ?response=url the job is queued and returned right away.
+    """
+    params, error_response = parse_generation_request()
+    if error_response:
+        return error_response
+    
+    options = params["options"]
+    try:
+        variants = parse_batch_variants(params["fields"], options)
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    options.pop("seed", None)
+    if options.pop("progressive", False):
+        return jsonify({"error": "Invalid parameters", "details": "progressive is not supported for batches"}), 400
+    
+    try:
+        job = job_manager.submit(params["image_data"], params["prompt"], pipeline=run_batch_pipeline,
+                                 timings=params["timings"], client_id=params["client_id"],
+                                 lane=params["lane"] or ADMISSION_BATCH_LANE, variants=variants, **options)
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    if request.args.get("response") == "url":
+        return job_accepted_response(job)
+    
+    if not wait_for_client(job, params["client_id"]):
+        return jsonify(job.to_dict()), 409
+    return job_result_response(job)
+
+def health_payload(pool):
+    """Health report for a backend pool plus the local stores and directories"""
+    # Test ComfyUI connection
+    comfy_connected = pool.any_available()
+    
+    # Check models
+    models_ok, models_msg = pool.models_status()
+    
+    # Check workflow file
+    workflow_exists = os.path.exists(WORKFLOW_FILE)
+    
+    # Check directories
+    artifact_dir_exists = os.path.exists(ARTIFACT_DIR)
+    output_dir_exists = os.path.exists(OUTPUT_DIR)
+    
+    # Ready once a backend has its models loaded, so the first job doesn't pay for it
+    ready = pool.ready()
+    
+    return {
+        "status": "healthy" if ready else "warming_up" if comfy_connected else "degraded",
+        "ready": ready,
+        "comfyui_connected": comfy_connected,
+        "comfyui_urls": [backend.url for backend in pool.backends],
+        "workflow_loaded": workflow_exists,
+        "models_status": models_msg,
+        "models_ok": models_ok,
+        "backends": pool.snapshot(),
+        "result_cache": result_cache.stats(),
+        "artifacts": artifact_store.stats(),
+        "directories": {
+            "artifact_dir": artifact_dir_exists,
+            "output_dir": output_dir_exists
+        },
+        "workflow_file": WORKFLOW_FILE,
+        "timestamp": datetime.now().isoformat()
+    }
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Enhanced health check with ComfyUI and model status"""
     try:
-        # Test ComfyUI connection
-        comfy_connected = check_comfyui_connection()
-        
-        # Check models
-        models_ok, models_msg = check_required_models()
-        
-        # Check workflow file
-        workflow_exists = os.path.exists(WORKFLOW_FILE)
-        
-        # Check directories
-        upload_dir_exists = os.path.exists(UPLOAD_DIR)
-        output_dir_exists = os.path.exists(OUTPUT_DIR)
-        
-        return jsonify({
-            "status": "healthy" if comfy_connected else "degraded",
-            "comfyui_connected": comfy_connected,
-            "comfyui_url": COMFY_UI_URL,
-            "workflow_loaded": workflow_exists,
-            "models_status": models_msg,
-            "directories": {
-                "upload_dir": upload_dir_exists,
-                "output_dir": output_dir_exists
-            },
-            "workflow_file": WORKFLOW_FILE,
-            "timestamp": datetime.now().isoformat()
-        })
+        return jsonify(health_payload(get_backend_pool()))
     except Exception as e:
         return jsonify({
             "status": "error",
@@ -660,40 +3759,219 @@ def test_endpoint():
 def list_models():
     """List available models in ComfyUI"""
     try:
-        if not check_comfyui_connection():
+        # Backends run the same workflow, any healthy one's listing will do
+        backend = next((b for b in get_backend_pool().backends if b.available), None)
+        if backend is None:
             return jsonify({"error": "ComfyUI not connected"}), 503
-            
-        response = requests.get(f"{COMFY_UI_URL}/object_info")
-        if response.status_code == 200:
-            return jsonify(response.json())
+        
+        capabilities = backend.capabilities
+        object_info = capabilities.object_info
+        if object_info is None:
+            # Not fetched yet (or dropped after a failure), load it once now
+            capabilities.refresh()
+            object_info = capabilities.object_info
+        if object_info is not None:
+            return jsonify(object_info)
         else:
             return jsonify({"error": "Could not fetch model info"}), 500
             
+    except ComfyUIUnavailableError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/cache', methods=['GET'])
+def get_cache_stats():
+    """Result cache hit/miss counters and sizes, plus ComfyUI's own node cache reuse"""
+    stats = result_cache.stats()
+    with _event_listeners_lock:
+        listeners = list(_event_listeners.values())
+    cached = sum(listener.nodes_cached for listener in listeners)
+    executed = sum(listener.nodes_executed for listener in listeners)
+    stats["renditions"] = rendition_cache.stats()
+    stats["comfyui_nodes"] = {
+        "cached": cached,
+        "executed": executed,
+        "hit_rate": round(cached / (cached + executed), 3) if cached + executed else None
+    }
+    return jsonify(stats)
+
+def artifact_payload(entry):
+    return {
+        "id": entry["id"],
+        "kind": entry["kind"],
+        "size": entry["size"],
+        "mime_type": entry["mime_type"],
+        "created_at": datetime.fromtimestamp(entry["created_at"]).isoformat(),
+        "url": f"/api/artifacts/{entry['id']}",
+        "thumbnail_url": rendition_url(f"/api/artifacts/{entry['id']}", "thumb")
+    }
+
+@app.route('/api/artifacts', methods=['GET'])
+def list_artifacts():
+    """Stored inputs and outputs, newest first (?kind=input|output&limit=N)"""
+    kind = request.args.get("kind")
+    if kind is not None and kind not in ARTIFACT_KINDS:
+        return jsonify({"error": "Invalid kind", "details": f"kind must be one of {', '.join(ARTIFACT_KINDS)}"}), 400
+    limit = min(request.args.get("limit", 50, type=int), 1000)
+    return jsonify({
+        "artifacts": [artifact_payload(entry) for entry in artifact_store.list(kind, limit)],
+        "stats": artifact_store.stats()
+    })
+
+@app.route('/api/artifacts/<artifact_id>', methods=['GET'])
+def get_artifact(artifact_id):
+    """Serve a stored input or output by id, or a rendition of it"""
+    entry, data = artifact_store.get(artifact_id)
+    if entry is None:
+        return jsonify({"error": "Artifact not found", "artifact_id": artifact_id}), 404
+    if rendition_requested(request.args):
+        if data is None:
+            try:
+                with open(entry["path"], "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return jsonify({"error": "Artifact not found", "artifact_id": artifact_id}), 404
+        try:
+            response = image_response(data, entry["mime_type"], artifact_id)
+        except ValueError as e:
+            return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    else:
+        if data is not None:
+            # Still queued for the disk writer
+            response = Response(data, mimetype=entry["mime_type"])
+        else:
+            try:
+                response = send_file(entry["path"], mimetype=entry["mime_type"], conditional=False, etag=False)
+            except FileNotFoundError:
+                return jsonify({"error": "Artifact not found", "artifact_id": artifact_id}), 404
+        response.set_etag(artifact_id)
+    # Ids are content hashes, so the bytes behind one (or a rendition of them) never change
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+def pool_metrics(pool=None):
+    for backend in (pool or get_backend_pool()).backends:
+        labels = {"backend": backend.url}
+        yield "isogen_comfyui_up", labels, int(backend.available)
+        yield "isogen_comfyui_queue_depth", labels, backend.queue_depth
+        yield "isogen_comfyui_in_flight", labels, backend.in_flight
+        yield "isogen_comfyui_job_latency_seconds", labels, backend.latency
+        yield "isogen_comfyui_jobs_completed_total", labels, backend.jobs_completed
+
+def result_cache_metrics():
+    stats = result_cache.stats()
+    yield "isogen_result_cache_hits_total", {"tier": "memory"}, stats["memory_hits"]
+    yield "isogen_result_cache_hits_total", {"tier": "disk"}, stats["disk_hits"]
+    yield "isogen_result_cache_misses_total", {}, stats["misses"]
+    yield "isogen_result_cache_evictions_total", {}, stats["evictions"]
+    yield "isogen_result_cache_bytes", {"tier": "memory"}, stats["memory_bytes"]
+    yield "isogen_result_cache_bytes", {"tier": "disk"}, stats["disk_bytes"]
+
+def rendition_cache_metrics():
+    stats = rendition_cache.stats()
+    yield "isogen_rendition_cache_hits_total", {"tier": "memory"}, stats["memory_hits"]
+    yield "isogen_rendition_cache_hits_total", {"tier": "disk"}, stats["disk_hits"]
+    yield "isogen_rendition_cache_misses_total", {}, stats["misses"]
+    yield "isogen_rendition_cache_bytes", {"tier": "memory"}, stats["memory_bytes"]
+    yield "isogen_rendition_cache_bytes", {"tier": "disk"}, stats["disk_bytes"]
+
+def artifact_metrics():
+    stats = artifact_store.stats()
+    yield "isogen_artifacts", {}, stats["entries"]
+    yield "isogen_artifact_bytes", {}, stats["bytes"]
+    yield "isogen_artifact_evictions_total", {}, stats["evictions"]
+
+def job_metrics(stats=None):
+    if stats is None:
+        stats = job_manager.stats()
+    if "workers" in stats:
+        yield "isogen_job_workers", {}, stats["workers"]
+    for status in ("queued", "running", "completed", "failed", "cancelled"):
+        yield "isogen_jobs", {"status": status}, stats["jobs"].get(status, 0)
+    admission = stats["admission"]
+    for lane, waiting in admission["lanes"].items():
+        yield "isogen_admission_waiting", {"lane": lane}, waiting
+    for reason in ("queue_full", "client_limit"):
+        yield "isogen_admission_rejected_total", {"reason": reason}, admission["rejected"].get(reason, 0)
+
+for name, metric_type, help_text in (
+    ("isogen_comfyui_up", "gauge", "1 if the backend is in rotation"),
+    ("isogen_comfyui_queue_depth", "gauge", "Last sampled ComfyUI queue length (running + pending)"),
+    ("isogen_comfyui_in_flight", "gauge", "Jobs this service currently has on the backend"),
+    ("isogen_comfyui_job_latency_seconds", "gauge", "EWMA of job duration on the backend"),
+    ("isogen_comfyui_jobs_completed_total", "counter", "Jobs completed on the backend"),
+    ("isogen_result_cache_hits_total", "counter", "Result cache hits by tier"),
+    ("isogen_result_cache_misses_total", "counter", "Result cache misses"),
+    ("isogen_result_cache_evictions_total", "counter", "Result cache evictions"),
+    ("isogen_result_cache_bytes", "gauge", "Bytes held by the result cache by tier"),
+    ("isogen_rendition_cache_hits_total", "counter", "Rendition cache hits by tier"),
+    ("isogen_rendition_cache_misses_total", "counter", "Renditions transcoded on request"),
+    ("isogen_rendition_cache_bytes", "gauge", "Bytes held by the rendition cache by tier"),
+    ("isogen_artifacts", "gauge", "Stored artifacts"),
+    ("isogen_artifact_bytes", "gauge", "Bytes held by the artifact store"),
+    ("isogen_artifact_evictions_total", "counter", "Artifacts removed by retention"),
+    ("isogen_job_workers", "gauge", "Job worker threads"),
+    ("isogen_jobs", "gauge", "Retained jobs by status"),
+    ("isogen_admission_waiting", "gauge", "Jobs waiting for a worker by priority lane"),
+    ("isogen_admission_rejected_total", "counter", "Submissions refused with 429 by reason"),
+):
+    metrics.describe(name, metric_type, help_text)
+metrics.add_collector(pool_metrics)
+metrics.add_collector(result_cache_metrics)
+metrics.add_collector(rendition_cache_metrics)
+metrics.add_collector(artifact_metrics)
+metrics.add_collector(job_metrics)
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Stage timings, job and request counters, pool and cache state (Prometheus text format)"""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route('/api/queue', methods=['GET'])
 def get_queue():
-    """Get current ComfyUI queue status"""
+    """Get current ComfyUI queue status, merged across the pool and per backend"""
     try:
         if not check_comfyui_connection():
             return jsonify({"error": "ComfyUI not connected"}), 503
-            
-        response = requests.get(f"{COMFY_UI_URL}/queue")
-        if response.status_code == 200:
-            return jsonify(response.json())
-        else:
-            return jsonify({"error": "Could not fetch queue info"}), 500
+        
+        merged = {"queue_running": [], "queue_pending": [], "backends": {}}
+        for backend in get_backend_pool().backends:
+            if not backend.available:
+                merged["backends"][backend.url] = {"error": "unavailable"}
+                continue
+            try:
+                response = backend.transport.get("/queue")
+            except ComfyUIUnavailableError as e:
+                merged["backends"][backend.url] = {"error": str(e)}
+                continue
+            if response.status_code != 200:
+                merged["backends"][backend.url] = {"error": "Could not fetch queue info"}
+                continue
+            data = response.json()
+            merged["queue_running"].extend(data.get('queue_running', []))
+            merged["queue_pending"].extend(data.get('queue_pending', []))
+            merged["backends"][backend.url] = data
+        # Jobs still waiting here, not yet submitted to any backend
+        merged["admission"] = job_manager.admission.stats()
+        return jsonify(merged)
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
+    # With debug=True the reloader re-runs this file in a child process that does the serving.
+    # Only that one prints the banner and starts the backend pool, so each ComfyUI
+    # instance gets one event listener and one warm-up.
+    if os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+        app.run(host='0.0.0.0', port=5000, debug=True)
+        raise SystemExit
+    
     print("=" * 60)
     print("🚀 Starting isOGen Backend (Real ComfyUI Integration)")
     print("=" * 60)
-    print(f"📡 ComfyUI URL: {COMFY_UI_URL}")
-    print(f"📁 Upload directory: {UPLOAD_DIR}")
+    print(f"📡 ComfyUI URLs: {', '.join(COMFY_UI_URLS)}")
+    print(f"📁 Artifact directory: {ARTIFACT_DIR}")
     print(f"📁 Output directory: {OUTPUT_DIR}")
     print(f"📋 Workflow file: {WORKFLOW_FILE}")
     print("\n🌐 Available Endpoints:")
@@ -701,13 +3979,31 @@ if __name__ == '__main__':
     print("  GET  /api/test - Simple test")
     print("  GET  /api/models - List available ComfyUI models")
     print("  GET  /api/queue - ComfyUI queue status")
+    print("  GET  /api/cache - Result cache and ComfyUI node cache statistics")
+    print("  GET  /api/metrics - Prometheus metrics (stage timings, pool, cache)")
+    print("  GET  /api/artifacts - Stored inputs/outputs (GET /api/artifacts/<id> serves one)")
     print("  POST /api/process-base64 - Process image with real ComfyUI workflow")
+    print("  POST /api/jobs - Queue a generation job (returns job id)")
+    print("  GET  /api/jobs/<id> - Job status")
+    print("  GET  /api/jobs/<id>/result - Job output")
+    print("  GET  /api/jobs/<id>/image - Job output image (binary)")
+    print("  GET  /api/jobs/<id>/events - Live job progress (Server-Sent Events)")
+    print("  POST /api/jobs/<id>/cancel - Cancel a job and its ComfyUI prompt")
+    print("  POST /api/process - Process multipart/raw image, returns image bytes")
+    print("  POST /api/batch - Several prompt/seed variants of one image in one run")
     print("\n🔧 Real ComfyUI Features:")
-    print("  - WebSocket connection for real-time processing")
+    print("  - Shared WebSocket listener for real-time processing")
+    print(f"  - Load-aware routing over {len(COMFY_UI_URLS)} ComfyUI instance(s)")
     print("  - Automatic workflow parameter updates")
     print("  - Model availability checking")
     print("  - Detailed error reporting")
     print("  - Image input/output handling")
+    print(f"  - Background job queue ({JOB_WORKERS} workers), identical in-flight requests share one job")
+    if POOL_WARMUP:
+        keepalive = f", keep-alive after {POOL_KEEPALIVE_INTERVAL}s idle" if POOL_KEEPALIVE_INTERVAL else ""
+        print(f"  - Model warm-up on every backend before /api/health reports ready{keepalive}")
+    print(f"  - Quality profiles: {', '.join(WORKFLOW_PROFILES)} (progressive=1 streams a draft first)")
+    print(f"  - Fair admission: {', '.join(ADMISSION_LANES)} lanes, {ADMISSION_MAX_PER_CLIENT} jobs per client, 429 when full")
     print("=" * 60)
     
     # Initial system check
@@ -719,6 +4015,8 @@ if __name__ == '__main__':
     print(f"ComfyUI Connection: {'✅' if comfy_ok else '❌'}")
     print(f"Workflow File: {'✅' if workflow_ok else '❌'}")
     print(f"Models: {models_msg}")
+    if POOL_WARMUP and comfy_ok:
+        print("Warm-up: running in the background (see \"ready\" in /api/health)")
     
     if not comfy_ok:
         print("\n⚠️  WARNING: ComfyUI not detected!")
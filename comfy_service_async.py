@@ -0,0 +1,1388 @@
+#!/usr/bin/env python3
+"""
+Asyncio serving mode for the isOGen backend
+Serves the generation API from one event loop, so a waiting request costs a
+coroutine instead of a thread. Workflow handling, caches, the artifact store
+and the routing policy are shared with comfy_service; only the I/O is async.
+The endpoints are those of comfy_service, except that progressive (draft
+first) generation is only available on the threaded server.
+
+Requires aiohttp (pip install aiohttp). Run with: python comfy_service_async.py
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import queue
+import random
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from urllib.parse import quote
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # Optional dependency, only this serving mode needs it
+    aiohttp = None
+    web = None
+
+from comfy_service import (
+    ADMISSION_BATCH_LANE, ADMISSION_CLIENT_HEADER, ADMISSION_DEFAULT_LANE, ADMISSION_LANES, ARTIFACT_DIR,
+    ARTIFACT_KINDS, CAPABILITY_INITIAL_WAIT, CAPABILITY_RETRY_INTERVAL, CAPABILITY_TTL, COMFY_HTTP_BACKOFF,
+    COMFY_HTTP_CONNECT_TIMEOUT, COMFY_HTTP_DOWNLOAD_TIMEOUT, COMFY_HTTP_POOL_SIZE, COMFY_HTTP_READ_TIMEOUT,
+    COMFY_HTTP_RETRIES, COMFY_PROMPT_TIMEOUT, COMFY_UI_URLS, COMFY_WS_CONNECT_TIMEOUT, COMFY_WS_PING_INTERVAL,
+    COMFY_WS_RECONNECT_DELAY, COMFY_WS_RECONNECT_MAX_DELAY, DEFAULT_PROMPT, DETERMINISTIC_SEEDS, INPUT_NORMALIZE,
+    JOB_ABANDON_AFTER, JOB_DISCONNECT_POLL, JOB_EVENT_BUFFER, JOB_HOUSEKEEPING_INTERVAL, JOB_RESULT_TTL,
+    POOL_KEEPALIVE_INTERVAL, POOL_MONITOR_INTERVAL, POOL_WARMUP, SAVE_INPUTS_LOCALLY, SAVE_OUTPUTS_LOCALLY,
+    SSE_KEEPALIVE_INTERVAL, STAGED_INPUT_CACHE_SIZE, STAGED_INPUT_TTL, TRACKER_POLL_BACKOFF, TRACKER_POLL_MAX,
+    TRACKER_POLL_MIN, WORKFLOW_DEFAULT_PROFILE, WORKFLOW_FILE, AdmissionQueue, BackendPool, CapabilityCache,
+    CircuitBreaker, ComfyUIEventListener, ComfyUIUnavailableError, CompletionTracker, Job, JobCancelledError,
+    JobQueueFullError, ProcessingError, artifact_payload, artifact_store, batch_result, build_batch_workflow,
+    cached_output_result, collect_batch_outputs, decode_base64_image, ensure_comfyui_ready, generation_cache_key,
+    get_rendition, get_workflow_template, health_payload, job_metrics, job_result_payload, logger, make_output_result,
+    metrics, normalize_prompt, parse_batch_variants, parse_flag, parse_generation_options, parse_rendition,
+    plan_batch_variants, pool_metrics, progress_forwarder, rendition_cache, rendition_etag, resolve_seed, result_cache,
+    select_output_image, sse_event, staged_input_name, timed_normalize_input, update_workflow_for_processing,
+    warmup_image, warmup_workflow,
+)
+
+# Configuration
+ASYNC_HOST = "0.0.0.0"
+ASYNC_PORT = 5000
+ASYNC_MAX_PENDING = 1024  # Generations allowed to wait for a backend slot, each holds its input in memory
+ASYNC_RECENT_JOBS = 64  # Finished jobs kept so image_url in a response stays fetchable
+
+async def wait_event(event, timeout=None):
+    """asyncio.Event.wait with a timeout, returns False when it expired"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+class AsyncResponse:
+    """Status, headers and the fully read body of one ComfyUI response"""
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncComfyUITransport:
+    """ComfyUITransport on a shared aiohttp session: same timeouts, retries and circuit breaker"""
+    def __init__(self, session, server_address):
+        self.session = session
+        self.server_address = server_address
+        self.base_url = f"http://{server_address}"
+        self.breaker = CircuitBreaker()
+
+    async def request(self, method, path, timeout=None, retries=None, **kwargs):
+        """Send a request and read the body, retrying idempotent methods on connection errors and 5xx responses"""
+        if timeout is None:
+            timeout = COMFY_HTTP_READ_TIMEOUT
+        if retries is None:
+            retries = COMFY_HTTP_RETRIES if method in ("GET", "HEAD") else 0
+        url = f"{self.base_url}{path}"
+        client_timeout = aiohttp.ClientTimeout(sock_connect=COMFY_HTTP_CONNECT_TIMEOUT, sock_read=timeout)
+        
+        attempt = 0
+        while True:
+            if not self.breaker.allow_request():
+                raise ComfyUIUnavailableError(
+                    f"ComfyUI at {self.server_address} is unavailable "
+                    f"(circuit open, retry in {self.breaker.retry_after():.0f}s)")
+            try:
+                async with self.session.request(method, url, timeout=client_timeout, **kwargs) as response:
+                    result = AsyncResponse(response.status, response.headers, await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure()
+                if attempt >= retries:
+                    raise ComfyUIUnavailableError(f"ComfyUI at {self.server_address} unreachable: {e!r}") from e
+            else:
+                if result.status_code < 500:
+                    self.breaker.record_success()
+                    return result
+                self.breaker.record_failure()
+                if attempt >= retries:
+                    return result
+            
+            await asyncio.sleep(random.uniform(0, COMFY_HTTP_BACKOFF * (2 ** attempt)))
+            attempt += 1
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+class AsyncComfyUIClient:
+    """ComfyUIClient over an AsyncComfyUITransport"""
+    def __init__(self, transport, client_id=None):
+        self.transport = transport
+        self.server_address = transport.server_address
+        self.client_id = client_id or str(uuid.uuid4())
+
+    async def queue_prompt(self, prompt, prompt_id=None):
+        """Queue a prompt for processing"""
+        p = {"prompt": prompt, "client_id": self.client_id}
+        if prompt_id:
+            p["prompt_id"] = prompt_id
+        response = await self.transport.post("/prompt", data=json.dumps(p).encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+        return response.json()
+
+    async def get_image(self, filename, subfolder, folder_type):
+        """Get an image from ComfyUI"""
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        url_values = "&".join([f"{k}={quote(str(v))}" for k, v in data.items()])
+        response = await self.transport.get(f"/view?{url_values}", timeout=COMFY_HTTP_DOWNLOAD_TIMEOUT)
+        if response.status_code != 200:
+            raise Exception(f"ComfyUI /view returned status {response.status_code}")
+        return response.content
+
+    async def get_history(self, prompt_id):
+        """Get the history for a prompt"""
+        response = await self.transport.get(f"/history/{prompt_id}")
+        return response.json()
+
+class AsyncEventListener(ComfyUIEventListener):
+    """ComfyUIEventListener with the WebSocket read by a task on the event loop
+
+    Dispatch, watches and re-keying are inherited; watches still resolve a
+    concurrent Future, which callers await through asyncio.wrap_future.
+    """
+    def __init__(self, transport, capabilities):
+        super().__init__(transport.server_address)
+        self.transport = transport
+        self.capabilities = capabilities
+        self._connected = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name=f"comfy-ws-{self.server_address}")
+        return self
+
+    async def wait_connected(self, timeout=None):
+        return await wait_event(self._connected, timeout)
+
+    async def _run(self):
+        ws_url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        delay = COMFY_WS_RECONNECT_DELAY
+        while True:
+            ws = None
+            try:
+                ws = await asyncio.wait_for(
+                    self.transport.session.ws_connect(ws_url, heartbeat=COMFY_WS_PING_INTERVAL),
+                    COMFY_WS_CONNECT_TIMEOUT)
+                self._connected.set()
+                delay = COMFY_WS_RECONNECT_DELAY
+                logger.info("Connected to ComfyUI WebSocket (%s)", self.server_address)
+                # Completion events may have been missed while disconnected
+                asyncio.get_running_loop().create_task(self._reconcile())
+                async for message in ws:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        self._dispatch(json.loads(message.data))
+                    elif message.type == aiohttp.WSMsgType.BINARY:
+                        self._dispatch_binary(message.data)
+                    elif message.type == aiohttp.WSMsgType.ERROR:
+                        raise ws.exception()
+                raise ConnectionError("closed by server")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._connected.is_set():
+                    logger.error("WebSocket connection to %s lost: %r", self.server_address, e)
+                    # Re-probe right away so the pool stops routing here
+                    self.capabilities.invalidate()
+            finally:
+                self._connected.clear()
+                if ws is not None:
+                    await ws.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, COMFY_WS_RECONNECT_MAX_DELAY)
+
+    async def _reconcile(self):
+        with self._lock:
+            watches = list(self._watches.values())
+        client = AsyncComfyUIClient(self.transport, client_id=self.client_id)
+        for watch in watches:
+            try:
+                history = await client.get_history(watch.prompt_id)
+            except Exception:
+                continue
+            entry = history.get(watch.prompt_id)
+            if not entry or not entry.get('status', {}).get('completed', True):
+                continue
+            self.unwatch(watch)
+            error = None
+            if entry.get('status', {}).get('status_str') == 'error':
+                error = "execution error (recovered from history)"
+            watch.finish(error=error)
+
+class AsyncCompletionTracker(CompletionTracker):
+    """CompletionTracker sampling /queue from a task on the event loop"""
+    def __init__(self, transport):
+        super().__init__(transport.server_address)
+        self.transport = transport
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name=f"comfy-tracker-{self.server_address}")
+        return self
+
+    async def _run(self):
+        interval = TRACKER_POLL_MIN
+        while True:
+            with self._lock:
+                watches = dict(self._watches)
+            if not watches:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                interval = TRACKER_POLL_MIN
+                continue
+            try:
+                changed = await self._check(watches)
+            except Exception as e:
+                logger.warning("Error checking prompt status on %s: %s", self.server_address, e)
+                changed = False
+            interval = TRACKER_POLL_MIN if changed else min(interval * TRACKER_POLL_BACKOFF, TRACKER_POLL_MAX)
+            # New prompts cut the wait short
+            if await wait_event(self._wakeup, interval):
+                self._wakeup.clear()
+                interval = TRACKER_POLL_MIN
+
+    async def _check(self, watches):
+        """One /queue sample for all outstanding prompts, returns True if anything changed"""
+        response = await self.transport.get("/queue")
+        if response.status_code != 200:
+            raise Exception(f"ComfyUI returned status: {response.status_code}")
+        changed, left = self._apply_queue(watches, response.json())
+        for watch in left:
+            history = (await self.transport.get(f"/history/{watch.prompt_id}")).json()
+            if self._settle(watch, history.get(watch.prompt_id)):
+                changed = True
+        return changed
+
+class AsyncCapabilityCache(CapabilityCache):
+    """CapabilityCache probed from a task on the event loop"""
+    def __init__(self, transport):
+        super().__init__(transport.server_address)
+        self.transport = transport
+        self._wakeup = asyncio.Event()
+        self._first_probe = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name=f"comfy-caps-{self.server_address}")
+        return self
+
+    async def wait_ready(self, timeout=None):
+        return await wait_event(self._first_probe, timeout)
+
+    async def refresh(self):
+        """Probe /system_stats, and /object_info when the cached copy is stale"""
+        try:
+            response = await self.transport.get("/system_stats", retries=0)
+            if response.status_code != 200:
+                raise Exception(f"ComfyUI returned status: {response.status_code}")
+            system_stats = response.json()
+            
+            object_info = None
+            if self.object_info_stale():
+                response = await self.transport.get("/object_info")
+                if response.status_code != 200:
+                    raise Exception("Could not get model info from ComfyUI")
+                object_info = response.json()
+        except Exception as e:
+            self.record_failure(e)
+            return False
+        
+        self.record_probe(system_stats, object_info)
+        return True
+
+    async def _run(self):
+        while True:
+            ok = await self.refresh()
+            await wait_event(self._wakeup, CAPABILITY_TTL if ok else CAPABILITY_RETRY_INTERVAL)
+            self._wakeup.clear()
+
+class AsyncBackendPool(BackendPool):
+    """BackendPool whose probes, event listeners and queue samples all run on one event loop
+
+    Routing, leases and ejection are inherited unchanged; they only touch
+    in-memory state, so they are safe to call from coroutines.
+    """
+    def __init__(self, session, urls):
+        # Admission hands out at most one turn per available slot, so a lease never has to wait
+        super().__init__(urls, slot_wait=0)
+        self._task = None
+        self._warmup_task = None
+        for backend in self.backends:
+            backend.transport = AsyncComfyUITransport(session, backend.server_address)
+            backend.capabilities = AsyncCapabilityCache(backend.transport)
+            backend.listener = AsyncEventListener(backend.transport, backend.capabilities)
+            backend.tracker = AsyncCompletionTracker(backend.transport)
+
+    async def start(self):
+        if self._task is None:
+            for backend in self.backends:
+                backend.capabilities.start()
+                backend.listener.start()
+                backend.tracker.start()
+            await asyncio.gather(*(backend.capabilities.wait_ready(CAPABILITY_INITIAL_WAIT)
+                                   for backend in self.backends))
+            self._task = asyncio.get_running_loop().create_task(self._monitor(), name="comfy-pool")
+            if POOL_WARMUP or POOL_KEEPALIVE_INTERVAL:
+                self._warmup_task = asyncio.get_running_loop().create_task(self._warm_up(), name="comfy-warmup")
+        return self
+
+    async def close(self):
+        tasks = []
+        if self._warmup_task:
+            self._warmup_task.cancel()
+            tasks.append(self._warmup_task)
+        for part in [self] + [component for backend in self.backends
+                              for component in (backend.capabilities, backend.listener, backend.tracker)]:
+            if part._task:
+                part._task.cancel()
+                tasks.append(part._task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _sample_queue(self, backend):
+        try:
+            response = await backend.transport.get("/queue", retries=0)
+            if response.status_code == 200:
+                data = response.json()
+                backend.queue_depth = len(data.get('queue_running', [])) + len(data.get('queue_pending', []))
+        except Exception:
+            pass
+
+    async def _monitor(self):
+        while True:
+            await asyncio.gather(*(self._sample_queue(backend) for backend in self.backends
+                                   if backend.capabilities.connected))
+            for backend in self.backends:
+                if backend.ejected_until and not backend.ejected:
+                    backend.ejected_until = 0
+                    logger.info("Re-admitting ComfyUI backend %s", backend.url)
+            await asyncio.sleep(POOL_MONITOR_INTERVAL)
+
+    async def _warm_up(self):
+        while True:
+            for backend in self.backends:
+                reason = self.warmup_due(backend)
+                if reason is None:
+                    continue
+                started = time.time()
+                try:
+                    await warm_up_backend(backend)
+                except Exception as e:
+                    self.record_warmup(backend, reason, time.time() - started, e)
+                else:
+                    self.record_warmup(backend, reason, time.time() - started)
+            await asyncio.sleep(POOL_MONITOR_INTERVAL)
+
+async def warm_up_backend(backend):
+    """Load the models on one backend with a throwaway 1-step, low-resolution generation"""
+    input_filename = await stage_input_image(warmup_image(), backend.transport)
+    await process_workflow(backend, warmup_workflow(input_filename))
+
+_staged_inputs = OrderedDict()
+
+async def stage_input_image(image_data, transport):
+    """Upload image bytes to ComfyUI's input folder, returns the name to put in LoadImage"""
+    filename, mime_type = staged_input_name(image_data)
+    
+    # Single-threaded, so the cache needs no lock
+    key = (transport.server_address, filename)
+    now = time.time()
+    staged = _staged_inputs.get(key)
+    if staged and now - staged[0] < STAGED_INPUT_TTL:
+        _staged_inputs.move_to_end(key)
+        return staged[1]
+    
+    form = aiohttp.FormData()
+    form.add_field("image", image_data, filename=filename, content_type=mime_type)
+    form.add_field("type", "input")
+    form.add_field("overwrite", "true")
+    response = await transport.post("/upload/image", data=form, timeout=COMFY_HTTP_DOWNLOAD_TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(f"ComfyUI upload failed with status {response.status_code}: {response.text[:200]}")
+    
+    uploaded = response.json()
+    name = uploaded.get("name", filename)
+    if uploaded.get("subfolder"):
+        name = f"{uploaded['subfolder']}/{name}"
+    
+    _staged_inputs[key] = (now, name)
+    while len(_staged_inputs) > STAGED_INPUT_CACHE_SIZE:
+        _staged_inputs.popitem(last=False)
+    logger.debug("Uploaded input to ComfyUI: %s (%d bytes)", name, len(image_data))
+    return name
+
+async def submit_and_watch(watcher, workflow_data, on_event=None, prompt_id=None):
+    """Queue a workflow under the listener's (or tracker's) client id, returns (prompt_id, watch)"""
+    client = AsyncComfyUIClient(watcher.transport, client_id=watcher.client_id)
+    # Watch before queueing so a fast completion event can't be missed
+    watch = watcher.watch(prompt_id or str(uuid.uuid4()), on_event)
+    try:
+        queue_result = await client.queue_prompt(workflow_data, prompt_id=watch.prompt_id)
+    except BaseException:
+        watcher.unwatch(watch)
+        raise
+    
+    prompt_id = queue_result.get('prompt_id') if isinstance(queue_result, dict) else None
+    if not prompt_id:
+        watcher.unwatch(watch)
+        raise Exception(f"Cannot find prompt_id in response: {queue_result}")
+    if prompt_id != watch.prompt_id:
+        watcher.rekey(watch, prompt_id)
+    return prompt_id, watch
+
+_cancel_tasks = set()  # Strong references to in-flight cancel_prompt tasks
+
+async def cancel_prompt(backend, prompt_id, reason="Client disconnected"):
+    """Delete a pending prompt from the backend's queue, or interrupt it if it is the one running
+
+    Mirrors comfy_service.cancel_prompt; /interrupt is only sent while the
+    listener sees this prompt executing, so other clients' work is never stopped.
+    """
+    transport = backend.transport
+    outcome = None
+    try:
+        await transport.post("/queue", json={"delete": [prompt_id]})
+        outcome = "deleted"
+        if backend.listener.running_prompt == prompt_id:
+            await transport.post("/interrupt", json={"prompt_id": prompt_id})
+            outcome = "interrupted"
+    except Exception as e:
+        logger.warning("Could not cancel prompt %s on %s: %s", prompt_id, backend.server_address, e)
+    
+    backend.listener.abandon(prompt_id, reason)
+    backend.tracker.abandon(prompt_id, reason)
+    metrics.inc("isogen_prompts_cancelled_total", outcome=outcome or "unreachable")
+    logger.info("Cancelled prompt %s on %s (%s): %s", prompt_id, backend.server_address, outcome or "unreachable", reason)
+    return outcome
+
+def cancel_prompt_soon(backend, prompt_id, reason="Client disconnected"):
+    """Run cancel_prompt in the background so the cancellation that asked for it isn't held up"""
+    task = asyncio.create_task(cancel_prompt(backend, prompt_id, reason))
+    _cancel_tasks.add(task)
+    task.add_done_callback(_cancel_tasks.discard)
+
+async def process_workflow(backend, workflow_data, progress=None, output_selector=select_output_image):
+    """Queue a workflow and await the images output_selector picks, over the WebSocket or by polling"""
+    listener = backend.listener
+    if await listener.wait_connected(COMFY_WS_CONNECT_TIMEOUT):
+        watcher = listener
+    else:
+        logger.warning("No WebSocket connection to ComfyUI at %s, falling back to polling", backend.server_address)
+        watcher = backend.tracker
+    on_event = progress_forwarder(workflow_data, progress) if progress else None
+    
+    prompt_id = str(uuid.uuid4())
+    try:
+        prompt_id, watch = await submit_and_watch(watcher, workflow_data, on_event, prompt_id)
+    except asyncio.CancelledError as e:
+        # ComfyUI may have queued the prompt before the cancellation landed
+        cancel_prompt_soon(backend, prompt_id, *e.args[:1])
+        raise
+    logger.debug("Queued prompt %s on %s", prompt_id, backend.server_address)
+    if progress:
+        progress("submitted", {"prompt_id": prompt_id, "backend": backend.server_address})
+    try:
+        outputs = await asyncio.wait_for(asyncio.wrap_future(watch.future), COMFY_PROMPT_TIMEOUT)
+    except asyncio.TimeoutError:
+        watcher.unwatch(watch)
+        await cancel_prompt(backend, prompt_id, reason="Timed out")
+        raise TimeoutError(f"Prompt {prompt_id} did not finish within {COMFY_PROMPT_TIMEOUT}s")
+    except asyncio.CancelledError as e:
+        watcher.unwatch(watch)
+        # Nobody is waiting for this prompt any more, free the GPU
+        cancel_prompt_soon(backend, prompt_id, *e.args[:1])
+        raise
+    except BaseException:
+        watcher.unwatch(watch)
+        raise
+    
+    if progress:
+        progress("stage", {"stage": "fetching_output"})
+    client = AsyncComfyUIClient(backend.transport, client_id=watcher.client_id)
+    if watcher is listener:
+        outputs = (await client.get_history(prompt_id))[prompt_id]['outputs']
+    
+    # Resolve the wanted outputs first so discarded images are never downloaded
+    selection = output_selector(outputs, workflow_data)
+    if not selection:
+        raise Exception("No output image found in workflow results")
+    return await download_selected_images(client, selection)
+
+async def download_selected_images(client, selection):
+    """download_selected_images from comfy_service, fetching several refs concurrently"""
+    if "filename" in selection:
+        return await client.get_image(selection['filename'], selection.get('subfolder', ''),
+                                      selection.get('type', 'output'))
+    keys = [key for key, ref in selection.items() if ref]
+    images = await asyncio.gather(*(client.get_image(selection[key]['filename'], selection[key].get('subfolder', ''),
+                                                     selection[key].get('type', 'output')) for key in keys))
+    fetched = dict(zip(keys, images))
+    return {key: fetched.get(key) for key in selection}
+
+def unavailable_error(e, backend):
+    backend.capabilities.invalidate()
+    return ProcessingError(
+        "ComfyUI not available",
+        details=str(e),
+        suggestion="Start ComfyUI with: python main.py --listen",
+        status_code=503
+    )
+
+def current_template():
+    template = get_workflow_template()
+    if not template.current():
+        raise ProcessingError(
+            "Workflow not found",
+            details=f"Could not load {WORKFLOW_FILE}",
+            suggestion="Ensure the workflow JSON file exists in the project root"
+        )
+    return template
+
+async def stage_job_input(image_data, backend):
+    """Stage the input bytes on a leased backend, mapping failures to API errors"""
+    try:
+        return await stage_input_image(image_data, backend.transport)
+    except ComfyUIUnavailableError as e:
+        raise unavailable_error(e, backend)
+    except ValueError as e:
+        raise ProcessingError("Invalid image data", details=str(e), status_code=400)
+    except Exception as e:
+        raise ProcessingError("Failed to stage input image", details=str(e))
+
+async def execute_workflow(backend, workflow, output_selector=select_output_image, progress=None):
+    """Run a prepared workflow on a leased backend, mapping failures to API errors"""
+    if progress:
+        progress("stage", {"stage": "submitting"})
+    try:
+        return await process_workflow(backend, workflow, progress, output_selector)
+    except ComfyUIUnavailableError as e:
+        logger.error("ComfyUI unavailable: %s", e)
+        raise unavailable_error(e, backend)
+    except Exception as e:
+        logger.error("ComfyUI processing failed: %s", e)
+        backend.capabilities.invalidate()
+        raise ProcessingError(
+            "ComfyUI processing failed",
+            details=str(e),
+            suggestion="Check ComfyUI console for detailed error messages"
+        )
+
+async def run_generation_pipeline(pool, image_data, prompt, seed=None, deterministic_seed=DETERMINISTIC_SEEDS,
+                                  profile=WORKFLOW_DEFAULT_PROFILE, progress=None):
+    """run_generation_pipeline from comfy_service, awaiting ComfyUI instead of blocking on it"""
+    template = current_template()
+    input_hash = hashlib.sha256(image_data).hexdigest()
+    seed = resolve_seed(seed, deterministic_seed, input_hash, prompt)
+    cache_key = None
+    if seed is not None:
+        cache_key = generation_cache_key(input_hash, prompt, seed, template, profile)
+        # A disk-tier hit reads a file, keep it off the loop
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            logger.info("Result cache hit (%s)", cache_key[:12])
+            result = cached_output_result(cached[0], prompt, seed, profile)
+            result.update(input_filename=staged_input_name(image_data)[0],
+                          workflow_nodes=len(template.profile_graph(profile)))
+            return result
+    
+    with pool.lease(affinity=(input_hash, prompt)) as backend:
+        ensure_comfyui_ready(backend)
+        
+        if progress:
+            progress("stage", {"stage": "staging_input"})
+        input_filename = await stage_job_input(image_data, backend)
+        
+        if seed is None:
+            seed = random.randint(1, 2**32 - 1)
+        updated_workflow = update_workflow_for_processing(template, input_filename, prompt, profile=profile, seed=seed)
+        if not updated_workflow:
+            raise ProcessingError(
+                "Failed to update workflow",
+                details="Could not customize workflow with input parameters"
+            )
+        output_image_data = await execute_workflow(backend, updated_workflow, progress=progress)
+    
+    input_artifact = artifact_store.put("input", image_data) if SAVE_INPUTS_LOCALLY else None
+    output_artifact = artifact_store.put("output", output_image_data) if SAVE_OUTPUTS_LOCALLY else None
+    
+    result = make_output_result(output_image_data, prompt, seed, output_artifact=output_artifact, profile=profile)
+    result.update(input_filename=input_filename, input_artifact=input_artifact, workflow_nodes=len(updated_workflow))
+    if cache_key:
+        result_cache.put(cache_key, output_image_data, result["output_mime_type"])
+    return result
+
+async def run_batch_pipeline(pool, image_data, prompt, variants, deterministic_seed=DETERMINISTIC_SEEDS,
+                             profile=WORKFLOW_DEFAULT_PROFILE, progress=None):
+    """run_batch_pipeline from comfy_service: every variant of one input in a single ComfyUI graph"""
+    template = current_template()
+    # Cache lookups of the variants may read files from the disk tier
+    input_hash, results, pending = await asyncio.to_thread(plan_batch_variants, template, image_data, prompt,
+                                                           variants, deterministic_seed, profile)
+    workflow = None
+    input_filename = None
+    input_artifact = None
+    if pending:
+        with pool.lease(affinity=(input_hash, prompt)) as backend:
+            ensure_comfyui_ready(backend)
+            if progress:
+                progress("stage", {"stage": "staging_input"})
+            input_filename = await stage_job_input(image_data, backend)
+            if SAVE_INPUTS_LOCALLY:
+                input_artifact = artifact_store.put("input", image_data)
+            
+            workflow, select_variant_images = build_batch_workflow(template, input_filename, pending, profile)
+            output_images = await execute_workflow(backend, workflow, select_variant_images, progress)
+        
+        collect_batch_outputs(results, pending, output_images, profile)
+    
+    return batch_result(template, image_data, prompt, results, pending, input_filename, input_artifact, workflow,
+                        profile)
+
+def error_response(payload, status):
+    return web.json_response(payload, status=status)
+
+def request_client_id(request, fields=None):
+    """Whom a request counts against: the X-Client-Id header, the client_id field, then the remote address"""
+    fields = request.query if fields is None else fields
+    return request.headers.get(ADMISSION_CLIENT_HEADER) or fields.get('client_id') or request.remote
+
+async def parse_generation_request(request):
+    """Extract image bytes and prompt from a JSON, multipart or raw image body
+
+    Returns (params, error_response), like parse_generation_request of comfy_service.
+    """
+    started = time.perf_counter()
+    if request.content_type == "multipart/form-data":
+        fields = await request.post()
+        upload = fields.get("image")
+        image_data = upload.file.read() if isinstance(upload, web.FileField) else None
+    elif request.content_type.startswith("image/"):
+        image_data = await request.read()
+        fields = request.query
+    else:
+        try:
+            fields = await request.json()
+        except ValueError:
+            fields = None
+        if not isinstance(fields, dict) or 'image' not in fields:
+            return None, error_response({"error": "No image data provided"}, 400)
+        try:
+            image_data = decode_base64_image(fields['image'])
+        except Exception as e:
+            return None, error_response({"error": "Invalid image data", "details": str(e)}, 400)
+    
+    if not image_data:
+        return None, error_response({"error": "No image data provided"}, 400)
+    timings = {"decode": time.perf_counter() - started}
+    metrics.observe("isogen_stage_seconds", timings["decode"], stage="decode")
+    
+    if INPUT_NORMALIZE:
+        # Decoding and resizing is CPU work, keep it off the event loop
+        try:
+            image_data, timings["normalize"] = await asyncio.to_thread(timed_normalize_input, image_data)
+        except ValueError as e:
+            return None, error_response({"error": "Invalid image data", "details": str(e)}, 400)
+    
+    try:
+        options = parse_generation_options(fields)
+        # Checked now so a bad rendition doesn't surface only after the GPU work
+        parse_rendition(request.query)
+    except ValueError as e:
+        return None, error_response({"error": "Invalid parameters", "details": str(e)}, 400)
+    if options.pop("progressive", False):
+        return None, error_response({"error": "Invalid parameters",
+                                     "details": "progressive is only supported by the threaded server"}, 400)
+    
+    lane = fields.get('priority') or None
+    if lane is not None and lane not in ADMISSION_LANES:
+        return None, error_response({"error": "Invalid parameters",
+                                     "details": f"priority must be one of {', '.join(ADMISSION_LANES)}"}, 400)
+    
+    prompt = normalize_prompt(fields.get('prompt') or "") or DEFAULT_PROMPT
+    logger.debug("Generation request: %d image bytes (%s), prompt %.100r",
+                 len(image_data), request.content_type or "no content type", prompt)
+    return {"image_data": image_data, "prompt": prompt, "options": options, "fields": fields, "timings": timings,
+            "client_id": request_client_id(request, fields), "lane": lane}, None
+
+def submit(state, image_data, prompt, pipeline=None, timings=None, client_id=None, lane=None, **options):
+    """JobManager.submit for the event loop, raises JobQueueFullError when admission is refused
+
+    A request identical to an unfinished job is merged into it: the existing
+    job is returned, still counted against the client's admission limit.
+    """
+    job = Job(image_data, prompt, options, pipeline or run_generation_pipeline, timings, client_id,
+              lane or ADMISSION_DEFAULT_LANE)
+    prune_jobs(state)
+    running = state["in_flight"].get(job.fingerprint)
+    if running is not None and state["admission"].attach(running, job.client_id):
+        running.touch()
+        if state["admission"].promote(running, job.lane):
+            logger.info("Job %s promoted to lane %s by a merged request", running.id, running.lane)
+        metrics.inc("isogen_jobs_merged_total")
+        logger.info("Request merged into in-flight job %s (%d attached)", running.id, running.attached)
+        return running
+    pending = start_flight(state, job)
+    logger.info("Job %s queued in lane %s (%d waiting)", job.id, job.lane, pending)
+    return job
+
+def start_flight(state, job):
+    """Admit a job and run it in its own task, so every request merged into it can wait on the same result"""
+    pending = state["admission"].push(job)
+    task = state["tasks"][job.id] = asyncio.create_task(run_job(state, job))
+    state["in_flight"][job.fingerprint] = job
+    state["jobs"][job.id] = job
+
+    def forget(task):
+        state["tasks"].pop(job.id, None)
+        if state["in_flight"].get(job.fingerprint) is job:
+            del state["in_flight"][job.fingerprint]
+        if not job.finished:
+            # Cancelled before it got a turn
+            state["admission"].remove(job)
+            job.fail(JobCancelledError(details=job.cancel_reason or "Client disconnected"))
+            job.finish()
+    task.add_done_callback(forget)
+    return pending
+
+async def run_job(state, job):
+    """Wait for a turn and run the job's pipeline; cancelling the task stops it wherever it is"""
+    await wait_for_turn(state, job)
+    
+    job.start()
+    try:
+        job.result = await job.pipeline(state["pool"], job.image_data, job.prompt, progress=job.publish,
+                                        **job.options)
+        job.status = "completed"
+    except asyncio.CancelledError:
+        # The lease and the watch are released and the prompt cancelled on the way out
+        job.fail(JobCancelledError(details=job.cancel_reason or "Client disconnected"))
+        raise
+    except Exception as e:
+        job.fail(e)
+    finally:
+        job.finish()
+        end_turn(state, job)
+
+async def wait_for_turn(state, job):
+    """Return once the admitted job may use a backend slot"""
+    turn = state["turns"][job.id] = asyncio.get_running_loop().create_future()
+    dispatch(state)
+    try:
+        await turn
+    except asyncio.CancelledError:
+        # Cancelled while waiting; give the turn back if it was already granted
+        state["turns"].pop(job.id, None)
+        if not state["admission"].remove(job) and turn.done() and not turn.cancelled():
+            end_turn(state, job)
+        raise
+
+def dispatch(state):
+    """Grant turns in fair order while the pool has free slots
+
+    Only backends in rotation count, so with one of them down jobs keep
+    waiting here instead of failing their lease. With none in rotation the
+    turns go out anyway and the lease answers 503 straight away.
+    """
+    pool = state["pool"]
+    while state["running"] < (pool.available_slots or pool.slots):
+        job = state["admission"].pop()
+        if job is None:
+            return
+        state["running"] += 1
+        state["turns"].pop(job.id).set_result(None)
+
+def end_turn(state, job):
+    state["running"] -= 1
+    state["admission"].done(job)
+    dispatch(state)
+
+def cancel_flight(state, job, reason="Cancelled by the client", detach=True, client_id=None):
+    """JobManager.cancel for the event loop: cancelling the job's task stops it wherever it is
+
+    With detach, client_id only removes its own request: a job other merged
+    requests still wait on keeps running, and a client with no request
+    attached can't cancel it. Returns False if the job had already finished
+    or been cancelled, or client_id has nothing to detach.
+    """
+    if job.finished or job.cancel_reason is not None:
+        return False
+    if detach:
+        if client_id is not None and not state["admission"].holds(job, client_id):
+            return False
+        if job.attached > 1:
+            state["admission"].detach(job, client_id if client_id is not None else job.client_id)
+            logger.info("Request detached from job %s: %s (%d still attached)", job.id, reason, job.attached)
+            return True
+    # Nobody may attach to a job on its way out
+    if state["in_flight"].get(job.fingerprint) is job:
+        del state["in_flight"][job.fingerprint]
+    job.cancel_reason = reason
+    state["tasks"][job.id].cancel(reason)
+    logger.info("Cancelling job %s: %s", job.id, reason)
+    return True
+
+async def wait_for_client(state, job, client_id):
+    """Await the job; detaches client_id if the client disconnects first (aiohttp cancels the handler)"""
+    task = state["tasks"].get(job.id)
+    if task is None:
+        return
+    try:
+        await asyncio.wait([task])
+    except asyncio.CancelledError:
+        cancel_flight(state, job, "Client disconnected", client_id=client_id)
+        raise
+
+def prune_jobs(state):
+    """Forget finished jobs older than JOB_RESULT_TTL, and the oldest beyond ASYNC_RECENT_JOBS"""
+    jobs = state["jobs"]
+    cutoff = time.time() - JOB_RESULT_TTL
+    finished = [job for job in jobs.values() if job.finished]
+    excess = len(finished) - ASYNC_RECENT_JOBS
+    for job in finished:
+        if excess > 0 or job.finished_at < cutoff:
+            del jobs[job.id]
+            excess -= 1
+
+async def housekeep(state):
+    """Expire finished jobs and reap abandoned ones on a timer, like the JobManager housekeeping thread"""
+    while True:
+        await asyncio.sleep(min(JOB_ABANDON_AFTER / 2, JOB_HOUSEKEEPING_INTERVAL) if JOB_ABANDON_AFTER
+                            else JOB_HOUSEKEEPING_INTERVAL)
+        prune_jobs(state)
+        if not JOB_ABANDON_AFTER:
+            continue
+        # Jobs submitted to be fetched later, without an event stream, are never reaped
+        cutoff = time.time() - JOB_ABANDON_AFTER
+        abandoned = [job for job in state["jobs"].values()
+                     if not job.finished and job.streamed and job.last_seen < cutoff and not job.subscribed]
+        for job in abandoned:
+            cancel_flight(state, job, f"Abandoned: nobody followed the job for {JOB_ABANDON_AFTER}s", detach=False)
+
+def queue_full_response(e):
+    """429 with Retry-After for a submission the admission queue turned away"""
+    return web.json_response({
+        "error": "Too many pending jobs" if e.reason == "client_limit" else "Job queue full",
+        "details": str(e),
+        "retry_after": e.retry_after,
+        "suggestion": "Retry once some of the running generations have finished"
+    }, status=429, headers={"Retry-After": str(e.retry_after)})
+
+def job_accepted_response(job):
+    status = job.to_dict()
+    status["status_url"] = f"/api/jobs/{job.id}"
+    status["result_url"] = f"/api/jobs/{job.id}/result"
+    status["image_url"] = f"/api/jobs/{job.id}/image"
+    return web.json_response(status, status=202)
+
+def find_job(request):
+    """The job named in the URL, or None"""
+    return request.app["isogen"]["jobs"].get(request.match_info["job_id"])
+
+def job_not_found(request):
+    return error_response({"error": "Job not found", "job_id": request.match_info["job_id"]}, 404)
+
+async def job_result_response(request, job):
+    """JSON response for a finished job, inlining a rendition if the query asks for one"""
+    if job.status in ("failed", "cancelled"):
+        return error_response(job.error, job.error_status or 500)
+    try:
+        rendition = parse_rendition(request.query, request.headers.get("Accept"))
+    except ValueError as e:
+        return error_response({"error": "Invalid parameters", "details": str(e)}, 400)
+    if rendition:
+        # Transcoding is CPU work, keep it off the event loop
+        return web.json_response(await asyncio.to_thread(job_result_payload, job, rendition))
+    return web.json_response(job_result_payload(job))
+
+async def submit_job(request):
+    """Queue a generation job and return its id immediately"""
+    params, error = await parse_generation_request(request)
+    if error:
+        return error
+    
+    try:
+        job = submit(request.app["isogen"], params["image_data"], params["prompt"], timings=params["timings"],
+                     client_id=params["client_id"], lane=params["lane"], **params["options"])
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    return job_accepted_response(job)
+
+async def get_job_status(request):
+    """Get the status of a generation job"""
+    job = find_job(request)
+    if not job:
+        return job_not_found(request)
+    job.touch()
+    return web.json_response(job.to_dict())
+
+async def cancel_job(request):
+    """Cancel a queued or running job, deleting or interrupting its ComfyUI prompt
+
+    The client is identified like on submission (X-Client-Id, ?client_id=,
+    remote address); with several merged requests it only detaches its own.
+    """
+    state = request.app["isogen"]
+    job = find_job(request)
+    if not job:
+        return job_not_found(request)
+    if not cancel_flight(state, job, client_id=request_client_id(request)) and job.cancel_reason is None:
+        if not job.finished:
+            # Merged requests share the job id; each client may only withdraw its own
+            return error_response({"error": "No request of this client is attached to the job", "job_id": job.id},
+                                  403)
+        return error_response({"error": "Job already finished", "job_id": job.id, "status": job.status}, 409)
+    task = state["tasks"].get(job.id)
+    if task is not None:
+        # The task unwinds at its next await, usually right away
+        await asyncio.wait([task], timeout=JOB_DISCONNECT_POLL)
+    return web.json_response(job.to_dict(), status=200 if job.finished else 202)
+
+async def get_job_result(request):
+    """Get the output of a generation job, 202 while it is still running"""
+    job = find_job(request)
+    if not job:
+        return job_not_found(request)
+    job.touch()
+    if not job.finished:
+        return web.json_response(job.to_dict(), status=202)
+    return await job_result_response(request, job)
+
+async def process_base64_image(request):
+    """Process base64 image with real ComfyUI workflow"""
+    state = request.app["isogen"]
+    params, error = await parse_generation_request(request)
+    if error:
+        return error
+    
+    try:
+        job = submit(state, params["image_data"], params["prompt"], timings=params["timings"],
+                     client_id=params["client_id"], lane=params["lane"], **params["options"])
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    # Blocking wrapper around the job API for existing clients
+    await wait_for_client(state, job, params["client_id"])
+    return await job_result_response(request, job)
+
+async def get_job_image(request):
+    """Get the output image of a generation job as raw bytes"""
+    job = find_job(request)
+    if not job:
+        return job_not_found(request)
+    job.touch()
+    if parse_flag(request.query.get("draft", "")):
+        # Only progressive jobs have a draft, and this server does not run them
+        if job.finished:
+            return error_response({"error": "Job has no draft", "job_id": job.id}, 404)
+        return web.json_response(job.to_dict(), status=202)
+    if not job.finished:
+        return web.json_response(job.to_dict(), status=202)
+    return await job_image_response(request, job)
+
+async def job_image_response(request, job):
+    """Serve a finished job's output image as raw bytes with an ETag"""
+    if job.status in ("failed", "cancelled"):
+        return error_response(job.error, job.error_status or 500)
+    
+    output = job.result
+    if "variants" in output:
+        try:
+            index = int(request.query.get("variant", 0))
+        except ValueError:
+            index = 0
+        if not 0 <= index < len(output["variants"]):
+            return error_response({"error": "Variant not found", "variant": index}, 404)
+        output = output["variants"][index]
+    
+    headers = {
+        "Cache-Control": "private, max-age=3600",
+        "X-Job-Id": job.id,
+        "Server-Timing": ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in job.timings.items())
+    }
+    return await image_response(request, output["output_data"], output["output_mime_type"], output["output_etag"],
+                                headers)
+
+class JobEvents(asyncio.Queue):
+    """Subscriber queue for Job.publish on the event loop; a full queue raises queue.Full like the threaded one"""
+    def put_nowait(self, item):
+        try:
+            super().put_nowait(item)
+        except asyncio.QueueFull:
+            raise queue.Full from None
+
+async def stream_job_events(request):
+    """Server-Sent Events stream of a job's stage, node and sampler progress
+
+    Pass ?previews=1 to also receive downscaled JPEG previews of the sampler.
+    """
+    job = find_job(request)
+    if not job:
+        return job_not_found(request)
+    events = job.subscribe(previews=parse_flag(request.query.get("previews", "0")),
+                           events=JobEvents(maxsize=JOB_EVENT_BUFFER))
+    # The CORS middleware can't add headers once the stream has started
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Access-Control-Allow-Origin": "*"
+    })
+    try:
+        await response.prepare(request)
+        await response.write(sse_event("status", job.to_dict()).encode())
+        while True:
+            if job.finished and events.empty():
+                # Finished before we subscribed, or the final event was dropped
+                await response.write(sse_event(*job.terminal_event()).encode())
+                break
+            try:
+                event_type, data = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+            await response.write(sse_event(event_type, data).encode())
+            if event_type in ("completed", "failed", "cancelled"):
+                break
+    finally:
+        job.unsubscribe(events)
+    return response
+
+async def process_binary_image(request):
+    """Process a multipart or raw image/* upload and return the output image bytes
+
+    With ?response=url the job is queued and its image URL returned right away.
+    """
+    state = request.app["isogen"]
+    params, error = await parse_generation_request(request)
+    if error:
+        return error
+    
+    try:
+        job = submit(state, params["image_data"], params["prompt"], timings=params["timings"],
+                     client_id=params["client_id"], lane=params["lane"], **params["options"])
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    if request.query.get("response") == "url":
+        return job_accepted_response(job)
+    
+    await wait_for_client(state, job, params["client_id"])
+    return await job_image_response(request, job)
+
+async def process_batch(request):
+    """Generate several prompt/seed variants of one image in a single ComfyUI run
+
+    Accepts the same body formats as /api/process plus prompts, seeds and
+    batch_size. With ?response=url the job is queued and returned right away.
+    """
+    state = request.app["isogen"]
+    params, error = await parse_generation_request(request)
+    if error:
+        return error
+    
+    options = params["options"]
+    try:
+        variants = parse_batch_variants(params["fields"], options)
+    except ValueError as e:
+        return error_response({"error": "Invalid parameters", "details": str(e)}, 400)
+    options.pop("seed", None)
+    
+    try:
+        job = submit(state, params["image_data"], params["prompt"], pipeline=run_batch_pipeline,
+                     timings=params["timings"], client_id=params["client_id"],
+                     lane=params["lane"] or ADMISSION_BATCH_LANE, variants=variants, **options)
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    
+    if request.query.get("response") == "url":
+        return job_accepted_response(job)
+    
+    await wait_for_client(state, job, params["client_id"])
+    return await job_result_response(request, job)
+
+def not_modified(request, etag):
+    return f'"{etag}"' in request.headers.get("If-None-Match", "")
+
+async def image_response(request, data, mime_type, etag, headers, path=None):
+    """Image bytes (read from path when data is None) or the rendition the query asks for, with an ETag"""
+    try:
+        rendition = parse_rendition(request.query, request.headers.get("Accept"))
+    except ValueError as e:
+        return error_response({"error": "Invalid parameters", "details": str(e)}, 400)
+    response_etag = etag
+    if rendition is not None:
+        response_etag = rendition_etag(etag, rendition)
+        if rendition["negotiated"]:
+            headers["Vary"] = "Accept"
+    headers["ETag"] = f'"{response_etag}"'
+    if not_modified(request, response_etag):
+        return web.Response(status=304, headers=headers)
+    
+    if data is None:
+        try:
+            data = await asyncio.to_thread(_read_file, path)
+        except FileNotFoundError:
+            return None
+    if rendition is not None:
+        # Transcoding is CPU work, keep it off the event loop
+        data, mime_type = await asyncio.to_thread(get_rendition, data, etag, rendition)
+    return web.Response(body=data, content_type=mime_type, headers=headers)
+
+async def get_artifact(request):
+    """Serve a stored input or output by id, or a rendition of it"""
+    artifact_id = request.match_info["artifact_id"]
+    entry, data = artifact_store.get(artifact_id)
+    if entry is not None:
+        headers = {"Cache-Control": "private, max-age=31536000, immutable"}
+        response = await image_response(request, data, entry["mime_type"], artifact_id, headers, path=entry["path"])
+        if response is not None:
+            return response
+    return error_response({"error": "Artifact not found", "artifact_id": artifact_id}, 404)
+
+async def list_artifacts(request):
+    """Stored inputs and outputs, newest first (?kind=input|output&limit=N)"""
+    kind = request.query.get("kind")
+    if kind is not None and kind not in ARTIFACT_KINDS:
+        return error_response({"error": "Invalid kind", "details": f"kind must be one of {', '.join(ARTIFACT_KINDS)}"},
+                              400)
+    try:
+        limit = min(int(request.query.get("limit", 50)), 1000)
+    except ValueError:
+        limit = 50
+    return web.json_response({
+        "artifacts": [artifact_payload(entry) for entry in artifact_store.list(kind, limit)],
+        "stats": artifact_store.stats()
+    })
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def health_check(request):
+    """Enhanced health check with ComfyUI and model status"""
+    state = request.app["isogen"]
+    try:
+        payload = health_payload(state["pool"])
+    except Exception as e:
+        return error_response({"status": "error", "error": str(e), "timestamp": datetime.now().isoformat()}, 500)
+    payload["serving_mode"] = "asyncio"
+    payload["running"] = state["running"]
+    payload["admission"] = state["admission"].stats()
+    return web.json_response(payload)
+
+async def test_endpoint(request):
+    """Simple test endpoint"""
+    return web.json_response({
+        "message": "Backend is working!",
+        "timestamp": datetime.now().isoformat(),
+        "mode": "real_comfyui_integration"
+    })
+
+async def get_cache_stats(request):
+    """Result cache hit/miss counters and sizes, plus ComfyUI's own node cache reuse"""
+    stats = result_cache.stats()
+    listeners = [backend.listener for backend in request.app["isogen"]["pool"].backends]
+    cached = sum(listener.nodes_cached for listener in listeners)
+    executed = sum(listener.nodes_executed for listener in listeners)
+    stats["renditions"] = rendition_cache.stats()
+    stats["comfyui_nodes"] = {
+        "cached": cached,
+        "executed": executed,
+        "hit_rate": round(cached / (cached + executed), 3) if cached + executed else None
+    }
+    return web.json_response(stats)
+
+async def list_models(request):
+    """List available models in ComfyUI"""
+    backend = next((b for b in request.app["isogen"]["pool"].backends if b.available), None)
+    if backend is None:
+        return error_response({"error": "ComfyUI not connected"}, 503)
+    
+    capabilities = backend.capabilities
+    if capabilities.object_info is None:
+        # Not fetched yet (or dropped after a failure), load it once now
+        await capabilities.refresh()
+    if capabilities.object_info is None:
+        return error_response({"error": "Could not fetch model info"}, 500)
+    return web.json_response(capabilities.object_info)
+
+async def fetch_queue(backend):
+    if not backend.available:
+        return {"error": "unavailable"}
+    try:
+        response = await backend.transport.get("/queue")
+    except ComfyUIUnavailableError as e:
+        return {"error": str(e)}
+    if response.status_code != 200:
+        return {"error": "Could not fetch queue info"}
+    return response.json()
+
+async def get_queue(request):
+    """Get current ComfyUI queue status, merged across the pool and per backend"""
+    pool = request.app["isogen"]["pool"]
+    if not pool.any_available():
+        return error_response({"error": "ComfyUI not connected"}, 503)
+    
+    samples = await asyncio.gather(*(fetch_queue(backend) for backend in pool.backends))
+    merged = {"queue_running": [], "queue_pending": [], "backends": {}}
+    for backend, data in zip(pool.backends, samples):
+        merged["queue_running"].extend(data.get('queue_running', []))
+        merged["queue_pending"].extend(data.get('queue_pending', []))
+        merged["backends"][backend.url] = data
+    # Requests still waiting here, not yet submitted to any backend
+    merged["admission"] = request.app["isogen"]["admission"].stats()
+    return web.json_response(merged)
+
+def app_metrics(state):
+    """Pool, job and admission gauges of this app, in place of comfy_service's thread-pool collectors"""
+    if state["pool"] is None:
+        return
+    yield from pool_metrics(state["pool"])
+    counts = {}
+    for job in state["jobs"].values():
+        counts[job.status] = counts.get(job.status, 0) + 1
+    yield from job_metrics({"jobs": counts, "admission": state["admission"].stats()})
+
+async def get_metrics(request):
+    """Stage timings, job and request counters, pool and cache state (Prometheus text format)"""
+    return web.Response(body=metrics.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+if web is not None:
+    @web.middleware
+    async def cors_and_metrics(request, handler):
+        """Flask-CORS's allow-all defaults plus the per-endpoint request metrics of the Flask app"""
+        started = time.perf_counter()
+        if request.method == "OPTIONS":
+            response = web.Response(headers={
+                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers": request.headers.get("Access-Control-Request-Headers", "*")
+            })
+        else:
+            response = await handler(request)
+        if not response.prepared:
+            response.headers["Access-Control-Allow-Origin"] = "*"
+        route = request.match_info.route
+        endpoint = route.name if route and route.name else "unknown"
+        metrics.inc("isogen_http_requests_total", endpoint=endpoint, status=response.status)
+        metrics.observe("isogen_http_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+        return response
+
+def create_app(urls=COMFY_UI_URLS):
+    """Build the aiohttp application; the pool and its session live as long as the app"""
+    if web is None:
+        raise RuntimeError("The asyncio serving mode requires aiohttp (pip install aiohttp)")
+    app = web.Application(middlewares=[cors_and_metrics], client_max_size=64 * 1024 * 1024)
+    app["isogen"] = {"pool": None, "session": None, "admission": None, "turns": {}, "in_flight": {}, "tasks": {},
+                     "running": 0, "jobs": OrderedDict(), "housekeeping": None}
+    collector = partial(app_metrics, app["isogen"])
+
+    async def start_pool(app):
+        state = app["isogen"]
+        # One connection pool for every backend; +1 per host for the event WebSocket
+        state["session"] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=0, limit_per_host=COMFY_HTTP_POOL_SIZE + 1))
+        state["pool"] = pool = await AsyncBackendPool(state["session"], urls).start()
+        state["admission"] = AdmissionQueue(max_pending=ASYNC_MAX_PENDING, slots=pool.slots,
+                                            job_seconds=pool.average_latency)
+        state["housekeeping"] = asyncio.create_task(housekeep(state), name="comfy-job-housekeeping")
+        # The defaults would start comfy_service's threaded pool and report its idle job manager
+        metrics.remove_collector(pool_metrics)
+        metrics.remove_collector(job_metrics)
+        metrics.add_collector(collector)
+
+    async def stop_pool(app):
+        state = app["isogen"]
+        metrics.remove_collector(collector)
+        state["housekeeping"].cancel()
+        for task in list(state["tasks"].values()):
+            task.cancel()
+        await asyncio.gather(state["housekeeping"], *state["tasks"].values(), return_exceptions=True)
+        # Let the prompts of those jobs be cancelled while the listeners can still tell which one is running
+        await asyncio.gather(*_cancel_tasks, return_exceptions=True)
+        await state["pool"].close()
+        await state["session"].close()
+    
+    app.on_startup.append(start_pool)
+    app.on_cleanup.append(stop_pool)
+    app.router.add_get('/api/health', health_check, name="health_check")
+    app.router.add_get('/api/test', test_endpoint, name="test_endpoint")
+    app.router.add_get('/api/models', list_models, name="list_models")
+    app.router.add_get('/api/queue', get_queue, name="get_queue")
+    app.router.add_get('/api/cache', get_cache_stats, name="get_cache_stats")
+    app.router.add_get('/api/metrics', get_metrics, name="get_metrics")
+    app.router.add_post('/api/jobs', submit_job, name="submit_job")
+    app.router.add_get('/api/jobs/{job_id}', get_job_status, name="get_job_status")
+    app.router.add_post('/api/jobs/{job_id}/cancel', cancel_job, name="cancel_job")
+    app.router.add_get('/api/jobs/{job_id}/result', get_job_result, name="get_job_result")
+    app.router.add_get('/api/jobs/{job_id}/image', get_job_image, name="get_job_image")
+    app.router.add_get('/api/jobs/{job_id}/events', stream_job_events, name="stream_job_events")
+    app.router.add_post('/api/process-base64', process_base64_image, name="process_base64_image")
+    app.router.add_post('/api/process', process_binary_image, name="process_binary_image")
+    app.router.add_post('/api/batch', process_batch, name="process_batch")
+    app.router.add_get('/api/artifacts', list_artifacts, name="list_artifacts")
+    app.router.add_get('/api/artifacts/{artifact_id}', get_artifact, name="get_artifact")
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the isOGen API from a single asyncio event loop")
+    parser.add_argument("--host", default=ASYNC_HOST)
+    parser.add_argument("--port", type=int, default=ASYNC_PORT)
+    args = parser.parse_args()
+    if web is None:
+        raise SystemExit("The asyncio serving mode requires aiohttp: pip install aiohttp")
+    
+    print("=" * 60)
+    print("🚀 Starting isOGen Backend (asyncio mode)")
+    print("=" * 60)
+    print(f"📡 ComfyUI URLs: {', '.join(COMFY_UI_URLS)}")
+    print(f"📁 Artifact directory: {ARTIFACT_DIR}")
+    print(f"📋 Workflow file: {WORKFLOW_FILE}")
+    print(f"⏳ Up to {ASYNC_MAX_PENDING} generations waiting for a backend slot")
+    print("\n🌐 Available Endpoints:")
+    print("  GET  /api/health - Health check with ComfyUI status")
+    print("  GET  /api/test - Simple test")
+    print("  GET  /api/models - List available ComfyUI models")
+    print("  GET  /api/queue - ComfyUI queue status")
+    print("  GET  /api/cache - Result cache and ComfyUI node cache statistics")
+    print("  GET  /api/metrics - Prometheus metrics (stage timings, pool, cache)")
+    print("  GET  /api/artifacts - Stored inputs/outputs (GET /api/artifacts/<id> serves one)")
+    print("  POST /api/process-base64 - Process image with real ComfyUI workflow")
+    print("  POST /api/jobs - Queue a generation job (returns job id)")
+    print("  GET  /api/jobs/<id> - Job status")
+    print("  GET  /api/jobs/<id>/result - Job output")
+    print("  GET  /api/jobs/<id>/image - Job output image (binary)")
+    print("  GET  /api/jobs/<id>/events - Live job progress (Server-Sent Events)")
+    print("  POST /api/jobs/<id>/cancel - Cancel a job and its ComfyUI prompt")
+    print("  POST /api/process - Process multipart/raw image, returns image bytes")
+    print("  POST /api/batch - Several prompt/seed variants of one image in one run")
+    print("=" * 60)
+    
+    # Cancel handlers whose client disconnects so abandoned generations stop using the GPU
+    web.run_app(create_app(), host=args.host, port=args.port, print=None, handler_cancellation=True)
@@ -0,0 +1,94 @@
+"""
+Shared helpers and fixtures; mock ComfyUI servers (benchmarks/mock_comfyui.py) run as subprocesses
+
+    python -m pytest -q tests
+"""
+
+import io
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_SCRIPT = os.path.join(REPO_DIR, "benchmarks", "mock_comfyui.py")
+
+# The workflow file and output directories are resolved against the working directory
+os.chdir(REPO_DIR)
+sys.path.insert(0, REPO_DIR)
+import comfy_service  # noqa: E402
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until(condition, timeout=10, interval=0.05):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+def make_png(seed):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (seed % 256, 40, 80)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+class MockServer:
+    """One mock ComfyUI process"""
+    def __init__(self, latency):
+        self.port = free_port()
+        self.address = f"127.0.0.1:{self.port}"
+        self.url = f"http://{self.address}"
+        self.process = subprocess.Popen(
+            [sys.executable, MOCK_SCRIPT, "--port", str(self.port), "--latency", str(latency), "--jitter", "0",
+             "--no-previews"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not wait_until(self.responding):
+            self.stop()
+            raise RuntimeError(f"Mock ComfyUI on port {self.port} did not start")
+
+    def responding(self):
+        try:
+            return requests.get(f"{self.url}/system_stats", timeout=1).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def get(self, path):
+        return requests.get(f"{self.url}{path}", timeout=5).json()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+@pytest.fixture
+def mocks(request):
+    latency = getattr(request, "param", 0.3)
+    servers = [MockServer(latency), MockServer(latency)]
+    yield servers
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def pool(mocks, monkeypatch):
+    """A started two-backend pool, installed as the module's pool so pipelines route through it"""
+    monkeypatch.setattr(comfy_service, "POOL_WARMUP", False)
+    monkeypatch.setattr(comfy_service, "SAVE_INPUTS_LOCALLY", False)
+    monkeypatch.setattr(comfy_service, "SAVE_OUTPUTS_LOCALLY", False)
+    pool = comfy_service.BackendPool([server.url for server in mocks], max_in_flight=1, slot_wait=0).start()
+    assert wait_until(lambda: all(backend.available for backend in pool.backends))
+    monkeypatch.setattr(comfy_service, "_backend_pool", pool)
+    return pool
+
+@pytest.fixture
+def job_manager(pool, monkeypatch):
+    monkeypatch.setattr(comfy_service, "JOB_ABANDON_AFTER", 1)
+    return comfy_service.JobManager(max_workers=2, max_pending=8)
@@ -0,0 +1,107 @@
+"""AdmissionQueue lanes, per-client fairness and limits, and the 429 answer of the job API"""
+
+import pytest
+
+import comfy_service
+from conftest import make_png
+from test_job_manager import BlockingPipeline
+
+def make_job(client_id, index, prompt=None, lane="interactive"):
+    return comfy_service.Job(make_png(index), prompt or f"building {index}", client_id=client_id, lane=lane)
+
+def drain(admission):
+    jobs = []
+    while (job := admission.pop()) is not None:
+        jobs.append(job)
+    return jobs
+
+@pytest.fixture
+def admission():
+    return comfy_service.AdmissionQueue(max_pending=16, max_per_client=8, slots=1,
+                                        job_seconds=lambda: 10, affinity_run=0)
+
+def test_higher_lane_is_served_first(admission):
+    bulk = make_job("alice", 1, lane="bulk")
+    interactive = make_job("bob", 2)
+    admission.push(bulk)
+    admission.push(interactive)
+    assert drain(admission) == [interactive, bulk]
+
+def test_clients_take_turns_within_a_lane(admission):
+    alice = [make_job("alice", index) for index in range(3)]
+    bob = make_job("bob", 10)
+    for job in alice + [bob]:
+        admission.push(job)
+    assert drain(admission) == [alice[0], bob, alice[1], alice[2]]
+
+def test_position_follows_dispatch_order(admission):
+    alice = [make_job("alice", index) for index in range(2)]
+    bob = make_job("bob", 10)
+    for job in alice + [bob]:
+        admission.push(job)
+    assert [admission.position(job) for job in alice + [bob]] == [0, 2, 1]
+    assert admission.estimate_wait(2) == 30
+
+def test_jobs_sharing_an_input_or_prompt_may_go_out_of_turn():
+    admission = comfy_service.AdmissionQueue(max_pending=16, max_per_client=8, affinity_run=1)
+    first = make_job("alice", 1, prompt="tower")
+    other = make_job("bob", 2, prompt="house")
+    warm = make_job("carol", 3, prompt="tower")
+    later = make_job("carol", 4, prompt="tower")
+    for job in (first, other, warm, later):
+        admission.push(job)
+    # warm shares the prompt ComfyUI just encoded; later would too, but only affinity_run jobs may jump
+    assert drain(admission) == [first, warm, other, later]
+
+def test_client_limit_and_queue_limit(admission):
+    admission.max_per_client = 2
+    admission.push(make_job("alice", 1))
+    admission.push(make_job("alice", 2))
+    with pytest.raises(comfy_service.JobQueueFullError) as error:
+        admission.push(make_job("alice", 3))
+    assert error.value.reason == "client_limit"
+    assert error.value.retry_after == 10
+
+    admission.max_pending = 3
+    admission.push(make_job("bob", 4))
+    with pytest.raises(comfy_service.JobQueueFullError) as error:
+        admission.push(make_job("carol", 5))
+    assert error.value.reason == "queue_full"
+    assert admission.stats()["rejected"] == {"client_limit": 1, "queue_full": 1}
+
+def test_finished_jobs_free_their_clients_share(admission):
+    admission.max_per_client = 1
+    job = make_job("alice", 1)
+    admission.push(job)
+    assert admission.pop() is job
+    with pytest.raises(comfy_service.JobQueueFullError):
+        admission.push(make_job("alice", 2))
+    admission.done(job)
+    admission.push(make_job("alice", 2))
+
+def test_unknown_lane_is_rejected(admission):
+    with pytest.raises(ValueError):
+        admission.push(make_job("alice", 1, lane="urgent"))
+
+def test_job_api_answers_429_with_retry_after(monkeypatch):
+    manager = comfy_service.JobManager(max_workers=1, max_pending=8)
+    manager.admission.max_per_client = 1
+    monkeypatch.setattr(comfy_service, "job_manager", manager)
+    monkeypatch.setattr(comfy_service, "JOB_ABANDON_AFTER", 0)
+    pipeline = BlockingPipeline()
+    monkeypatch.setattr(comfy_service, "run_generation_pipeline", pipeline)
+    client = comfy_service.app.test_client()
+    try:
+        accepted = client.post("/api/jobs", data=make_png(1), content_type="image/png",
+                               headers={"X-Client-Id": "alice"})
+        assert accepted.status_code == 202
+        refused = client.post("/api/jobs", data=make_png(2), content_type="image/png",
+                              headers={"X-Client-Id": "alice"})
+        assert refused.status_code == 429
+        assert int(refused.headers["Retry-After"]) >= 1
+        assert refused.get_json()["error"] == "Too many pending jobs"
+        # Another client still gets in
+        other = client.post("/api/jobs", data=make_png(3), content_type="image/png", headers={"X-Client-Id": "bob"})
+        assert other.status_code == 202
+    finally:
+        pipeline.release.set()
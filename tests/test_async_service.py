@@ -0,0 +1,115 @@
+"""The asyncio serving mode's job, events, cancel, process, batch and metrics endpoints against mock ComfyUI"""
+
+import asyncio
+import base64
+
+import pytest
+
+import comfy_service
+from conftest import make_png, wait_until
+
+pytest.importorskip("aiohttp")
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+import comfy_service_async  # noqa: E402
+
+@pytest.fixture
+def serve(mocks, monkeypatch):
+    """Run a scenario coroutine against a started app: serve(scenario) calls scenario(client)"""
+    for module in (comfy_service, comfy_service_async):
+        monkeypatch.setattr(module, "POOL_WARMUP", False)
+        monkeypatch.setattr(module, "SAVE_INPUTS_LOCALLY", False)
+        monkeypatch.setattr(module, "SAVE_OUTPUTS_LOCALLY", False)
+    # The app swaps the default collectors for its own
+    monkeypatch.setattr(comfy_service.metrics, "_collectors", list(comfy_service.metrics._collectors))
+
+    def run(scenario):
+        async def main():
+            app = comfy_service_async.create_app([server.url for server in mocks])
+            async with TestClient(TestServer(app)) as client:
+                pool = app["isogen"]["pool"]
+                for _ in range(100):
+                    if all(backend.available for backend in pool.backends):
+                        break
+                    await asyncio.sleep(0.05)
+                return await scenario(client)
+        return asyncio.run(main())
+    return run
+
+def json_body(seed, prompt="async building", **fields):
+    return {"image": base64.b64encode(make_png(seed)).decode(), "prompt": prompt, **fields}
+
+def test_job_api_streams_events_and_serves_the_result(serve):
+    async def scenario(client):
+        response = await client.post("/api/jobs", json=json_body(1))
+        assert response.status == 202
+        job = await response.json()
+        assert job["status_url"] == f"/api/jobs/{job['job_id']}"
+
+        events = await client.get(f"/api/jobs/{job['job_id']}/events")
+        assert events.headers["Content-Type"] == "text/event-stream"
+        assert events.headers["Access-Control-Allow-Origin"] == "*"
+        names = [line[len("event: "):] for line in (await events.text()).splitlines() if line.startswith("event: ")]
+        assert names[0] == "status"
+        assert "submitted" in names
+        assert names[-1] == "completed"
+
+        result = await (await client.get(job["result_url"])).json()
+        assert result["success"] and result["output_image"].startswith("data:image/png;base64,")
+        image = await client.get(job["image_url"])
+        assert image.status == 200
+        assert (await image.read()).startswith(b"\x89PNG")
+
+        exposition = await (await client.get("/api/metrics")).text()
+        assert 'isogen_jobs{status="completed"} 1' in exposition
+        assert "isogen_comfyui_up" in exposition
+        # No threaded job workers in this mode
+        assert "isogen_job_workers" not in exposition
+    serve(scenario)
+
+def test_process_and_batch(serve, mocks):
+    async def scenario(client):
+        response = await client.post("/api/process?prompt=raw", data=make_png(2), headers={"Content-Type": "image/png"})
+        assert response.status == 200
+        assert response.content_type == "image/png"
+
+        response = await client.post("/api/batch", json=json_body(3, prompts=["first", "second"]))
+        assert response.status == 200
+        batch = await response.json()
+        assert [variant["prompt"] for variant in batch["variants"]] == ["first", "second"]
+        image = await client.get(f"/api/jobs/{batch['job_id']}/image?variant=1")
+        assert (await image.read()).startswith(b"\x89PNG")
+
+        response = await client.post("/api/process-base64", json=json_body(4, progressive=True))
+        assert response.status == 400
+    serve(scenario)
+    # One prompt for the single image, one for both variants
+    assert sum(server.get("/mock/stats")["prompts"] for server in mocks) == 2
+
+@pytest.mark.parametrize("mocks", [3.0], indirect=True)
+def test_cancel_detaches_merged_requests_first(serve, mocks):
+    async def scenario(client):
+        body = json_body(5)
+        first = await (await client.post("/api/jobs", json=body, headers={"X-Client-Id": "alice"})).json()
+        merged = await (await client.post("/api/jobs", json=body, headers={"X-Client-Id": "bob"})).json()
+        assert merged["job_id"] == first["job_id"]
+        assert merged["attached_requests"] == 2
+        cancel_url = f"/api/jobs/{first['job_id']}/cancel"
+
+        assert (await client.post(f"{cancel_url}?client_id=eve")).status == 403
+        response = await client.post(f"{cancel_url}?client_id=bob")
+        assert response.status == 202
+        assert (await response.json())["status"] in ("queued", "running")
+        assert (await client.post(f"{cancel_url}?client_id=bob")).status == 403
+
+        response = await client.post(f"{cancel_url}?client_id=alice")
+        assert response.status == 200
+        status = await response.json()
+        assert status["status"] == "cancelled"
+        assert status["cancel_reason"] == "Cancelled by the client"
+        result = await client.get(first["result_url"])
+        assert result.status == 409
+        assert (await result.json())["error"] == "Job cancelled"
+    serve(scenario)
+    assert wait_until(lambda: all(not server.get("/queue")["queue_running"] for server in mocks))
+    assert sum(server.get("/mock/stats")["completed"] for server in mocks) == 0
@@ -0,0 +1,105 @@
+"""Backend pool, cancellation and abandoned-job tests against two mock ComfyUI servers"""
+
+import pytest
+
+import comfy_service
+from conftest import make_png, wait_until
+
+def test_lease_spreads_jobs_and_releases_slots(pool):
+    first = pool.acquire()
+    second = pool.acquire()
+    assert {first, second} == set(pool.backends)
+    # max_in_flight=1: both backends are busy
+    assert pool.acquire() is None
+
+    pool.release(first, duration=1.0)
+    assert first.in_flight == 0
+    assert first.jobs_completed == 1
+    assert pool.acquire() is first
+    pool.release(first)
+    pool.release(second)
+
+def test_lease_releases_on_failure(pool):
+    with pytest.raises(RuntimeError):
+        with pool.lease() as backend:
+            raise RuntimeError("boom")
+    assert backend.in_flight == 0
+    assert backend.failures == 1
+
+def test_backend_ejected_after_repeated_failures(pool):
+    failing, healthy = pool.backends
+    for _ in range(comfy_service.POOL_EJECT_FAILURES):
+        failing.in_flight += 1
+        pool.release(failing, failed=True)
+    assert failing.ejected
+    assert not failing.available
+
+    # Every new job goes to the other backend while the first is out of rotation
+    backend = pool.acquire()
+    assert backend is healthy
+    assert pool.acquire() is None
+    pool.release(backend)
+    assert pool.available_slots == pool.max_in_flight
+
+def test_generation_falls_back_to_healthy_backend(pool, mocks):
+    down = pool.backends[0]
+    mocks[0].stop()
+    down.capabilities.invalidate()
+    assert wait_until(lambda: not down.available)
+
+    result = comfy_service.run_generation_pipeline(make_png(1), "fallback building")
+    assert result["output_data"].startswith(b"\x89PNG")
+    assert pool.backends[1].jobs_completed == 1
+    assert mocks[1].get("/mock/stats")["completed"] == 1
+
+def test_no_backend_available_is_503(pool, mocks):
+    for server, backend in zip(mocks, pool.backends):
+        server.stop()
+        backend.capabilities.invalidate()
+    assert wait_until(lambda: not pool.any_available())
+
+    with pytest.raises(comfy_service.ProcessingError) as error:
+        with pool.lease():
+            pass
+    assert error.value.status_code == 503
+
+@pytest.mark.parametrize("mocks", [3.0], indirect=True)
+def test_cancel_queued_and_running_jobs(job_manager, mocks):
+    jobs = [job_manager.submit(make_png(index), f"cancel building {index}", client_id=f"client-{index}")
+            for index in range(3)]
+    # Two workers take a job each, the third waits in the admission queue
+    assert wait_until(lambda: sum(job.prompt_id is not None for job in jobs) == 2)
+    running = [job for job in jobs if job.prompt_id]
+    queued = next(job for job in jobs if not job.prompt_id)
+
+    assert job_manager.cancel(queued)
+    assert queued.status == "cancelled"
+
+    # Each backend runs one prompt; wait for ComfyUI to start executing before interrupting it
+    for job in running:
+        server = next(server for server in mocks if job.backend == server.url.split("://", 1)[-1])
+        assert wait_until(lambda: bool(server.get("/queue")["queue_running"]))
+        assert job_manager.cancel(job)
+
+    for job in running:
+        assert job.wait(10)
+        assert job.status == "cancelled"
+        server = next(server for server in mocks if job.backend == server.url.split("://", 1)[-1])
+        assert wait_until(lambda: server.get(f"/history/{job.prompt_id}"), timeout=10)
+        messages = server.get(f"/history/{job.prompt_id}")[job.prompt_id]["status"]["messages"]
+        assert messages[-1][0] == "execution_interrupted"
+    assert sum(server.get("/mock/stats")["completed"] for server in mocks) == 0
+
+@pytest.mark.parametrize("mocks", [6.0], indirect=True)
+def test_reaper_cancels_only_jobs_whose_stream_went_away(job_manager):
+    followed = job_manager.submit(make_png(10), "streamed building", client_id="streamed")
+    fetched_later = job_manager.submit(make_png(11), "polled building", client_id="polled")
+
+    events = followed.subscribe()
+    followed.unsubscribe(events)
+
+    assert wait_until(lambda: followed.status == "cancelled", timeout=5)
+    assert followed.cancel_reason.startswith("Abandoned")
+    # Submitted to be fetched later and never streamed: left to finish
+    assert fetched_later.status in ("queued", "running")
+    job_manager.cancel(fetched_later)
@@ -0,0 +1,50 @@
+"""Batch variants: request parsing, the shared multi-variant graph and a run against mock backends"""
+
+import pytest
+
+import comfy_service
+from conftest import make_png
+
+def test_variants_cycle_prompts_and_take_explicit_seeds():
+    fields = {"prompts": ["tower", "  house  "], "seeds": "7,8", "batch_size": "3"}
+    assert comfy_service.parse_batch_variants(fields, {}) == [
+        {"prompt": "tower", "seed": 7}, {"prompt": "house", "seed": 8}, {"prompt": "tower"}]
+
+def test_base_seed_gives_consecutive_variant_seeds():
+    assert comfy_service.parse_batch_variants({"batch_size": 3}, {"seed": 40}) == [
+        {"seed": 40}, {"seed": 41}, {"seed": 42}]
+
+@pytest.mark.parametrize("batch_size", ["0", str(comfy_service.BATCH_MAX_VARIANTS + 1)])
+def test_batch_size_is_bounded(batch_size):
+    with pytest.raises(ValueError):
+        comfy_service.parse_batch_variants({"batch_size": batch_size}, {})
+
+def test_variant_graph_shares_everything_upstream_of_the_varying_slots():
+    template = comfy_service.WorkflowTemplate(comfy_service.WORKFLOW_FILE)
+    workflow, node_maps = template.instantiate_variants({"image": "in.png", "positive_prompt": "tower"},
+                                                        [{"seed": 1}, {"seed": 2}, {"seed": 3}])
+    graph = template.current()
+    # The sampler and everything after it run per variant, the loaders, image branch and prompt once
+    cloned = set(node_maps[1])
+    assert cloned == {"109", "91", "107", "113", "118"}
+    assert len(workflow) == len(graph) + 2 * len(cloned)
+    assert workflow["100"]["inputs"]["image"] == "in.png"
+    assert [workflow[node_map["109"]]["inputs"]["noise_seed"] for node_map in node_maps] == [1, 2, 3]
+    assert workflow["109_v2"]["inputs"]["positive"] == ["96", 0]
+    assert workflow["91_v2"]["inputs"]["samples"] == ["109_v2", 0]
+    assert node_maps[0] == {node_id: node_id for node_id in cloned}
+
+def test_batch_runs_as_one_prompt_and_caches_each_variant(pool, mocks, tmp_path, monkeypatch):
+    monkeypatch.setattr(comfy_service, "result_cache", comfy_service.ResultCache(str(tmp_path), disk_bytes=0))
+    variants = [{"prompt": "tower", "seed": 1}, {"prompt": "house", "seed": 2}, {"prompt": "tower", "seed": 3}]
+
+    result = comfy_service.run_batch_pipeline(make_png(1), "tower", variants)
+    assert [(variant["prompt"], variant["seed"], variant["cached"]) for variant in result["variants"]] == [
+        ("tower", 1, False), ("house", 2, False), ("tower", 3, False)]
+    assert all(variant["output_data"].startswith(b"\x89PNG") for variant in result["variants"])
+    assert result["input_filename"] == comfy_service.staged_input_name(make_png(1))[0]
+    assert sum(server.get("/mock/stats")["prompts"] for server in mocks) == 1
+
+    again = comfy_service.run_batch_pipeline(make_png(1), "tower", variants[1:] + [{"prompt": "tower", "seed": 4}])
+    assert [variant["cached"] for variant in again["variants"]] == [True, True, False]
+    assert sum(server.get("/mock/stats")["prompts"] for server in mocks) == 2
@@ -0,0 +1,80 @@
+"""CompletionTracker: queue positions and completion from /queue and /history, without the WebSocket"""
+
+import pytest
+
+import comfy_service
+from conftest import MockServer
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"steps": 15}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+}
+
+@pytest.fixture
+def tracker():
+    # Not started: the tests drive _apply_queue/_settle directly
+    return comfy_service.CompletionTracker("127.0.0.1:9")
+
+def watch_events(tracker, prompt_id):
+    events = []
+    watch = tracker.watch(prompt_id, lambda event_type, data: events.append((event_type, data["position"])))
+    return watch, events
+
+def test_queue_positions_follow_the_pending_number_order(tracker):
+    first, first_events = watch_events(tracker, "a")
+    second, second_events = watch_events(tracker, "b")
+    queue = {"queue_running": [[0, "x", {}, {}, []]],
+             "queue_pending": [[7, "b", {}, {}, []], [5, "a", {}, {}, []]]}
+
+    changed, left = tracker._apply_queue({"a": first, "b": second}, queue)
+    assert changed and left == []
+    assert (first.queue_position, second.queue_position) == (1, 2)
+
+    # Nothing moved: no events, so the tracker backs off
+    changed, _ = tracker._apply_queue({"a": first, "b": second}, queue)
+    assert not changed
+    queue = {"queue_running": [[5, "a", {}, {}, []]], "queue_pending": [[7, "b", {}, {}, []]]}
+    tracker._apply_queue({"a": first, "b": second}, queue)
+    assert first_events == [("queue_position", 1), ("queue_position", 0)]
+    assert second_events == [("queue_position", 2), ("queue_position", 1)]
+
+def test_finished_prompt_hands_over_its_outputs(tracker):
+    watch = tracker.watch("a")
+    _, left = tracker._apply_queue({"a": watch}, {"queue_running": [], "queue_pending": []})
+    assert left == [watch]
+    outputs = {"9": {"images": [{"filename": "out.png", "subfolder": "", "type": "output"}]}}
+    assert tracker._settle(watch, {"outputs": outputs, "status": {"status_str": "success", "messages": []}})
+    assert watch.wait(0) == outputs
+
+def test_execution_error_is_raised_with_its_message(tracker):
+    watch = tracker.watch("a")
+    error = {"exception_type": "RuntimeError", "exception_message": "out of memory", "node_id": "3"}
+    tracker._settle(watch, {"outputs": {}, "status": {"status_str": "error",
+                                                      "messages": [["execution_error", error]]}})
+    with pytest.raises(comfy_service.ComfyUIExecutionError, match="out of memory"):
+        watch.wait(0)
+
+def test_prompt_missing_everywhere_fails_after_the_grace_period(tracker, monkeypatch):
+    watch = tracker.watch("a")
+    # We watch before queueing, so a prompt briefly missing from queue and history is normal
+    assert not tracker._settle(watch, None)
+    assert not watch.done
+    monkeypatch.setattr(comfy_service, "TRACKER_LOST_AFTER", 0)
+    assert tracker._settle(watch, None)
+    with pytest.raises(comfy_service.ComfyUIExecutionError, match="disappeared"):
+        watch.wait(0)
+
+def test_each_prompt_finishes_with_its_own_work():
+    server = MockServer(latency=0.6)
+    try:
+        tracker = comfy_service.CompletionTracker(server.address).start()
+        watches = [comfy_service.submit_and_watch(tracker, dict(WORKFLOW))[1] for _ in range(3)]
+        outputs = watches[0].wait(10)
+        assert "9" in outputs
+        # The first prompt is reported while the others are still queued or running
+        assert not watches[2].done
+        for watch in watches[1:]:
+            assert "9" in watch.wait(10)
+        assert server.get("/mock/stats")["completed"] == 3
+    finally:
+        server.stop()
@@ -0,0 +1,82 @@
+"""Input normalization: validation, orientation, alpha, downscaling and the clean-PNG passthrough"""
+
+import io
+
+import pytest
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+import comfy_service
+
+def encode(image, image_format="PNG", **params):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+def test_clean_png_within_target_passes_through_untouched():
+    data = encode(Image.new("RGB", (512, 384), (10, 20, 30)))
+    normalized, info = comfy_service.normalize_input_image(data, target_side=1024)
+    assert normalized is data
+    assert info["size"] == [512, 384]
+
+def test_large_input_is_downscaled_to_the_resize_side():
+    data = encode(Image.new("RGB", (3000, 2000), (10, 20, 30)), "JPEG", quality=90)
+    normalized, info = comfy_service.normalize_input_image(data, target_side=1024)
+    image = decode(normalized)
+    assert (image.format, image.mode, image.size) == ("PNG", "RGB", (1536, 1024))
+    assert info["source_size"] == [3000, 2000]
+
+def test_alpha_and_metadata_are_dropped():
+    text = PngInfo()
+    text.add_text("prompt", "{}")
+    data = encode(Image.new("RGBA", (256, 256), (10, 20, 30, 128)), pnginfo=text)
+    normalized, info = comfy_service.normalize_input_image(data)
+    image = decode(normalized)
+    assert image.mode == "RGB"
+    assert "prompt" not in image.info
+    assert info["source_mode"] == "RGBA"
+
+def test_rgb_png_with_text_chunks_is_re_encoded():
+    text = PngInfo()
+    text.add_text("workflow", "{}")
+    data = encode(Image.new("RGB", (256, 256)), pnginfo=text)
+    normalized, _ = comfy_service.normalize_input_image(data)
+    assert normalized != data
+    assert "workflow" not in decode(normalized).info
+
+def test_exif_orientation_is_applied():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotate 90 degrees clockwise on display
+    data = encode(Image.new("RGB", (400, 200), (10, 20, 30)), "JPEG", exif=exif.tobytes())
+    normalized, _ = comfy_service.normalize_input_image(data)
+    image = decode(normalized)
+    assert image.size == (200, 400)
+    assert not image.getexif()
+
+@pytest.mark.parametrize("data, message", [
+    (b"GIF89a" + bytes(32), "Unsupported image format"),
+    (b"\x89PNG\r\n\x1a\n" + bytes(32), "Could not decode image"),
+    (encode(Image.new("RGB", (32, 400))), "at least"),
+])
+def test_unusable_inputs_are_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        comfy_service.normalize_input_image(data)
+
+def test_pixel_limit_is_checked_before_decoding(monkeypatch):
+    monkeypatch.setattr(comfy_service, "INPUT_MAX_PIXELS", 100 * 100)
+    with pytest.raises(ValueError, match="pixel limit"):
+        comfy_service.normalize_input_image(encode(Image.new("RGB", (200, 200))))
+
+def test_target_side_comes_from_the_largest_profile():
+    template = comfy_service.WorkflowTemplate(comfy_service.WORKFLOW_FILE)
+    final_side = template.slot_value("resize_side")
+    assert comfy_service.input_target_side(template) == max(final_side, 512)
+
+def test_request_path_rejects_bad_images_with_400():
+    client = comfy_service.app.test_client()
+    response = client.post("/api/jobs", data=b"not an image", content_type="image/png")
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid image data"
@@ -0,0 +1,115 @@
+"""JobManager single-flight merging, per-client admission and cancellation, with an in-process pipeline"""
+
+import threading
+
+import pytest
+
+import comfy_service
+from conftest import make_png, wait_until
+
+class BlockingPipeline:
+    """Stands in for run_generation_pipeline, running until released"""
+    __name__ = "blocking_pipeline"
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self, image_data, prompt, progress=None, **options):
+        self.calls += 1
+        # Each progress event is a cancellation point, as in the real pipeline
+        while not self.release.wait(0.02):
+            progress("stage", {"stage": "executing"})
+        return {"output_data": b"image", "prompt": prompt}
+
+@pytest.fixture
+def pipeline():
+    pipeline = BlockingPipeline()
+    yield pipeline
+    pipeline.release.set()
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(comfy_service, "JOB_ABANDON_AFTER", 0)
+    return comfy_service.JobManager(max_workers=1, max_pending=8)
+
+def submit(manager, pipeline, client_id, seed=1):
+    return manager.submit(make_png(seed), "merged building", pipeline=pipeline, client_id=client_id)
+
+def test_identical_requests_merge_into_one_job(manager, pipeline):
+    first = submit(manager, pipeline, "alice")
+    second = submit(manager, pipeline, "bob")
+    assert second is first
+    assert first.attached == 2
+
+    pipeline.release.set()
+    assert first.wait(5)
+    assert first.status == "completed"
+    assert pipeline.calls == 1
+    assert wait_until(lambda: manager.admission.stats()["clients"] == 0)
+
+def test_merged_requests_count_against_the_client_limit(manager, pipeline):
+    manager.admission.max_per_client = 1
+    job = submit(manager, pipeline, "alice")
+    submit(manager, pipeline, "bob")
+    with pytest.raises(comfy_service.JobQueueFullError) as error:
+        submit(manager, pipeline, "bob")
+    assert error.value.reason == "client_limit"
+    assert job.attached == 2
+
+def test_a_client_only_detaches_itself(manager, pipeline):
+    job = submit(manager, pipeline, "alice")
+    submit(manager, pipeline, "bob")
+    assert wait_until(lambda: job.status == "running")
+
+    assert manager.cancel(job, client_id="bob")
+    # Detaching is once per request: bob can't remove alice by repeating the call
+    assert not manager.cancel(job, client_id="bob")
+    assert not manager.cancel(job, client_id="mallory")
+    assert job.attached == 1
+    assert job.cancel_reason is None
+
+    assert manager.cancel(job, client_id="alice")
+    assert job.wait(5)
+    assert job.status == "cancelled"
+    assert wait_until(lambda: manager.admission.stats()["clients"] == 0)
+
+def test_cancelled_queued_job_frees_every_attached_client(manager, pipeline):
+    running = submit(manager, pipeline, "alice", seed=1)
+    queued = submit(manager, pipeline, "alice", seed=2)
+    submit(manager, pipeline, "bob", seed=2)
+    assert wait_until(lambda: running.status == "running")
+
+    assert manager.cancel(queued, detach=False)
+    assert queued.status == "cancelled"
+    assert manager.admission.stats()["clients"] == 1
+
+def test_encode_timing_is_recorded_once_per_job(manager, monkeypatch):
+    metrics = comfy_service.Metrics()
+    monkeypatch.setattr(comfy_service, "metrics", metrics)
+
+    def pipeline(image_data, prompt, progress=None, **options):
+        return comfy_service.make_output_result(make_png(3), prompt, 1)
+    job = manager.submit(make_png(3), "encoded building", pipeline=pipeline, client_id="alice")
+    assert job.wait(5)
+
+    first = comfy_service.job_result_payload(job)
+    for _ in range(3):
+        # Polling a finished job is a read, it must not add samples or move the job's timings
+        assert comfy_service.job_result_payload(job)["timings"] == first["timings"]
+    assert metrics._histograms[("isogen_stage_seconds", (("stage", "encode"),))][2] == 1
+
+def test_finished_jobs_expire_without_new_submissions(monkeypatch):
+    monkeypatch.setattr(comfy_service, "JOB_ABANDON_AFTER", 0)
+    monkeypatch.setattr(comfy_service, "JOB_HOUSEKEEPING_INTERVAL", 0.05)
+    manager = comfy_service.JobManager(max_workers=1, max_pending=8, ttl=0.2)
+
+    def pipeline(image_data, prompt, progress=None, **options):
+        return {"output_data": b"image"}
+    job = manager.submit(make_png(4), "expiring building", pipeline=pipeline, client_id="alice")
+    assert job.wait(5)
+    assert job.image_data is None
+    assert manager.get(job.id) is job
+
+    assert wait_until(lambda: manager.get(job.id) is None, timeout=5)
+    assert manager.stats()["jobs"] == {}
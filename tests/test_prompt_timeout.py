@@ -0,0 +1,40 @@
+"""A prompt that runs past COMFY_PROMPT_TIMEOUT is cancelled on ComfyUI, not left holding the GPU"""
+
+import pytest
+import requests
+
+import comfy_service
+from conftest import MockServer, wait_until
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"steps": 15}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+}
+
+@pytest.fixture
+def slow_mock(monkeypatch):
+    monkeypatch.setattr(comfy_service, "COMFY_PROMPT_TIMEOUT", 0.5)
+    server = MockServer(latency=8)
+    yield server
+    server.stop()
+
+def test_websocket_timeout_interrupts_running_prompt(slow_mock):
+    with pytest.raises(TimeoutError):
+        comfy_service.process_with_comfyui_websocket(dict(WORKFLOW), server_address=slow_mock.address)
+
+    assert wait_until(lambda: slow_mock.get("/history"), timeout=5)
+    (entry,) = slow_mock.get("/history").values()
+    assert entry["status"]["messages"][-1][0] == "execution_interrupted"
+    assert slow_mock.get("/mock/stats")["completed"] == 0
+
+def test_polling_timeout_deletes_queued_prompt(slow_mock):
+    # Keep the mock's single worker busy so our prompt is still waiting when the timeout hits
+    requests.post(f"{slow_mock.url}/prompt", json={"prompt": WORKFLOW, "client_id": "other"}, timeout=5)
+    assert wait_until(lambda: slow_mock.get("/queue")["queue_running"])
+
+    with pytest.raises(TimeoutError):
+        comfy_service.process_with_polling(dict(WORKFLOW), server_address=slow_mock.address)
+
+    queue = slow_mock.get("/queue")
+    assert queue["queue_pending"] == []
+    assert len(queue["queue_running"]) == 1
@@ -0,0 +1,91 @@
+"""Output renditions: query parsing, transcoding, the rendition cache and the image endpoint"""
+
+import io
+
+import pytest
+from PIL import Image
+
+import comfy_service
+
+def photo(width=800, height=600):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 120, 40)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+@pytest.fixture(autouse=True)
+def rendition_cache(tmp_path, monkeypatch):
+    cache = comfy_service.ResultCache(str(tmp_path), disk_bytes=0)
+    monkeypatch.setattr(comfy_service, "rendition_cache", cache)
+    return cache
+
+def test_no_rendition_args_serve_the_original():
+    assert comfy_service.parse_rendition({"variant": "1"}) is None
+
+def test_size_preset_with_explicit_override():
+    rendition = comfy_service.parse_rendition({"size": "thumb", "quality": "50"}, "image/webp,*/*")
+    assert rendition == {"format": "webp", "quality": 50, "max_side": 256, "negotiated": True}
+
+@pytest.mark.parametrize("accept, image_format", [
+    (None, "webp"),
+    ("image/avif,image/webp,*/*", "webp"),
+    ("image/*", "webp"),
+    ("image/jpeg,image/png", "jpg"),
+    ("image/png", "png"),
+])
+def test_format_auto_follows_the_accept_header(accept, image_format):
+    assert comfy_service.parse_rendition({"format": "auto"}, accept)["format"] == image_format
+
+def test_png_ignores_quality():
+    rendition = comfy_service.parse_rendition({"format": "png", "quality": "40", "max_side": "64"})
+    assert rendition == {"format": "png", "quality": None, "max_side": 64, "negotiated": False}
+
+@pytest.mark.parametrize("args", [{"size": "huge"}, {"format": "gif"}, {"quality": "0"}, {"max_side": "8"},
+                                  {"max_side": str(comfy_service.RENDITION_MAX_SIDE + 1)}])
+def test_invalid_rendition_args(args):
+    with pytest.raises(ValueError):
+        comfy_service.parse_rendition(args)
+
+def test_render_downscales_and_transcodes():
+    rendition = comfy_service.parse_rendition({"format": "jpg", "max_side": "200"})
+    data, mime_type = comfy_service.render_image(photo(), rendition)
+    assert mime_type == "image/jpeg"
+    image = Image.open(io.BytesIO(data))
+    assert (image.format, image.size) == ("JPEG", (200, 150))
+
+def test_rendition_is_transcoded_once(rendition_cache, monkeypatch):
+    rendition = comfy_service.parse_rendition({"size": "thumb", "format": "webp"})
+    first = comfy_service.get_rendition(photo(), "etag1", rendition)
+    monkeypatch.setattr(comfy_service, "render_image", lambda *args: pytest.fail("rendered twice"))
+    assert comfy_service.get_rendition(photo(), "etag1", rendition) == first
+    assert rendition_cache.stats()["memory_hits"] == 1
+
+def test_job_image_endpoint_serves_renditions(monkeypatch):
+    monkeypatch.setattr(comfy_service, "JOB_ABANDON_AFTER", 0)
+    manager = comfy_service.JobManager(max_workers=1, max_pending=8)
+    monkeypatch.setattr(comfy_service, "job_manager", manager)
+    output = photo()
+
+    def pipeline(image_data, prompt, progress=None, **options):
+        return comfy_service.make_output_result(output, prompt, 1)
+    job = manager.submit(photo(64, 64), "rendered building", pipeline=pipeline, client_id="alice")
+    assert job.wait(5)
+    client = comfy_service.app.test_client()
+
+    original = client.get(f"/api/jobs/{job.id}/image")
+    assert original.data == output
+    assert original.headers["ETag"].strip('"') == job.result["output_etag"]
+
+    thumb = client.get(f"/api/jobs/{job.id}/image?size=thumb&format=auto", headers={"Accept": "image/webp,*/*"})
+    assert thumb.mimetype == "image/webp"
+    assert "Accept" in thumb.headers["Vary"]
+    assert Image.open(io.BytesIO(thumb.data)).size == (256, 192)
+    assert thumb.headers["ETag"] != original.headers["ETag"]
+
+    revalidated = client.get(f"/api/jobs/{job.id}/image?size=thumb&format=auto",
+                             headers={"Accept": "image/webp,*/*", "If-None-Match": thumb.headers["ETag"]})
+    assert revalidated.status_code == 304
+
+    result = client.get(f"/api/jobs/{job.id}/result").get_json()
+    assert result["thumbnail_url"] == f"/api/jobs/{job.id}/image?size=thumb&format=auto"
+
+    assert client.get(f"/api/jobs/{job.id}/image?size=huge").status_code == 400
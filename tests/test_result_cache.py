@@ -0,0 +1,95 @@
+"""ResultCache memory and disk tiers"""
+
+import os
+
+import comfy_service
+
+SIZE = 108
+
+def payload(index):
+    """PNG-signed bytes of a fixed size, the cache only sniffs the signature"""
+    return b"\x89PNG\r\n\x1a\n" + bytes([index]) * (SIZE - 8)
+
+def flush():
+    # A single writer thread, so this returns once every earlier write landed
+    comfy_service._disk_writer.submit(lambda: None).result()
+
+def test_memory_tier_is_lru_and_capped(tmp_path):
+    first = payload(1)
+    cache = comfy_service.ResultCache(str(tmp_path), memory_bytes=SIZE * 2, disk_bytes=0)
+    cache.put("a", first, "image/png")
+    cache.put("b", payload(2), "image/png")
+    assert cache.get("a") == (first, "image/png")  # a is now the most recent
+    cache.put("c", payload(3), "image/png")
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    stats = cache.stats()
+    assert stats["memory_entries"] == 2
+    assert stats["evictions"] == 1
+    assert os.listdir(tmp_path) == []
+
+def test_entry_too_large_for_memory_goes_to_disk_only(tmp_path):
+    data = payload(1)
+    cache = comfy_service.ResultCache(str(tmp_path), memory_bytes=SIZE - 1, disk_bytes=SIZE * 4)
+    cache.put("big", data, "image/png")
+    flush()
+    assert cache.stats()["memory_entries"] == 0
+    assert cache.get("big") == (data, "image/png")
+    assert cache.stats()["disk_hits"] == 1
+
+def test_disk_hit_is_promoted_to_memory(tmp_path):
+    first = payload(1)
+    cache = comfy_service.ResultCache(str(tmp_path), memory_bytes=SIZE, disk_bytes=SIZE * 4)
+    cache.put("a", first, "image/png")
+    cache.put("b", payload(2), "image/png")
+    flush()
+
+    assert cache.get("a") == (first, "image/png")
+    assert cache.get("a") == (first, "image/png")
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+
+def test_disk_tier_evicts_least_recently_used_files(tmp_path):
+    cache = comfy_service.ResultCache(str(tmp_path), memory_bytes=1, disk_bytes=SIZE * 2)
+    cache.put("a", payload(1), "image/png")
+    cache.put("b", payload(2), "image/png")
+    flush()
+    assert cache.get("a") is not None  # Read from disk, now more recent than b
+    cache.put("c", payload(3), "image/png")
+    flush()
+
+    assert sorted(os.listdir(tmp_path)) == ["a.bin", "c.bin"]
+    assert cache.get("b") is None
+    assert cache.stats()["disk_bytes"] <= SIZE * 2
+
+def test_disk_index_survives_restart(tmp_path):
+    data = payload(1)
+    cache = comfy_service.ResultCache(str(tmp_path), memory_bytes=SIZE * 4, disk_bytes=SIZE * 4)
+    cache.put("a", data, "image/png")
+    flush()
+
+    restarted = comfy_service.ResultCache(str(tmp_path), memory_bytes=SIZE * 4, disk_bytes=SIZE * 4)
+    assert restarted.stats()["disk_entries"] == 1
+    # The mime type is sniffed again from the bytes
+    assert restarted.get("a") == (data, "image/png")
+
+def test_missing_file_is_a_miss(tmp_path):
+    data = payload(1)
+    cache = comfy_service.ResultCache(str(tmp_path), memory_bytes=1, disk_bytes=SIZE * 4)
+    cache.put("a", data, "image/png")
+    flush()
+    os.remove(tmp_path / "a.bin")
+
+    assert cache.get("a") is None
+    assert cache.stats()["disk_entries"] == 0
+    assert cache.stats()["misses"] == 1
+
+def test_make_key_covers_every_input():
+    base = ("input", "prompt", 1, "v1", {"profile": "final"})
+    keys = {comfy_service.ResultCache.make_key(*base)}
+    for index, value in enumerate(("other", "other prompt", 2, "v2", {"profile": "draft"})):
+        changed = list(base)
+        changed[index] = value
+        keys.add(comfy_service.ResultCache.make_key(*changed))
+    assert len(keys) == 6
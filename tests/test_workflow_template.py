@@ -0,0 +1,80 @@
+"""WorkflowTemplate reloading"""
+
+import json
+import os
+
+import comfy_service
+
+SLOTS = {"prompt": ("6", "text")}
+
+def write(path, content, mtime):
+    path.write_text(content)
+    os.utime(path, ns=(mtime, mtime))
+
+def test_broken_edit_is_parsed_once_and_last_good_graph_served(tmp_path, caplog):
+    path = tmp_path / "workflow.json"
+    write(path, json.dumps({"6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a house"}}}), 1_000_000_000)
+    template = comfy_service.WorkflowTemplate(str(path), slots=SLOTS, profiles={})
+    good = template.current()
+    assert good["6"]["inputs"]["text"] == "a house"
+
+    write(path, '{"6": {"class_type": ', 2_000_000_000)
+    for _ in range(3):
+        assert template.current() is good
+    assert sum(record.message.startswith("Error loading workflow") for record in caplog.records) == 1
+
+    write(path, json.dumps({"6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a tower"}}}), 3_000_000_000)
+    assert template.current()["6"]["inputs"]["text"] == "a tower"
+
+def node(class_type, **inputs):
+    return {"class_type": class_type, "inputs": inputs}
+
+GRAPH = {
+    "1": node("LoadImage", image="in.png"),
+    "2": node("KSampler", steps=20, latent_image=["1", 0]),
+    "3": node("VAEDecode", samples=["2", 0]),
+    "4": node("ImageScaleBy", image=["3", 0], scale_by=2),
+    "5": node("SaveImage", images=["4", 0], filename_prefix="out"),
+    "6": node("PreviewImage", images=["1", 0]),
+    "7": node("ImageComparer", image_a=["6", 0], image_b=["3", 0]),
+}
+
+def test_profile_bypasses_drops_and_turns_saves_into_previews():
+    profile = {"slots": {"steps": 4}, "bypass": {"4": "image"}, "drop": ["6"], "preview_saves": True}
+    workflow = comfy_service.apply_workflow_profile(GRAPH, profile, {"steps": ("2", "steps")})
+
+    # The consumer of the bypassed upscale reads the upscale's own input
+    assert workflow["5"] == {"class_type": "PreviewImage", "inputs": {"images": ["3", 0]},
+                             "_meta": {"title": "Preview Image"}}
+    # Dropped nodes take whatever linked to them along
+    assert "6" not in workflow and "7" not in workflow
+    assert workflow["2"]["inputs"]["steps"] == 4
+    assert sorted(workflow) == ["1", "2", "3", "5"]
+
+def test_profile_leaves_the_template_untouched():
+    before = json.dumps(GRAPH, sort_keys=True)
+    comfy_service.apply_workflow_profile(GRAPH, {"slots": {"steps": 4}, "bypass": {"4": "image"},
+                                                 "preview_saves": True}, {"steps": ("2", "steps")})
+    assert json.dumps(GRAPH, sort_keys=True) == before
+
+def test_unknown_profile_entries_are_skipped():
+    workflow = comfy_service.apply_workflow_profile(GRAPH, {"bypass": {"42": "image"}, "slots": {"cfg": 1}},
+                                                    {"steps": ("2", "steps")})
+    assert workflow == GRAPH
+
+def test_draft_profile_of_the_shipped_workflow_is_a_valid_graph():
+    template = comfy_service.WorkflowTemplate(comfy_service.WORKFLOW_FILE)
+    draft = template.profile_graph(comfy_service.WORKFLOW_DRAFT_PROFILE)
+    final = template.profile_graph(comfy_service.WORKFLOW_DEFAULT_PROFILE)
+
+    assert set(final) - set(draft) == {"106", "113", "115", "118"}
+    for node_id, graph_node in draft.items():
+        for value in graph_node["inputs"].values():
+            if comfy_service.is_node_link(value):
+                assert value[0] in draft, f"{node_id} links to removed node {value[0]}"
+    assert not [node_id for node_id, graph_node in draft.items()
+                if graph_node["class_type"] in comfy_service.OUTPUT_CLASS_TYPES]
+    assert draft["107"]["inputs"]["images"] == ["91", 0]
+    assert template.slot_value("steps", "draft") == 6
+    # Built once per workflow version
+    assert template.profile_graph(comfy_service.WORKFLOW_DRAFT_PROFILE) is draft